@@ -1,135 +1,201 @@
 import os
-import time
-import io
-import chardet
+import zipfile
 import streamlit as st
 import pandas as pd
 import folium
-from geopy.distance import geodesic
+from folium.plugins import Draw
 from streamlit_folium import st_folium
+from batch_quote import TEMPLATE, quote_centers, read_centers, resolve_centers, sheet_name
+from dataset import CONFLICT_POLICIES, SessionDataset, SharedDataset, export_frame, load_dataset, source_fingerprint
+from exports import EXCEL_MIME, build_csv, build_excel, lazy_export
+from geo_search import direction_mask
+from geocoding import GeocodeCache, GeocodingStage, make_geocoder
+from ingest import iter_upload_chunks
+from instrumentation import PerfRecorder, configure_logging, span
+from map_layers import add_density_layers, add_town_markers, selection_layer
+from polygons import parse_geojson, polygons_geojson, polygons_key
+from query_cache import query_cache
+from radius_solver import RadiusSolver
+from selection import DEFAULT_PAGE_SIZE, PAGE_SIZES, TownSelection
+from static_map import render_map_png
 
 # --- Cloud or local 判定 ---
 IS_CLOUD = os.environ.get("STREAMLIT_SERVER_HEADLESS") == "1"
 
+# 座標のある行が1つもない場合の地図の中心（神戸市役所付近）
+DEFAULT_MAP_CENTER = [34.69, 135.195]
+
+# --- 処理時間の計測（環境変数 APP_PERF_LOG を指定すると再実行ごとの結果をJSONで書き出す） ---
+configure_logging()
+if 'perf' not in st.session_state:
+    st.session_state.perf = PerfRecorder()
+perf = st.session_state.perf
+perf.start_rerun()
+
 # --- セッション状態の初期化 ---
-if 'selected_towns' not in st.session_state:
-    st.session_state.selected_towns = []
-
-if 'last_selection_count' not in st.session_state:
-    st.session_state.last_selection_count = 0
-
-if 'selection_changed' not in st.session_state:
-    st.session_state.selection_changed = False
-
-# 選択変更の検知関数
-def detect_selection_change():
-    current_count = len(st.session_state.selected_towns)
-    if current_count != st.session_state.last_selection_count:
-        st.session_state.selection_changed = True
-        st.session_state.last_selection_count = current_count
-    return st.session_state.selection_changed
-
-# 選択状態を更新する関数
-def update_selection(town, is_selected):
-    if is_selected and town not in st.session_state.selected_towns:
-        st.session_state.selected_towns.append(town)
-        st.session_state.selection_changed = True
-    elif not is_selected and town in st.session_state.selected_towns:
-        st.session_state.selected_towns.remove(town)
-        st.session_state.selection_changed = True
+# 選択した町名は集合で持つ（一括の選択・解除・反転を集合演算で行う）
+if 'town_selection' not in st.session_state:
+    st.session_state.town_selection = TownSelection()
+
+# チェックボックスが操作された時に選択状態を更新する関数
+def toggle_town(town):
+    st.session_state.town_selection.set(town, st.session_state[f"town_{town}"])
 
 # --- 初期データ読込み ---
-if 'df' not in st.session_state:
-    try:
-        # 既存のデータファイル
-        df1 = pd.read_csv('加古川市住所データ.csv', encoding='utf-8')
-        df2 = pd.read_csv('姫路市全域住所データ - 2024331.csv', encoding='utf-8')
-        
-        # 新規追加する市のデータファイル
-        df_list = [df1, df2]
-        
-        try:
-            df3 = pd.read_csv('神戸市住所データ.csv', encoding='utf-8')
-            df_list.append(df3)
-        except Exception as e:
-            if not IS_CLOUD:
-                st.warning(f"神戸市データファイルの読み込みに失敗: {str(e)}")
-                
-        try:
-            df4 = pd.read_csv('明石市住所データ.csv', encoding='utf-8')
-            df_list.append(df4)
-        except Exception as e:
-            if not IS_CLOUD:
-                st.warning(f"明石市データファイルの読み込みに失敗: {str(e)}")
-                
-        try:
-            df5 = pd.read_csv('西宮市住所データ.csv', encoding='utf-8')
-            df_list.append(df5)
-        except Exception as e:
-            if not IS_CLOUD:
-                st.warning(f"西宮市データファイルの読み込みに失敗: {str(e)}")
-                
-        try:
-            df6 = pd.read_csv('高砂市住所データ.csv', encoding='utf-8')
-            df_list.append(df6)
-        except Exception as e:
-            if not IS_CLOUD:
-                st.warning(f"高砂市データファイルの読み込みに失敗: {str(e)}")
-        
-        # すべてのデータフレームを結合
-        df = pd.concat(df_list, ignore_index=True)
-        
-    except Exception as e:
-        st.error(f"データの読み込みに失敗しました: {str(e)}")
-        df = pd.DataFrame(columns=['住所（スプレッドシート用）', '世帯数', 'Latitude', 'Longitude'])
-    
-    df['世帯数'] = pd.to_numeric(df['世帯数'].astype(str).str.replace(',', '', regex=False), errors='coerce').fillna(0).astype(int)
-    st.session_state.df = df
+# コンパイル済みデータと空間インデックスをプロセス内で一度だけ作り、全セッションで共有する
+# 元CSVが更新されるとキーが変わり、読み直される
+# 古いデータを持ち続けないように、保持するのは最新の1つだけ
+@st.cache_resource(show_spinner="住所データを読み込んでいます...", max_entries=1)
+def load_base_dataset(fingerprint):
+    df, errors = load_dataset()
+    return SharedDataset(df), errors
+
+with span('load'):
+    shared_data, load_errors = load_base_dataset(source_fingerprint())
+
+if 'data' not in st.session_state:
+    if not IS_CLOUD:
+        for message in load_errors:
+            st.warning(message)
+    if len(shared_data) == 0:
+        st.error("データの読み込みに失敗しました")
+
+    # セッションには共有データへの参照と、アップロードされた差分だけを持つ
+    st.session_state.data = SessionDataset(shared_data)
+elif st.session_state.data.shared is not shared_data:
+    # 元CSVが更新された場合は、アップロード分を新しい共有データに載せ替える（古いデータの検索結果は捨てる）
+    query_cache.discard(st.session_state.data.shared.version)
+    st.session_state.data = st.session_state.data.rebase(shared_data)
+
+data = st.session_state.data
+
+# 住所→座標の永続キャッシュ（プロセス内で1つの接続を全セッションで共有する）
+@st.cache_resource
+def geocode_cache():
+    return GeocodeCache()
 
 # --- サイドバーに都市選択フィルター追加 ---
 st.sidebar.header("データフィルター")
 cities = ["すべての市", "加古川市", "姫路市", "神戸市", "西宮市", "高砂市", "明石市"]
 selected_city = st.sidebar.selectbox("市を選択:", cities)
 
-# 選択された市でデータをフィルタリング
-if selected_city != "すべての市":
-    filtered_city_df = st.session_state.df[st.session_state.df['住所（スプレッドシート用）'].str.contains(selected_city, na=False)]
-    # 一時的にフィルタリングされたデータを使用
-    display_df = filtered_city_df
+# 区のある市では区でも絞り込めるようにする
+city_wards = data.wards(selected_city) if selected_city != "すべての市" else []
+if city_wards:
+    selected_ward = st.sidebar.selectbox("区を選択:", ["すべての区"] + city_wards)
 else:
-    display_df = st.session_state.df
+    selected_ward = "すべての区"
+ward_filter = None if selected_ward == "すべての区" else selected_ward
+selected_area = selected_city + (ward_filter or "")
+
+# 選択された市（区）に含まれる行の判定（検索結果などの一部の行に適用する）
+def in_display(df):
+    mask = pd.Series(True, index=df.index)
+    if selected_city != "すべての市":
+        mask &= df['city'] == selected_city
+    if ward_filter is not None:
+        mask &= df['ward'] == ward_filter
+    return mask
+
+# 地図の中心（行の座標の中央値）。座標のある行がなければ全データの中央値、それもなければ既定の位置
+def map_center_of(rows):
+    center_lat, center_lon = rows['Latitude'].median(), rows['Longitude'].median()
+    if pd.isna(center_lat) or pd.isna(center_lon):
+        lat, lon = data.coordinates()
+        center_lat, center_lon = pd.Series(lat).median(), pd.Series(lon).median()
+    if pd.isna(center_lat) or pd.isna(center_lon):
+        return DEFAULT_MAP_CENTER
+    return [float(center_lat), float(center_lon)]
+
+# 選択された市（区）の全行（市・区ごとの行範囲から切り出す）
+def display_rows():
+    if selected_city == "すべての市":
+        return data.filter()
+    return data.area_rows(selected_city, ward_filter)
+
+# 住所の部分一致検索（検索インデックスを使い、一致度の高い順に返す）
+def search_display(query):
+    with span('search'):
+        matched = data.take(data.search(query))
+        return matched[in_display(matched)]
 
 # 現在のフィルタリング状態を表示
-st.sidebar.info(f"現在のデータ: {selected_city if selected_city != 'すべての市' else '全地域'} ({len(display_df)} 件)")
+display_count = len(data) if selected_city == "すべての市" else data.area_count(selected_city, ward_filter)
+st.sidebar.info(f"現在のデータ: {selected_area if selected_city != 'すべての市' else '全地域'} ({display_count} 件)")
 
 # --- CSV/エクセルアップロード ---
 st.sidebar.header("住所データ管理")
 uploaded_file = st.sidebar.file_uploader("CSVまたはExcelファイルをアップロードしてください", type=["csv", "xlsx"], key="file_upload")
+conflict_policy = st.sidebar.selectbox(
+    "同じ住所・座標の世帯数が既存データと違う場合:",
+    list(CONFLICT_POLICIES), format_func=CONFLICT_POLICIES.get, key="conflict_policy"
+)
+# 座標のない住所は同梱データの地名辞典で埋め、それでも見つからない住所だけを外部の地図サービスに問い合わせる
+# （問い合わせ先は環境変数 APP_GEOCODER で変えられる。既定は OpenStreetMap の Nominatim）
+use_geocoder = st.sidebar.checkbox("座標がない住所を地図サービス（OpenStreetMap）で検索する", value=False, key="use_geocoder")
+
+if 'ingested_uploads' not in st.session_state:
+    st.session_state.ingested_uploads = {}
 
 if uploaded_file:
-    if uploaded_file.name.endswith('.csv'):
-        rawdata = uploaded_file.read()
-        encoding_guess = chardet.detect(rawdata)['encoding'] or 'shift-jis'
+    # 同じファイルは再実行のたびに読み直さない
+    if uploaded_file.file_id not in st.session_state.ingested_uploads:
+        progress = st.sidebar.progress(0.0, text='読み込み中...')
+
+        def chunks_with_progress():
+            for chunk, done in iter_upload_chunks(uploaded_file):
+                progress.progress(done, text=f'読み込み中... {done:.0%}')
+                yield chunk
+
+        previous_version = data.version
+        geocoder = None
+        if use_geocoder:
+            try:
+                geocoder = make_geocoder(os.environ.get('APP_GEOCODER', 'nominatim'))
+            except (OSError, ValueError) as e:
+                # 表のファイルが読めない・設定の書き間違いでも、キャッシュと同梱データだけで読み込みは続ける
+                st.sidebar.warning(f'地図サービスの設定（APP_GEOCODER）を使えないため、同梱データだけで座標を補います: {e}')
         try:
-            new_df = pd.read_csv(io.StringIO(rawdata.decode(encoding_guess)))
-        except UnicodeDecodeError:
-            new_df = pd.read_csv(io.StringIO(rawdata.decode('shift-jis', errors='ignore')))
-    elif uploaded_file.name.endswith('.xlsx'):
-        new_df = pd.read_excel(uploaded_file, engine='openpyxl')
-
-    new_df['世帯数'] = pd.to_numeric(new_df['世帯数'].astype(str).str.replace(',', '', regex=False), errors='coerce').fillna(0).astype(int)
-    st.session_state.df = pd.concat([st.session_state.df, new_df], ignore_index=True).drop_duplicates().reset_index(drop=True)
-    st.sidebar.success('データが追加されました！')
+            stage = GeocodingStage(shared_data.gazetteer, geocode_cache(), geocoder,
+                                   progress=lambda done: progress.progress(done, text=f'住所を検索中... {done:.0%}'))
+            # 分割して読み込み、新しい地点の行だけをこのセッションの差分として追加（既存の地点は世帯数を更新）
+            with span('upload'):
+                result = data.append_chunks(stage.iter_chunks(chunks_with_progress()), policy=conflict_policy)
+        # 壊れた Excel（zip として開けない）や読込み中の入出力エラーも、アプリを止めずに知らせる
+        except (ValueError, KeyError, UnicodeError, zipfile.BadZipFile, OSError) as e:
+            progress.empty()
+            st.sidebar.error(f'ファイルを読み込めませんでした: {e}')
+        else:
+            progress.empty()
+            st.session_state.ingested_uploads[uploaded_file.file_id] = result + (stage.stats,)
+            # このセッションだけの前の版の検索結果は、もう使われないので捨てる
+            if previous_version != data.version and previous_version != shared_data.version:
+                query_cache.discard(previous_version)
+
+    if uploaded_file.file_id in st.session_state.ingested_uploads:
+        added, updated, geocoded = st.session_state.ingested_uploads[uploaded_file.file_id]
+        st.sidebar.success(f'データが追加されました！（新しい行 {added:,} 件・世帯数を更新 {updated:,} 件）')
+        filled = geocoded['cache'] + geocoded['gazetteer'] + geocoded['geocoder']
+        if filled:
+            st.sidebar.info(f"座標のない住所 {filled:,} 件の座標を補いました（保存済み {geocoded['cache']:,} 件・"
+                            f"同梱データ {geocoded['gazetteer']:,} 件・地図サービス {geocoded['geocoder']:,} 件）")
+        if geocoded['not_found'] or geocoded['failed']:
+            st.sidebar.warning(f"座標が見つからなかった住所: {geocoded['not_found'] + geocoded['failed']:,} 件（地図には表示されません）")
 
 # --- 現在のデータ表示 ---
 with st.sidebar.expander("現在のCSVデータを確認"):
-    st.dataframe(display_df)
+    st.dataframe(export_frame(display_rows()))
+
+# --- メモリ使用量 ---
+shared_bytes, session_bytes = data.memory_usage()
+st.sidebar.caption(f"メモリ使用量: 共有データ {shared_bytes / 1024 ** 2:.1f}MB（全セッション共通） / "
+                   f"このセッションの追加データ {session_bytes / 1024 ** 2:.2f}MB（{len(data.overlay)} 件）")
 
 # --- 検索機能 ---
 st.title("ポスティングエリア世帯数計算ツール")
 
 # タブ選択（円形指定とチェックボックス指定の切り替え）
-tab1, tab2 = st.tabs(["円形範囲指定", "町名個別選択"])
+tab1, tab2, tab3, tab4 = st.tabs(["円形範囲指定", "町名個別選択", "多角形範囲指定", "複数地点一括見積"])
 
 with tab1:
     st.subheader("エリア検索（円形範囲指定）")
@@ -138,14 +204,23 @@ with tab1:
 
     if search_town:
         # フィルタリングされたデータから検索
-        filtered_df = display_df[display_df['住所（スプレッドシート用）'].str.contains(search_town, na=False)]
+        filtered_df = search_display(search_town)
         filtered_df = filtered_df.dropna(subset=['Latitude', 'Longitude'])
 
         if filtered_df.empty:
             st.warning('該当する町名が見つかりません。')
         else:
             selected_town = st.selectbox('町名を選択してください:', filtered_df['住所（スプレッドシート用）'])
-            radius_km = st.number_input('半径をkmで入力してください', min_value=0.5, max_value=10.0, step=0.5, value=3.0)
+
+            # 半径は直接指定するか、目標世帯数・予算から求める
+            radius_mode = st.radio('半径の決め方:', ['半径を指定', '目標世帯数から求める', '予算から求める'],
+                                   horizontal=True, key="radius_mode")
+            if radius_mode == '半径を指定':
+                radius_km = st.number_input('半径をkmで入力してください', min_value=0.5, max_value=10.0, step=0.5, value=3.0)
+            elif radius_mode == '目標世帯数から求める':
+                target_households = st.number_input('目標世帯数:', min_value=1, value=20000, step=1000, key="target_households")
+            else:
+                budget = st.number_input('予算（円）:', min_value=1, value=100000, step=10000, key="budget")
             
             # 単価情報の入力欄を追加（最小値を0.1に変更）
             unit_price = st.number_input('ポスティング単価（円/世帯）:', min_value=0.1, value=5.0, step=0.1, key="circle_price")
@@ -153,8 +228,37 @@ with tab1:
             selected_row = filtered_df[filtered_df['住所（スプレッドシート用）'] == selected_town].iloc[0]
             map_center = [selected_row['Latitude'], selected_row['Longitude']]
 
+            center_lat, center_lon = selected_row['Latitude'], selected_row['Longitude']
+            if radius_mode == '半径を指定':
+                # 範囲内の行を一括で検索（地図・合計・エクスポートで同じ結果を共有。同じ条件の検索は全セッションで再利用）
+                with span('radius'):
+                    in_range = data.cached('radius', lambda: data.query_radius(center_lat, center_lon, radius_km),
+                                           lat=center_lat, lon=center_lon, radius_km=radius_km)
+            else:
+                # 近い順に並べた町の世帯数の累積和から、目標に届く半径を求める
+                def solve_radius():
+                    lat, lon = data.coordinates()
+                    solver = RadiusSolver(lat, lon, data.households(), center_lat, center_lon)
+                    if radius_mode == '目標世帯数から求める':
+                        town_count, solved_radius_km = solver.for_households(target_households)
+                    else:
+                        town_count, solved_radius_km = solver.for_budget(budget, unit_price)
+                    return solver.ids(town_count), town_count, solved_radius_km, solver.total_households
+
+                goal = dict(target_households=target_households) if radius_mode == '目標世帯数から求める' else dict(budget=budget, unit_price=unit_price)
+                with span('radius_solver'):
+                    in_range, town_count, solved_radius_km, all_households = data.cached(
+                        'radius_solver', solve_radius, lat=center_lat, lon=center_lon, **goal)
+                if radius_mode == '目標世帯数から求める':
+                    if all_households < target_households:
+                        st.warning(f'全データの世帯数（{all_households:,}世帯）が目標に届きません')
+                elif town_count == 0:
+                    st.warning('予算内に収まる町がありません')
+                radius_km = round(solved_radius_km, 3)
+                st.info(f'📏 求めた半径: {radius_km}km（近い順に{town_count}件）')
+
             # 地図作成
-            m = folium.Map(location=map_center, zoom_start=14)
+            m = folium.Map(location=map_center, zoom_start=14, prefer_canvas=True)
             folium.Circle(location=map_center, radius=radius_km * 1000, color='blue', fill=True, fill_opacity=0.1).add_to(m)
             
             # 中心点マーカー（選択した地点）
@@ -164,16 +268,10 @@ with tab1:
                 icon=folium.Icon(color='red', icon='star')
             ).add_to(m)
 
-            # 範囲内マーカー追加
-            download_df = pd.DataFrame(columns=st.session_state.df.columns)
-            for idx, row in st.session_state.df.iterrows():
-                if pd.notna(row['Latitude']) and pd.notna(row['Longitude']):
-                    distance = geodesic((selected_row['Latitude'], selected_row['Longitude']), (row['Latitude'], row['Longitude'])).km
-                    if distance <= radius_km:
-                        folium.Marker([row['Latitude'], row['Longitude']],
-                                  popup=f"{row['住所（スプレッドシート用）']}:{row['世帯数']}世帯",
-                                  icon=folium.Icon(color='green', icon='home')).add_to(m)
-                        download_df = pd.concat([download_df, row.to_frame().T], ignore_index=True)
+            download_df = data.take(in_range)
+
+            # 範囲内マーカー追加（件数が多い場合は1つのレイヤーにまとめて描画し、縮小時は格子ごとの世帯数で色分け）
+            add_town_markers(m, download_df, color='green', pyramid=data.pyramid, ids=in_range)
 
             # 合計世帯数と売上予測を表示（「予想売上」→「算出金額」に変更）
             total_households = download_df['世帯数'].sum()
@@ -185,80 +283,51 @@ with tab1:
             with col2:
                 st.info(f'💰 算出金額: {estimated_sales:,}円（{unit_price}円/世帯）')
 
-            st_folium(m, width=700, height=500)
+            with span('st_folium'):
+                st_folium(m, width=700, height=500)
 
-            # --- スクリーンショット保存（ローカルのみ） ---
-            if not IS_CLOUD:
-                try:
-                    import chromedriver_autoinstaller
-                    from selenium import webdriver
-                    from selenium.webdriver.chrome.options import Options
-                    
-                    chromedriver_autoinstaller.install()
-                    map_file = os.path.abspath('temp_map.html')
-                    m.save(map_file)
-
-                    options = Options()
-                    options.add_argument('--headless')
-                    options.add_argument('--no-sandbox')
-                    options.add_argument('--disable-dev-shm-usage')
-                    options.add_argument('--disable-gpu')
-                    options.add_argument('--window-size=1920,1080')
-
-                    driver = webdriver.Chrome(options=options)
-                    driver.get(f'file://{map_file}')
-                    time.sleep(5)
-
-                    screenshot_file = os.path.abspath('map_image.png')
-                    driver.save_screenshot(screenshot_file)
-                    driver.quit()
-
-                    with open(screenshot_file, 'rb') as f:
-                        st.download_button('🗺️ 地図画像をダウンロード', f, 'map_image.png', 'image/png')
-
-                except Exception as e:
-                    st.error(f"地図のスクリーンショット取得に失敗しました（ローカル環境専用機能）: {e}")
-            else:
-                st.info("🛑 Web公開版では地図画像の自動保存機能は利用できません。")
+            # --- ダウンロード（ボタンが押された時だけ作成し、同じ内容は再利用） ---
+            circle_params = dict(center=selected_town, radius_km=radius_km, unit_price=unit_price)
 
-            # --- CSVダウンロード（町名入りファイル名にする） ---
-            csv_buffer = io.StringIO()
-            download_df.to_csv(csv_buffer, index=False)
-            csv_data = csv_buffer.getvalue().encode('utf-8')
-            file_name = f"範囲内住所データ_{selected_town}.csv"
+            # 地図画像
+            context_lat, context_lon = data.coordinates()
+            st.download_button(
+                '🗺️ 地図画像をダウンロード',
+                lazy_export('png', download_df, lambda rows: render_map_png(
+                    rows['Latitude'], rows['Longitude'], color='green',
+                    center=map_center, radius_km=radius_km, star=map_center,
+                    context_lat=context_lat, context_lon=context_lon
+                ), dataset_size=len(data), **circle_params),
+                'map_image.png',
+                'image/png'
+            )
 
             # エクスポートボタンのコンテナ
             export_col1, export_col2 = st.columns(2)
             with export_col1:
+                # CSV（町名入りファイル名にする）
                 st.download_button(
                     '📥 範囲内住所データをCSVでダウンロード',
-                    csv_data,
-                    file_name,
+                    lazy_export('csv', download_df, build_csv),
+                    f"範囲内住所データ_{selected_town}.csv",
                     'text/csv'
                 )
-            
-            # エクセルダウンロード機能も追加（サマリーシートの表記も変更）
+
             with export_col2:
-                try:
-                    buffer = io.BytesIO()
-                    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                        download_df.to_excel(writer, index=False, sheet_name='住所データ')
-                        # サマリーシートを追加
-                        summary_data = pd.DataFrame({
-                            '項目': ['検索町名', '半径', '総世帯数', 'ポスティング単価', '算出金額'],
-                            '値': [selected_town, f'{radius_km}km', f'{total_households:,}世帯', f'{unit_price}円/世帯', f'{estimated_sales:,}円']
-                        })
-                        summary_data.to_excel(writer, index=False, sheet_name='サマリー')
-                    
-                    excel_data = buffer.getvalue()
-                    st.download_button(
-                        '📊 範囲内住所データをExcelでダウンロード',
-                        excel_data,
-                        f"範囲内住所データ_{selected_town}_{radius_km}km.xlsx",
-                        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                    )
-                except Exception as e:
-                    st.error(f"Excelファイル作成に失敗しました: {e}")
+                # Excel（サマリーシート付き）
+                circle_summary = [
+                    ('検索町名', selected_town),
+                    ('半径', f'{radius_km}km'),
+                    ('総世帯数', f'{total_households:,}世帯'),
+                    ('ポスティング単価', f'{unit_price}円/世帯'),
+                    ('算出金額', f'{estimated_sales:,}円'),
+                ]
+                st.download_button(
+                    '📊 範囲内住所データをExcelでダウンロード',
+                    lazy_export('xlsx', download_df, lambda rows: build_excel(rows, circle_summary), **circle_params),
+                    f"範囲内住所データ_{selected_town}_{radius_km}km.xlsx",
+                    EXCEL_MIME
+                )
     else:
         st.warning('町名を入力して検索してください（部分的でもOK）')
 
@@ -275,7 +344,7 @@ with tab2:
     
     with direction_col1:
         base_point_search = st.text_input('基準点を検索:', key="base_point_search")
-        base_point_df = display_df[display_df['住所（スプレッドシート用）'].str.contains(base_point_search, na=False)] if base_point_search else pd.DataFrame()
+        base_point_df = search_display(base_point_search) if base_point_search else pd.DataFrame()
         
         if not base_point_df.empty:
             base_point_options = base_point_df['住所（スプレッドシート用）'].tolist()
@@ -307,98 +376,103 @@ with tab2:
         with vertical_col2:
             if st.checkbox("南側", key="south_direction"):
                 selected_directions.append("南側")
+        
+        # 方位角の範囲（扇形）と基準点からの距離で絞り込む
+        direction_sector = None
+        direction_ring = None
+        with st.expander("扇形・距離で絞り込む"):
+            if st.checkbox("方位角の範囲を指定", key="use_sector"):
+                sector_col1, sector_col2 = st.columns(2)
+                with sector_col1:
+                    sector_start = st.number_input('開始（度）', 0, 360, 0, step=15, key="sector_start")
+                with sector_col2:
+                    sector_end = st.number_input('終了（度）', 0, 360, 90, step=15, key="sector_end")
+                st.caption('北を0°として時計回り（東90°・南180°・西270°）。開始＞終了なら北をまたぐ範囲')
+                direction_sector = (sector_start, sector_end)
+            if st.checkbox("基準点からの距離を指定", key="use_ring"):
+                direction_ring = st.slider('距離（km）', 0.0, 20.0, (0.0, 3.0), step=0.5, key="ring_km")
+        
+        direction_labels = list(selected_directions)
+        if direction_sector is not None:
+            direction_labels.append(f"{direction_sector[0]}°〜{direction_sector[1]}°")
+        if direction_ring is not None:
+            direction_labels.append(f"{direction_ring[0]:g}〜{direction_ring[1]:g}km")
     
     # 都市の選択状態と対応する一括選択ボタン
+    selection = st.session_state.town_selection
     if selected_city != "すべての市":
-        st.write(f"{selected_city}の町名を一括操作:")
+        st.write(f"{selected_area}の町名を一括操作:")
         city_select_col1, city_select_col2 = st.columns(2)
         with city_select_col1:
-            if st.button(f'{selected_city}の全町名を選択', key="select_city_all"):
-                # 該当する市の全町名をセッション状態に保存
-                city_towns = display_df[display_df['住所（スプレッドシート用）'].str.contains(selected_city, na=False)]['住所（スプレッドシート用）'].unique().tolist()
-                if 'selected_towns' not in st.session_state:
-                    st.session_state.selected_towns = []
-                st.session_state.selected_towns = list(set(st.session_state.selected_towns + city_towns))
-                st.session_state.selection_changed = True
-                st.success(f"{len(city_towns)}件の{selected_city}の町名を選択しました")
+            if st.button(f'{selected_area}の全町名を選択', key="select_city_all"):
+                # 該当する市の全町名を選択に加える
+                city_towns = display_rows()['住所（スプレッドシート用）'].unique()
+                selection.select(city_towns)
+                st.success(f"{len(city_towns)}件の{selected_area}の町名を選択しました")
         
         with city_select_col2:
-            if st.button(f'{selected_city}の全町名を解除', key="deselect_city_all"):
-                # 該当する市の全町名をセッション状態から削除
-                if 'selected_towns' in st.session_state:
-                    city_towns = display_df[display_df['住所（スプレッドシート用）'].str.contains(selected_city, na=False)]['住所（スプレッドシート用）'].unique().tolist()
-                    st.session_state.selected_towns = [town for town in st.session_state.selected_towns if town not in city_towns]
-                    st.session_state.selection_changed = True
-                    st.success(f"{selected_city}の町名の選択を解除しました")
-    
-    # 町名リストの作成（検索フィルターを適用）
-    filtered_towns_df = display_df.copy()
-    
-    # 検索フィルターを適用
-    if search_filter:
-        filtered_towns_df = filtered_towns_df[filtered_towns_df['住所（スプレッドシート用）'].str.contains(search_filter, na=False)]
+            if st.button(f'{selected_area}の全町名を解除', key="deselect_city_all"):
+                # 該当する市の全町名を選択から外す
+                selection.deselect(display_rows()['住所（スプレッドシート用）'].unique())
+                st.success(f"{selected_area}の町名の選択を解除しました")
     
-    # 方向フィルターを適用（基準点が選択されていて、方向も選択されている場合）
-    if base_point and selected_directions:
+    # 方向フィルターは基準点が選択されていて、方向・扇形・距離のいずれかが指定されている場合に適用
+    direction_base = None
+    if base_point and direction_labels:
         # 基準点の座標を取得
-        base_point_row = display_df[display_df['住所（スプレッドシート用）'] == base_point].iloc[0]
-        base_latitude = base_point_row['Latitude']
-        base_longitude = base_point_row['Longitude']
+        base_point_row = base_point_df[base_point_df['住所（スプレッドシート用）'] == base_point].iloc[0]
+        direction_base = (base_point_row['Latitude'], base_point_row['Longitude'])
+    
+    # 町名リストの作成（検索フィルター・方向フィルターを適用）
+    def filtered_town_list():
+        # 検索フィルターを適用
+        if search_filter:
+            filtered_towns_df = search_display(search_filter)
+        else:
+            filtered_towns_df = display_rows()
         
-        # 方向に基づいてフィルタリング
-        direction_filtered_indices = []
-        for idx, row in filtered_towns_df.iterrows():
-            if pd.notna(row['Latitude']) and pd.notna(row['Longitude']):
-                # 方向の判定
-                is_north = row['Latitude'] > base_latitude
-                is_south = row['Latitude'] < base_latitude
-                is_east = row['Longitude'] > base_longitude
-                is_west = row['Longitude'] < base_longitude
-                
-                # 選択された方向のいずれかに当てはまればOK（OR条件）
-                matches_direction = False
-                for direction in selected_directions:
-                    if (direction == "北側" and is_north) or \
-                       (direction == "南側" and is_south) or \
-                       (direction == "東側" and is_east) or \
-                       (direction == "西側" and is_west):
-                        matches_direction = True
-                        break
-                
-                if matches_direction:
-                    direction_filtered_indices.append(idx)
+        # 方向フィルターを適用
+        if direction_base is not None:
+            with span('direction'):
+                filtered_towns_df = filtered_towns_df[direction_mask(
+                    filtered_towns_df, *direction_base,
+                    selected_directions, sector=direction_sector, ring=direction_ring
+                )]
         
-        # フィルタリングを適用
-        filtered_towns_df = filtered_towns_df.loc[direction_filtered_indices]
+        # 町名のリストを取得（重複排除。検索時は一致度順、それ以外は名前順）
+        if search_filter:
+            return tuple(dict.fromkeys(filtered_towns_df['住所（スプレッドシート用）']))
+        return tuple(sorted(filtered_towns_df['住所（スプレッドシート用）'].unique()))
     
-    # 町名のリストを取得（重複排除、ソート）
-    unique_towns = sorted(filtered_towns_df['住所（スプレッドシート用）'].unique())
+    # 同じ条件の町名リストは全セッションで再利用する
+    unique_towns = data.cached(
+        'town_list', filtered_town_list, search=search_filter, city=selected_city, ward=ward_filter,
+        base=direction_base,
+        directions=frozenset(selected_directions) if direction_base is not None else None,
+        sector=direction_sector if direction_base is not None else None,
+        ring=direction_ring if direction_base is not None else None,
+    )
     
-    # 「すべて選択」と「すべて解除」ボタン
+    # 「すべて選択」と「すべて解除」ボタン（全ページが対象）
     select_col1, select_col2, select_col3 = st.columns(3)
     with select_col1:
         if st.button('現在の表示をすべて選択', key="select_all"):
-            for town in unique_towns:
-                if town not in st.session_state.selected_towns:
-                    st.session_state.selected_towns.append(town)
-            st.session_state.selection_changed = True
+            selection.select(unique_towns)
             st.success(f"{len(unique_towns)}件の町名を選択しました")
     
     with select_col2:
         if st.button('現在の表示をすべて解除', key="deselect_all"):
-            st.session_state.selected_towns = [town for town in st.session_state.selected_towns if town not in unique_towns]
-            st.session_state.selection_changed = True
+            selection.deselect(unique_towns)
             st.success("表示中の町名の選択を解除しました")
     
     with select_col3:
         if st.button('選択を全解除', key="clear_all"):
-            st.session_state.selected_towns = []
-            st.session_state.selection_changed = True
+            selection.clear()
             st.success("すべての選択を解除しました")
     
     # 方向フィルターが適用されている場合の表示
-    if base_point and selected_directions:
-        direction_text = "・".join(selected_directions)
+    if base_point and direction_labels:
+        direction_text = "・".join(direction_labels)
         st.success(f"基準点「{base_point}」の {direction_text} の町名を表示しています（{len(unique_towns)}件）")
     
     # チェックボックスでの町名選択
@@ -406,82 +480,87 @@ with tab2:
     
     # 反転選択オプション - 現在表示されている町名の選択状態を一括反転
     if st.button('表示中の選択を反転', key="invert_selection"):
-        new_selections = []
-        for town in st.session_state.selected_towns:
-            if town not in unique_towns:  # 現在表示されていない選択済みの町名は保持
-                new_selections.append(town)
-        
-        for town in unique_towns:
-            if town not in st.session_state.selected_towns:  # 現在表示されていて未選択の町名を追加
-                new_selections.append(town)
-        
-        st.session_state.selected_towns = new_selections
-        st.session_state.selection_changed = True
+        selection.invert(unique_towns)
         st.success("表示中の町名の選択状態を反転しました")
     
+    # 町名リストはページに分け、表示中のページのチェックボックスだけを作る
+    num_towns = len(unique_towns)
+    page_col1, page_col2 = st.columns(2)
+    with page_col1:
+        page_size = st.selectbox('1ページの件数:', PAGE_SIZES, index=PAGE_SIZES.index(DEFAULT_PAGE_SIZE), key="town_page_size")
+    page_count = max(1, -(-num_towns // page_size))  # 切り上げ除算
+    # 絞り込みの条件が変わったら1ページ目に戻す
+    page_filter = (search_filter, selected_area, base_point, tuple(direction_labels))
+    if st.session_state.get('town_page_filter') != page_filter or st.session_state.get('town_page', 1) > page_count:
+        st.session_state.town_page_filter = page_filter
+        st.session_state.town_page = 1
+    with page_col2:
+        page = st.number_input(f'ページ（全{page_count}ページ）:', min_value=1, max_value=page_count, step=1, key="town_page")
+    page_start = (page - 1) * page_size
+    page_towns = unique_towns[page_start:page_start + page_size]
+    if num_towns > page_size:
+        st.caption(f"{page_start + 1}〜{page_start + len(page_towns)}件目を表示中（合計は全ページの選択で計算します）")
+    
     # 町名リストが多い場合にスクロール可能なコンテナに
     town_container = st.container()
     
-    # 選択状態を表示するための辞書を作成
-    selection_state = {}
-    
     # スクロール可能なコンテナにする
-    with town_container:
+    with town_container, span('town_list'):
         # 表示する町名の数に応じて列数を調整
-        num_towns = len(unique_towns)
-        if num_towns > 50:
+        if len(page_towns) > 50:
             num_cols = 3
-        elif num_towns > 20:
+        elif len(page_towns) > 20:
             num_cols = 2
         else:
             num_cols = 1
         
         # 列ごとに表示する町名の数を計算
-        towns_per_col = -(-num_towns // num_cols)  # 切り上げ除算
+        towns_per_col = -(-len(page_towns) // num_cols)  # 切り上げ除算
         
         # 列を作成
         cols = st.columns(num_cols)
         
+        # 表示するページの町の世帯数をまとめて取得
+        with span('aggregate'):
+            households_by_town = dict(zip(page_towns, data.town_households(page_towns)))
+        
         # 各列にチェックボックスを配置
         for i in range(num_cols):
-            start_idx = i * towns_per_col
-            end_idx = min(start_idx + towns_per_col, num_towns)
-            
             with cols[i]:
-                for town in unique_towns[start_idx:end_idx]:
-                    # その町の世帯数を取得
-                    town_households = filtered_towns_df[filtered_towns_df['住所（スプレッドシート用）'] == town]['世帯数'].sum()
+                for town in page_towns[i * towns_per_col:(i + 1) * towns_per_col]:
+                    # その町の世帯数を取得（町ごとの集計表から引く）
+                    town_households = households_by_town[town]
                     
-                    # チェックボックスの状態を更新
-                    is_checked = st.checkbox(
+                    # チェックボックスの状態は選択の集合から決める（一括操作の結果を既存のチェックボックスにも反映する）
+                    key = f"town_{town}"
+                    st.session_state[key] = town in selection
+                    st.checkbox(
                         f"{town} ({town_households:,}世帯)",
-                        value=town in st.session_state.selected_towns,
-                        key=f"town_{town}"
+                        key=key,
+                        on_change=toggle_town,
+                        args=(town,)
                     )
-                    
-                    # 選択状態を記録
-                    selection_state[town] = is_checked
-                    
-                    # セッション状態を更新
-                    update_selection(town, is_checked)
-    
-    # 更新された選択状態を反映
-    st.session_state.selection_changed = detect_selection_change()
     
     # 単価情報の入力欄
     unit_price_checkbox = st.number_input('ポスティング単価（円/世帯）:', min_value=0.1, value=5.0, step=0.1, key="checkbox_price")
     
     # 選択された町名の合計世帯数を計算
-    if st.session_state.selected_towns:
-        # ここで選択した町名のデータだけを取得
-        selected_towns_df = display_df[display_df['住所（スプレッドシート用）'].isin(st.session_state.selected_towns)]
-        total_households_checkbox = selected_towns_df['世帯数'].sum()
+    if selection:
+        # 選択した町名の集計（町ごとの集計表から引く。表示中の市・区に含まれる町だけを数える）
+        selected_town_names = selection.sorted()
+        with span('aggregate'):
+            selected_towns_table = data.town_table(selected_town_names)
+        if selected_city != "すべての市":
+            selected_towns_table = selected_towns_table[selected_towns_table['市'] == selected_city]
+        if ward_filter is not None:
+            selected_towns_table = selected_towns_table[selected_towns_table['区'] == ward_filter]
+        total_households_checkbox = int(selected_towns_table['世帯数'].sum())
         estimated_sales_checkbox = total_households_checkbox * unit_price_checkbox
         
         # 結果表示
         result_container = st.container()
         with result_container:
-            st.success(f'🏘️ 選択した町名（{len(st.session_state.selected_towns)}件）の合計世帯数: {total_households_checkbox:,}世帯')
+            st.success(f'🏘️ 選択した町名（{len(selection)}件）の合計世帯数: {total_households_checkbox:,}世帯')
             st.info(f'💰 算出金額: {estimated_sales_checkbox:,}円（{unit_price_checkbox}円/世帯）')
         
         # 選択した町名を地図に表示 - 常に最新の状態を反映
@@ -490,131 +569,333 @@ with tab2:
         
         if show_map:
             with map_container:
-                # 選択した町名のデータだけをフィルタリング
-                valid_coords = selected_towns_df.dropna(subset=['Latitude', 'Longitude'])
+                # 選択した町名の重心座標（町ごとに1点）
+                valid_coords = selected_towns_table.dropna(subset=['Latitude', 'Longitude'])
                 
                 if not valid_coords.empty:
-                    center_lat = valid_coords['Latitude'].mean()
-                    center_lon = valid_coords['Longitude'].mean()
+                    # 地図の土台（タイル・基準点）は選択が変わっても同じ内容にし、ブラウザ側で作り直させない
+                    # 中心は地図を最初に表示した時の選択の重心とし、表示地域・基準点が変わるまで固定する
+                    map_view = (selected_area, base_point)
+                    if st.session_state.get('selected_map_view', (None,))[0] != map_view:
+                        st.session_state.selected_map_view = (
+                            map_view, [float(valid_coords['Latitude'].mean()), float(valid_coords['Longitude'].mean())]
+                        )
                     
                     # 地図作成
-                    m_selected = folium.Map(location=[center_lat, center_lon], zoom_start=13)
-                    
-                    # 選択された町のマーカーを追加 - 選択した町名だけを表示
-                    for idx, row in valid_coords.iterrows():
-                        folium.Marker(
-                            [row['Latitude'], row['Longitude']],
-                            popup=f"{row['住所（スプレッドシート用）']}:{row['世帯数']}世帯",
-                            icon=folium.Icon(color='blue', icon='home')
-                        ).add_to(m_selected)
+                    m_selected = folium.Map(location=st.session_state.selected_map_view[1], zoom_start=13, prefer_canvas=True)
                     
                     # 基準点がある場合は特別なマーカーを追加
                     if base_point:
-                        base_point_row = display_df[display_df['住所（スプレッドシート用）'] == base_point].iloc[0]
+                        base_point_row = base_point_df[base_point_df['住所（スプレッドシート用）'] == base_point].iloc[0]
                         folium.Marker(
                             [base_point_row['Latitude'], base_point_row['Longitude']],
                             popup=f"<b>{base_point}</b> (基準点)",
                             icon=folium.Icon(color='red', icon='star')
                         ).add_to(m_selected)
                     
-                    # 地図表示 - キーを追加して更新を強制
-                    # 選択された町名のハッシュ値を組み合わせた一意のキーを生成
-                    map_key = f"map_{len(st.session_state.selected_towns)}_{sum([hash(town) for town in st.session_state.selected_towns]) % 1000000}"
-                    st_folium(m_selected, width=700, height=500, key=map_key)
+                    # 選択した町のマーカーは別のレイヤーで渡し、選択が変わった時はこのレイヤーだけを差し替える
+                    # （同じキーのまま表示するので、タイルの再読込みやズーム・表示位置のリセットが起きない）
+                    with span('st_folium'):
+                        st_folium(m_selected, width=700, height=500, key="selected_map",
+                                  feature_group_to_add=selection_layer(valid_coords, color='blue'),
+                                  returned_objects=[])
                     
-                    # スクリーンショット（ローカルのみ）
-                    if not IS_CLOUD:
-                        try:
-                            import chromedriver_autoinstaller
-                            from selenium import webdriver
-                            from selenium.webdriver.chrome.options import Options
-                            
-                            chromedriver_autoinstaller.install()
-                            map_file = os.path.abspath('temp_map_selected.html')
-                            m_selected.save(map_file)
-
-                            options = Options()
-                            options.add_argument('--headless')
-                            options.add_argument('--no-sandbox')
-                            options.add_argument('--disable-dev-shm-usage')
-                            options.add_argument('--disable-gpu')
-                            options.add_argument('--window-size=1920,1080')
-
-                            driver = webdriver.Chrome(options=options)
-                            driver.get(f'file://{map_file}')
-                            time.sleep(5)
-
-                            screenshot_file = os.path.abspath('map_selected_image.png')
-                            driver.save_screenshot(screenshot_file)
-                            driver.quit()
-
-                            with open(screenshot_file, 'rb') as f:
-                                st.download_button('🗺️ 選択地域の地図画像をダウンロード', f, 'map_selected_image.png', 'image/png')
-
-                        except Exception as e:
-                            st.error(f"地図のスクリーンショット取得に失敗しました（ローカル環境専用機能）: {e}")
-                    else:
-                        st.info("🛑 Web公開版では地図画像の自動保存機能は利用できません。")
+                    # 地図画像（ダウンロードボタンが押された時だけ描画）
+                    context_lat, context_lon = data.coordinates()
+                    star = (base_point_row['Latitude'], base_point_row['Longitude']) if base_point else None
+                    st.download_button(
+                        '🗺️ 選択地域の地図画像をダウンロード',
+                        lazy_export('png', valid_coords, lambda rows: render_map_png(
+                            rows['Latitude'], rows['Longitude'], color='blue', star=star,
+                            context_lat=context_lat, context_lon=context_lon
+                        ), star=star, dataset_size=len(data)),
+                        'map_selected_image.png',
+                        'image/png'
+                    )
                 else:
                     st.warning('選択した町名に有効な座標データがありません。')
         
-        # CSVダウンロード - 選択変更があったか定期的に確認して更新
-        csv_buffer = io.StringIO()
-        selected_towns_df.to_csv(csv_buffer, index=False)
-        csv_data = csv_buffer.getvalue().encode('utf-8')
-        
         # 方向情報を含めたファイル名
-        direction_str = f"_{'-'.join(selected_directions)}" if selected_directions else ""
+        direction_str = f"_{'-'.join(direction_labels)}" if direction_labels else ""
         file_prefix = base_point.replace("/", "／") if base_point else "選択地域"
         file_name = f"{file_prefix}{direction_str}_住所データ.csv"
-        
-        # エクスポートボタンのコンテナ
+
+        # サマリーシート・選択町名リストの内容
+        direction_info = f"{'-'.join(direction_labels)}の町名" if direction_labels else "選択された町名"
+        base_info = f"基準点: {base_point}" if base_point else "基準点なし"
+        checkbox_summary = [
+            ('選択方法', direction_info),
+            ('基準点情報', base_info),
+            ('選択町名数', f'{len(selection)}件'),
+            ('総世帯数', f'{total_households_checkbox:,}世帯'),
+            ('ポスティング単価', f'{unit_price_checkbox}円/世帯'),
+            ('算出金額', f'{estimated_sales_checkbox:,}円'),
+        ]
+
+        # 住所データの行はダウンロードボタンが押された時に取り出す
+        def selected_rows():
+            rows = display_rows()
+            return rows[rows['住所（スプレッドシート用）'].isin(selected_town_names)]
+
+        # エクスポートボタンのコンテナ（ボタンが押された時だけ作成）
         export_col1, export_col2 = st.columns(2)
         with export_col1:
             st.download_button(
                 '📥 選択地域の住所データをCSVでダウンロード',
-                csv_data,
+                lazy_export('csv', selected_rows, build_csv, towns=tuple(selected_town_names)),
                 file_name,
                 'text/csv'
             )
-        
-        # エクセルダウンロード
+
         with export_col2:
-            try:
-                buffer = io.BytesIO()
-                with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-                    selected_towns_df.to_excel(writer, index=False, sheet_name='住所データ')
-                    
-                    # 選択した町名のリスト
-                    town_list_df = pd.DataFrame({'選択した町名': st.session_state.selected_towns})
-                    town_list_df.to_excel(writer, index=False, sheet_name='選択町名リスト')
-                    
-                    # サマリーシート
-                    direction_info = f"{'-'.join(selected_directions)}の町名" if selected_directions else "選択された町名"
-                    base_info = f"基準点: {base_point}" if base_point else "基準点なし"
-                    
-                    summary_data = pd.DataFrame({
-                        '項目': ['選択方法', '基準点情報', '選択町名数', '総世帯数', 'ポスティング単価', '算出金額'],
-                        '値': [direction_info, base_info, f'{len(st.session_state.selected_towns)}件', 
-                              f'{total_households_checkbox:,}世帯', f'{unit_price_checkbox}円/世帯', 
-                              f'{estimated_sales_checkbox:,}円']
-                    })
-                    summary_data.to_excel(writer, index=False, sheet_name='サマリー')
-                
-                excel_data = buffer.getvalue()
-                excel_file_name = file_name.replace('.csv', '.xlsx')
-                
+            st.download_button(
+                '📊 選択地域の住所データをExcelでダウンロード',
+                lazy_export('xlsx', selected_rows, lambda rows: build_excel(
+                    rows, checkbox_summary,
+                    extra_sheets=[('選択町名リスト', pd.DataFrame({'選択した町名': selected_town_names}))]
+                ), summary=checkbox_summary, towns=tuple(selected_town_names)),
+                file_name.replace('.csv', '.xlsx'),
+                EXCEL_MIME
+            )
+    else:
+        # 次に選択した時は、その選択の位置に地図を表示する
+        st.session_state.pop('selected_map_view', None)
+        st.warning('町名を選択してください')
+
+# 多角形（地図上に描画、またはGeoJSONをアップロード）で範囲を指定
+with tab3:
+    st.subheader("エリア検索（多角形範囲指定）")
+    st.write("地図上で多角形・四角形を描くか、GeoJSONファイルをアップロードしてください（複数可）")
+
+    polygons = []
+    polygon_file = st.file_uploader("GeoJSONファイルをアップロード", type=['geojson', 'json'], key="polygon_file")
+    if polygon_file is not None:
+        try:
+            polygons.extend(parse_geojson(polygon_file.getvalue()))
+        except ValueError as e:
+            st.error(f'GeoJSONを読み込めませんでした: {e}')
+
+    # 描画用の地図（表示中の地域の中心）
+    area_rows = display_rows()
+    # アップロードで座標のない地域だけが追加された場合も、空の地図にならないようにする
+    draw_center = map_center_of(area_rows)
+    draw_map = folium.Map(location=draw_center, zoom_start=12, prefer_canvas=True)
+    # 表示中の地域の世帯数の分布（格子ごとの合計済みの値。全地域なら集計し直さずにそのまま使う）
+    # 地図のデータが大きくなり再実行のたびに送り直すので、選んだ時だけ、縮小した地図の粗い格子だけを載せる
+    if st.checkbox("世帯数の分布を地図に表示する", value=False, key="polygon_density"):
+        area_ids = None if selected_city == "すべての市" else area_rows.index.to_numpy()
+        add_density_layers(draw_map, data.pyramid, area_ids, interactive=False)
+    Draw(
+        export=False,
+        draw_options={'polyline': False, 'circle': False, 'marker': False, 'circlemarker': False},
+        edit_options={'edit': False},
+    ).add_to(draw_map)
+    with span('st_folium'):
+        drawn = st_folium(draw_map, width=700, height=500, key="polygon_draw_map", returned_objects=['all_drawings'])
+    for drawing in (drawn or {}).get('all_drawings') or []:
+        try:
+            polygons.extend(parse_geojson(drawing))
+        except ValueError:
+            pass
+
+    if polygons:
+        unit_price_polygon = st.number_input('ポスティング単価（円/世帯）:', min_value=0.1, value=5.0, step=0.1, key="polygon_price")
+
+        # 多角形内の行を一括で判定（外接矩形で候補を絞ってから内外判定。同じ多角形の結果は全セッションで再利用）
+        with span('polygon'):
+            polygon_ids = data.cached('polygon', lambda: data.query_polygons(polygons), polygons=polygons_key(polygons))
+            polygon_df = data.take(polygon_ids)
+        total_households_polygon = polygon_df['世帯数'].sum()
+        estimated_sales_polygon = total_households_polygon * unit_price_polygon
+
+        col1, col2 = st.columns(2)
+        with col1:
+            st.success(f'🏘️ 多角形（{len(polygons)}個）内の合計世帯数: {total_households_polygon:,}世帯（{len(polygon_df)}件）')
+        with col2:
+            st.info(f'💰 算出金額: {estimated_sales_polygon:,}円（{unit_price_polygon}円/世帯）')
+
+        # 市区ごとの内訳
+        area_summary = (polygon_df.groupby(['city', 'ward'], observed=True)['世帯数']
+                        .agg(['count', 'sum']).reset_index())
+        area_summary.columns = ['市', '区', '町名数', '世帯数']
+        st.dataframe(area_summary, hide_index=True)
+
+        # 多角形ごとの内訳（行を取り出さずに格子ごとの合計から求める。重なった部分はそれぞれに数える）
+        if len(polygons) > 1:
+            with span('polygon_totals'):
+                polygon_totals = [data.polygon_total([rings]) for rings in polygons]
+            st.dataframe(pd.DataFrame({
+                '多角形': [f'多角形{i + 1}' for i in range(len(polygons))],
+                '町名数': [rows for _, rows in polygon_totals],
+                '世帯数': [households for households, _ in polygon_totals],
+            }), hide_index=True)
+
+        if not polygon_df.empty:
+            result_map = folium.Map(location=draw_center, zoom_start=12, prefer_canvas=True)
+            folium.GeoJson(
+                polygons_geojson(polygons),
+                style_function=lambda _: {'color': 'blue', 'weight': 2, 'fillOpacity': 0.1},
+            ).add_to(result_map)
+            add_town_markers(result_map, polygon_df, color='green', pyramid=data.pyramid, ids=polygon_ids)
+            result_map.fit_bounds([[polygon_df['Latitude'].min(), polygon_df['Longitude'].min()],
+                                   [polygon_df['Latitude'].max(), polygon_df['Longitude'].max()]])
+            with span('st_folium'):
+                st_folium(result_map, width=700, height=500, key=f"polygon_result_map_{polygons_key(polygons)}",
+                          returned_objects=[])
+
+            # --- ダウンロード（ボタンが押された時だけ作成し、同じ内容は再利用） ---
+            polygon_params = dict(polygons=polygons_key(polygons), unit_price=unit_price_polygon)
+
+            context_lat, context_lon = data.coordinates()
+            st.download_button(
+                '🗺️ 地図画像をダウンロード',
+                lazy_export('png', polygon_df, lambda rows: render_map_png(
+                    rows['Latitude'], rows['Longitude'], color='green', polygons=polygons,
+                    context_lat=context_lat, context_lon=context_lon
+                ), dataset_size=len(data), **polygon_params),
+                'map_polygon_image.png',
+                'image/png'
+            )
+
+            export_col1, export_col2 = st.columns(2)
+            with export_col1:
                 st.download_button(
-                    '📊 選択地域の住所データをExcelでダウンロード',
-                    excel_data,
-                    excel_file_name,
-                    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+                    '📥 範囲内住所データをCSVでダウンロード',
+                    lazy_export('csv', polygon_df, build_csv),
+                    "多角形範囲内住所データ.csv",
+                    'text/csv'
+                )
+
+            with export_col2:
+                polygon_summary = [
+                    ('選択方法', f'多角形範囲（{len(polygons)}個）'),
+                    ('町名数', f'{len(polygon_df)}件'),
+                    ('総世帯数', f'{total_households_polygon:,}世帯'),
+                    ('ポスティング単価', f'{unit_price_polygon}円/世帯'),
+                    ('算出金額', f'{estimated_sales_polygon:,}円'),
+                ]
+                st.download_button(
+                    '📊 範囲内住所データをExcelでダウンロード',
+                    lazy_export('xlsx', polygon_df, lambda rows: build_excel(
+                        rows, polygon_summary, extra_sheets=[('市区別集計', area_summary)]
+                    ), **polygon_params),
+                    "多角形範囲内住所データ.xlsx",
+                    EXCEL_MIME
                 )
-            except Exception as e:
-                st.error(f"Excelファイル作成に失敗しました: {e}")
     else:
-        st.warning('町名を選択してください')
+        st.warning('地図上に範囲を描くか、GeoJSONファイルをアップロードしてください')
+
+# 複数の中心点（CSV）の円形範囲をまとめて見積もる
+with tab4:
+    st.subheader("複数地点一括見積（円形範囲）")
+    st.write("中心点リスト（名前・町名または緯度経度・半径）のCSVをアップロードしてください")
+    st.download_button(
+        '📄 中心点リストのひな形をダウンロード',
+        TEMPLATE.to_csv(index=False).encode('utf-8-sig'),
+        '中心点リスト.csv',
+        'text/csv'
+    )
+
+    centers_file = st.file_uploader("中心点リスト（CSV）", type=['csv'], key="centers_file")
+    batch_col1, batch_col2 = st.columns(2)
+    with batch_col1:
+        default_radius_km = st.number_input('半径の既定値（km）', min_value=0.5, max_value=10.0, step=0.5, value=3.0, key="batch_radius")
+    with batch_col2:
+        unit_price_batch = st.number_input('ポスティング単価（円/世帯）:', min_value=0.1, value=5.0, step=0.1, key="batch_price")
+
+    centers = None
+    if centers_file is not None:
+        try:
+            centers = resolve_centers(read_centers(centers_file.getvalue()), data, default_radius_km)
+        except (ValueError, pd.errors.ParserError) as e:
+            st.error(f'中心点リストを読み込めませんでした: {e}')
+
+    if centers is not None and not centers.empty:
+        # 全地点の距離をまとめて計算（地点ごとの合計と、重複を除いた全体の合計）
+        with span('batch'):
+            batch_summary, batch_hits, batch_union = quote_centers(data, centers, unit_price_batch)
+        union_df = data.take(batch_union)
+        union_households = union_df['世帯数'].sum()
+        overlap_households = batch_summary['世帯数'].sum() - union_households
+
+        col1, col2 = st.columns(2)
+        with col1:
+            st.success(f'🏘️ {len(centers)}地点の合計世帯数（重複除く）: {union_households:,}世帯（{len(union_df)}件）')
+        with col2:
+            st.info(f'💰 算出金額（重複除く）: {union_households * unit_price_batch:,}円（{unit_price_batch}円/世帯）')
+        if overlap_households:
+            st.caption(f'地点ごとの合計 {batch_summary["世帯数"].sum():,}世帯のうち、{overlap_households:,}世帯は複数の円に重複しています')
+        if (centers['状態'] != '').any():
+            st.warning(f"{(centers['状態'] != '').sum()}地点は見積もりできませんでした（状態の列を確認してください）")
+        st.dataframe(batch_summary, hide_index=True)
+
+        valid_centers = centers[centers['状態'] == '']
+        if not valid_centers.empty:
+            batch_map = folium.Map(location=[valid_centers['Latitude'].mean(), valid_centers['Longitude'].mean()],
+                                   zoom_start=11, prefer_canvas=True)
+            for row in valid_centers.itertuples(index=False):
+                folium.Circle(location=[row.Latitude, row.Longitude], radius=row.半径 * 1000,
+                              color='blue', fill=True, fill_opacity=0.1).add_to(batch_map)
+                folium.Marker([row.Latitude, row.Longitude], popup=f"<b>{row.名前}</b>",
+                              icon=folium.Icon(color='red', icon='star')).add_to(batch_map)
+            add_town_markers(batch_map, union_df, color='green', pyramid=data.pyramid, ids=batch_union)
+            batch_map.fit_bounds([[valid_centers['Latitude'].min(), valid_centers['Longitude'].min()],
+                                  [valid_centers['Latitude'].max(), valid_centers['Longitude'].max()]])
+            with span('st_folium'):
+                st_folium(batch_map, width=700, height=500, key="batch_map", returned_objects=[])
+
+        # 1つのExcelにまとめる（重複を除いた住所データ・地点別集計・地点ごとの住所データ）
+        batch_summary_items = [
+            ('選択方法', f'複数地点の円形範囲（{len(centers)}地点）'),
+            ('総世帯数（重複除く）', f'{union_households:,}世帯'),
+            ('重複世帯数', f'{overlap_households:,}世帯'),
+            ('ポスティング単価', f'{unit_price_batch}円/世帯'),
+            ('算出金額', f'{union_households * unit_price_batch:,}円'),
+        ]
+
+        def batch_workbook(rows):
+            center_sheets = [
+                (sheet_name(i, name), export_frame(data.take(ids)))
+                for i, (name, ids) in enumerate(zip(centers['名前'], batch_hits))
+            ]
+            return build_excel(rows, batch_summary_items,
+                               extra_sheets=[('地点別集計', batch_summary)] + center_sheets)
+
+        export_col1, export_col2 = st.columns(2)
+        with export_col1:
+            st.download_button(
+                '📥 範囲内住所データ（重複除く）をCSVでダウンロード',
+                lazy_export('csv', union_df, build_csv),
+                "複数地点_範囲内住所データ.csv",
+                'text/csv'
+            )
+        with export_col2:
+            st.download_button(
+                '📊 見積もりをExcelでダウンロード',
+                lazy_export('xlsx', union_df, batch_workbook,
+                            centers=centers.to_json(), unit_price=unit_price_batch),
+                "複数地点_見積もり.xlsx",
+                EXCEL_MIME
+            )
+    elif centers is not None:
+        st.warning('中心点リストが空です')
 
 # フッター情報
 st.markdown("---")
-st.markdown("**ポスティングエリア世帯数計算ツール** - 加古川市・姫路市・神戸市・西宮市・高砂市・明石市対応")
\ No newline at end of file
+st.markdown("**ポスティングエリア世帯数計算ツール** - 加古川市・姫路市・神戸市・西宮市・高砂市・明石市対応")
+
+# --- 処理時間（URLに ?debug=1 を付けるとサイドバーに表示） ---
+if st.query_params.get('debug') == '1':
+    with st.sidebar.expander("処理時間（デバッグ）", expanded=True):
+        st.caption(f"この再実行: {perf.elapsed_ms():,.0f}ms（セッション {perf.session_id}・{perf.reruns}回目）")
+        st.dataframe(perf.spans_frame(), hide_index=True)
+        if perf.counters:
+            st.dataframe(pd.DataFrame(list(perf.counters.items()), columns=['項目', '件数']), hide_index=True)
+        st.write("このセッションの区間ごとの時間")
+        st.dataframe(perf.percentiles_frame(), hide_index=True)
+        cache_stats = query_cache.stats()
+        st.caption(f"検索結果のキャッシュ（全セッション共通）: {cache_stats['entries']}件・"
+                   f"{cache_stats['bytes'] / 1024 ** 2:.1f}MB・ヒット率 {cache_stats['hit_rate']:.0%}"
+                   f"（ヒット {cache_stats['hits']:,} / ミス {cache_stats['misses']:,}）")
+
+perf.finish_rerun()
@@ -0,0 +1,357 @@
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import folium
+import pandas as pd
+
+from batch_quote import quote_centers, read_centers, resolve_centers, sheet_name
+from dataset import SessionDataset, SharedDataset, export_frame, load_dataset
+from exports import build_csv, build_excel
+from geo_search import HALF_PLANES, direction_mask
+from geocoding import GeocodeCache, GeocodingStage, make_geocoder
+from ingest import iter_upload_chunks
+from map_layers import add_town_markers
+from polygons import parse_geojson, polygons_geojson
+from radius_solver import RadiusSolver
+from static_map import render_map_png
+
+# 出力できるファイルの種類
+OUTPUT_KINDS = ['csv', 'xlsx', 'html', 'png']
+
+# ジョブの種類
+JOB_TYPES = ['radius', 'direction', 'towns', 'polygon', 'area', 'centers']
+
+# ファイル名に使えない文字
+FILE_NAME_INVALID = re.compile(r'[\\/:*?"<>|\s]+')
+
+# ワーカープロセスごとのデータ（initializer で一度だけ読み込む）
+_data = None
+
+USAGE_EXAMPLE = '''ジョブファイル（JSON）の例:
+{
+  "defaults": {"unit_price": 5.0, "outputs": ["csv", "xlsx", "html", "png"]},
+  "uploads": ["追加データ.csv"],
+  "jobs": [
+    {"name": "寺家町3km", "type": "radius", "center": "加古川町寺家町", "radius_km": 3},
+    {"name": "寺家町2万世帯", "type": "radius", "center": "加古川町寺家町", "target_households": 20000},
+    {"name": "魚崎北側", "type": "direction", "base": "東灘区魚崎北町１丁目",
+     "directions": ["北側"], "sector": [300, 60], "ring": [0, 3], "city": "神戸市"},
+    {"name": "選択町名", "type": "towns", "towns": ["兵庫県加古川市加古川町寺家町"]},
+    {"name": "川沿い", "type": "polygon", "geojson": "area.geojson"},
+    {"name": "加古川市全域", "type": "area", "city": "加古川市"},
+    {"name": "店舗一括", "type": "centers", "centers": "stores.csv", "radius_km": 3}
+  ]
+}
+相対パスはジョブファイルのあるフォルダからの位置'''
+
+
+def load_jobs(path):
+    """ジョブファイルを読み込み、既定値を合わせたジョブのリストとアップロードするファイルを返す"""
+    with open(path, encoding='utf-8') as f:
+        spec = json.load(f)
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+    base_dir = os.path.dirname(os.path.abspath(path))
+    defaults = spec.get('defaults', {})
+
+    jobs = []
+    for i, job in enumerate(spec.get('jobs', [])):
+        job = {**defaults, **job}
+        job.setdefault('name', f"job{i + 1}")
+        job.setdefault('unit_price', 5.0)
+        job['base_dir'] = base_dir
+        if job.get('type') not in JOB_TYPES:
+            raise ValueError(f"{job['name']}: type は {'/'.join(JOB_TYPES)} のいずれかです")
+        jobs.append(job)
+    uploads = [os.path.join(base_dir, upload) for upload in spec.get('uploads', [])]
+    return jobs, uploads
+
+
+def _load_shared():
+    df, errors = load_dataset()
+    for error in errors:
+        print(f"警告: {error}", file=sys.stderr)
+    return SharedDataset(df)
+
+
+def _geocode_uploads(shared, uploads, geocoder=None):
+    """アップロードするファイルの座標のない住所を探す段階（キャッシュ・地名辞典・geocoder の順）"""
+    return GeocodingStage(shared.gazetteer, GeocodeCache(), geocoder) if uploads else None
+
+
+def _init_worker(uploads, geocoder=None):
+    """ワーカープロセスでデータを読み込む（コンパイル済みデータがあれば一瞬で終わる）
+
+    座標のない住所は地名辞典と住所→座標のキャッシュで埋める（geocoder を渡せば外部にも問い合わせる）
+    """
+    global _data
+    _data = SessionDataset(_load_shared())
+    stage = _geocode_uploads(_data.shared, uploads, geocoder)
+    for upload in uploads:
+        with open(upload, 'rb') as f:
+            _data.append_chunks(stage.iter_chunks(chunk for chunk, _ in iter_upload_chunks(f)))
+
+
+def prefetch_geocodes(uploads, geocoder):
+    """アップロードするファイルの座標のない住所を先に外部に問い合わせてキャッシュに入れる
+
+    ワーカーごとに問い合わせると利用規約の間隔を守れないので、並列に実行する前にこのプロセスで一度だけ行う
+    """
+    stage = _geocode_uploads(_load_shared(), uploads, geocoder)
+    for upload in uploads:
+        with open(upload, 'rb') as f:
+            for _ in stage.iter_chunks(chunk for chunk, _ in iter_upload_chunks(f)):
+                pass
+    return stage.stats
+
+
+def _path(job, value):
+    return value if os.path.isabs(value) else os.path.join(job['base_dir'], value)
+
+
+def _find_town(data, query):
+    """町名を検索して最も一致度の高い行を返す"""
+    matched = data.take(data.search(query)[:1]).dropna(subset=['Latitude', 'Longitude'])
+    if matched.empty:
+        raise ValueError(f"町名が見つかりません: {query}")
+    return matched.iloc[0]
+
+
+def _area(data, job):
+    """ジョブで指定された市（と区）の行。指定がなければ全行"""
+    if job.get('city'):
+        return data.area_rows(job['city'], job.get('ward'))
+    return data.filter()
+
+
+def _run_query(data, job):
+    """ジョブの条件で行を取り出す
+
+    戻り値: (行, サマリーの追加項目, 地図に描く図形, 追加シート)
+    """
+    shapes = {}
+    details = []
+    extra_sheets = []
+    kind = job['type']
+
+    if kind == 'radius':
+        center = _find_town(data, job['center'])
+        shapes['star'] = (center['Latitude'], center['Longitude'])
+        if 'target_households' in job or 'budget' in job:
+            lat, lon = data.coordinates()
+            solver = RadiusSolver(lat, lon, data.households(), center['Latitude'], center['Longitude'])
+            if 'target_households' in job:
+                count, radius_km = solver.for_households(job['target_households'])
+                details.append(('目標世帯数', f"{job['target_households']:,}世帯"))
+            else:
+                count, radius_km = solver.for_budget(job['budget'], job['unit_price'])
+                details.append(('予算', f"{job['budget']:,}円"))
+            rows = data.take(solver.ids(count))
+        else:
+            radius_km = job['radius_km']
+            rows = data.take(data.query_radius(center['Latitude'], center['Longitude'], radius_km))
+        radius_km = round(radius_km, 3)
+        shapes['circle'] = (center['Latitude'], center['Longitude'], radius_km)
+        details += [('検索町名', center['住所（スプレッドシート用）']), ('半径', f'{radius_km}km')]
+
+    elif kind == 'direction':
+        base = _find_town(data, job['base'])
+        shapes['star'] = (base['Latitude'], base['Longitude'])
+        directions = job.get('directions', [])
+        unknown = set(directions) - set(HALF_PLANES)
+        if unknown:
+            raise ValueError(f"方向は {'・'.join(HALF_PLANES)} から選んでください: {'・'.join(unknown)}")
+        sector = tuple(job['sector']) if job.get('sector') else None
+        ring = tuple(job['ring']) if job.get('ring') else None
+        rows = _area(data, job)
+        rows = rows[direction_mask(rows, base['Latitude'], base['Longitude'], directions, sector=sector, ring=ring)]
+        labels = list(directions)
+        if sector:
+            labels.append(f"{sector[0]}°〜{sector[1]}°")
+        if ring:
+            labels.append(f"{ring[0]:g}〜{ring[1]:g}km")
+        details += [('基準点情報', f"基準点: {base['住所（スプレッドシート用）']}"),
+                    ('選択方法', f"{'-'.join(labels)}の町名" if labels else '全方向')]
+
+    elif kind == 'towns':
+        towns = job['towns']
+        rows = _area(data, job)
+        rows = rows[rows['住所（スプレッドシート用）'].isin(towns)]
+        missing = sorted(set(towns) - set(rows['住所（スプレッドシート用）']))
+        if missing:
+            print(f"警告: {job['name']}: 見つからない町名 {len(missing)}件（{missing[0]} など）", file=sys.stderr)
+        details.append(('選択町名数', f'{len(towns)}件'))
+        extra_sheets.append(('選択町名リスト', pd.DataFrame({'選択した町名': towns})))
+
+    elif kind == 'polygon':
+        with open(_path(job, job['geojson']), 'rb') as f:
+            polygons = parse_geojson(f.read())
+        shapes['polygons'] = polygons
+        rows = data.take(data.query_polygons(polygons))
+        details.append(('選択方法', f'多角形範囲（{len(polygons)}個）'))
+
+    elif kind == 'area':
+        rows = _area(data, job)
+        area = ' '.join(filter(None, [job.get('city'), job.get('ward')])) or '全地域'
+        details.append(('地域', area))
+
+    else:
+        with open(_path(job, job['centers']), 'rb') as f:
+            centers = resolve_centers(read_centers(f.read()), data, job.get('radius_km', 3.0))
+        summary, hits, union = quote_centers(data, centers, job['unit_price'])
+        rows = data.take(union)
+        valid = centers[centers['状態'] == '']
+        shapes['circles'] = list(zip(valid['Latitude'], valid['Longitude'], valid['半径']))
+        details += [('選択方法', f'複数地点の円形範囲（{len(centers)}地点）'),
+                    ('重複世帯数', f"{summary['世帯数'].sum() - rows['世帯数'].sum():,}世帯")]
+        extra_sheets.append(('地点別集計', summary))
+        extra_sheets += [(sheet_name(i, name), export_frame(data.take(ids)))
+                         for i, (name, ids) in enumerate(zip(centers['名前'], hits))]
+
+    return rows, details, shapes, extra_sheets
+
+
+def _html_map(rows, shapes):
+    """結果の地図（アプリと同じマーカー・図形）"""
+    located = rows.dropna(subset=['Latitude', 'Longitude'])
+    if located.empty and 'star' not in shapes:
+        return None
+    center = shapes.get('star') or (located['Latitude'].mean(), located['Longitude'].mean())
+    m = folium.Map(location=list(center), zoom_start=13, prefer_canvas=True)
+    circles = shapes.get('circles', []) + ([shapes['circle']] if 'circle' in shapes else [])
+    for lat, lon, radius_km in circles:
+        folium.Circle(location=[lat, lon], radius=radius_km * 1000, color='blue', fill=True, fill_opacity=0.1).add_to(m)
+    if 'polygons' in shapes:
+        folium.GeoJson(polygons_geojson(shapes['polygons']),
+                       style_function=lambda _: {'color': 'blue', 'weight': 2, 'fillOpacity': 0.1}).add_to(m)
+    if 'star' in shapes:
+        folium.Marker(list(shapes['star']), icon=folium.Icon(color='red', icon='star')).add_to(m)
+    add_town_markers(m, located, color='blue')
+    if not located.empty:
+        m.fit_bounds([[located['Latitude'].min(), located['Longitude'].min()],
+                      [located['Latitude'].max(), located['Longitude'].max()]])
+    return m
+
+
+def run_job(data, job, out_dir):
+    """1件のジョブを実行して出力ファイルを書き、集計結果を返す"""
+    start = time.perf_counter()
+    rows, details, shapes, extra_sheets = _run_query(data, job)
+    unit_price = job['unit_price']
+    total = int(rows['世帯数'].sum())
+    estimated = total * unit_price
+    summary_items = details + [
+        ('町名数', f'{len(rows)}件'),
+        ('総世帯数', f'{total:,}世帯'),
+        ('ポスティング単価', f'{unit_price}円/世帯'),
+        ('算出金額', f'{estimated:,}円'),
+    ]
+
+    stem = os.path.join(out_dir, FILE_NAME_INVALID.sub('_', job['name']))
+    outputs = []
+    for kind in job.get('outputs', OUTPUT_KINDS):
+        path = f"{stem}.{kind}"
+        if kind == 'csv':
+            with open(path, 'wb') as f:
+                f.write(build_csv(rows))
+        elif kind == 'xlsx':
+            with open(path, 'wb') as f:
+                f.write(build_excel(rows, summary_items, extra_sheets=extra_sheets))
+        elif kind == 'html':
+            m = _html_map(rows, shapes)
+            if m is None:
+                continue
+            m.save(path)
+        elif kind == 'png':
+            located = rows.dropna(subset=['Latitude', 'Longitude'])
+            if located.empty and 'star' not in shapes:
+                continue
+            circle = shapes.get('circle')
+            context_lat, context_lon = data.coordinates()
+            with open(path, 'wb') as f:
+                f.write(render_map_png(
+                    located['Latitude'], located['Longitude'], color='blue',
+                    center=circle[:2] if circle else None, radius_km=circle[2] if circle else None,
+                    star=shapes.get('star'), polygons=shapes.get('polygons'),
+                    context_lat=context_lat, context_lon=context_lon
+                ))
+        else:
+            raise ValueError(f"出力の種類は {'/'.join(OUTPUT_KINDS)} のいずれかです: {kind}")
+        outputs.append(path)
+
+    return {
+        'ジョブ': job['name'],
+        '種類': job['type'],
+        '町名数': len(rows),
+        '世帯数': total,
+        '算出金額': estimated,
+        '処理時間(秒)': round(time.perf_counter() - start, 3),
+        '出力': ' '.join(os.path.basename(path) for path in outputs),
+        'エラー': '',
+    }
+
+
+def _run_in_worker(job, out_dir):
+    try:
+        return run_job(_data, job, out_dir)
+    except Exception as e:
+        return {'ジョブ': job['name'], '種類': job['type'], 'エラー': f"{type(e).__name__}: {e}"}
+
+
+def run_jobs(jobs, out_dir, uploads=(), workers=None, geocoder=None):
+    """ジョブを並列に実行し、ジョブごとの結果の表を返す（workers=1 ならこのプロセスで順に実行）
+
+    geocoder を渡すと、アップロードするファイルの座標のない住所を外部にも問い合わせる
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+    if workers == 1:
+        _init_worker(list(uploads), geocoder)
+        results = [_run_in_worker(job, out_dir) for job in jobs]
+    else:
+        # コンパイル済みデータが古い場合は、ワーカーが同時に作り直さないようにこのプロセスで一度だけ作り直す
+        load_dataset()
+        if geocoder is not None and uploads:
+            prefetch_geocodes(list(uploads), geocoder)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(list(uploads),)) as pool:
+            results = list(pool.map(_run_in_worker, jobs, [out_dir] * len(jobs)))
+    results = pd.DataFrame(results, columns=['ジョブ', '種類', '町名数', '世帯数', '算出金額', '処理時間(秒)', '出力', 'エラー'])
+    return results.astype({'町名数': 'Int64', '世帯数': 'Int64'}).fillna({'出力': '', 'エラー': ''})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='ジョブファイルに書いた条件で、世帯数の集計と住所データ・地図を一括作成する',
+        epilog=USAGE_EXAMPLE,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('job_file', help='ジョブファイル（JSON）')
+    parser.add_argument('-o', '--out-dir', default='batch_output', help='出力先フォルダ（既定: batch_output）')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='並列に実行するプロセス数（既定: CPUコア数）')
+    parser.add_argument('--geocoder', default='none',
+                        help='座標のない住所の問い合わせ先（none / nominatim / table:住所と座標のCSV、既定: none）')
+    args = parser.parse_args(argv)
+
+    jobs, uploads = load_jobs(args.job_file)
+    try:
+        geocoder = make_geocoder(args.geocoder)
+    except (OSError, ValueError) as e:
+        parser.error(f'ジオコーダーを準備できませんでした: {e}')
+    start = time.perf_counter()
+    results = run_jobs(jobs, args.out_dir, uploads, args.workers, geocoder)
+    results.to_csv(os.path.join(args.out_dir, 'summary.csv'), index=False, encoding='utf-8-sig')
+
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(results.drop(columns=['出力']).to_string(index=False))
+    failed = int((results['エラー'] != '').sum())
+    print(f"{len(jobs)}件のジョブ（失敗 {failed}件） {time.perf_counter() - start:.1f}秒 → {args.out_dir}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
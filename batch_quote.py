@@ -0,0 +1,132 @@
+import io
+import re
+
+import numpy as np
+import pandas as pd
+
+from ingest import sniff_encoding
+
+# 中心点リスト（CSV）の列名として受け付ける名前
+NAME_COLUMNS = ['名前', '店舗名', '名称']
+TOWN_COLUMNS = ['町名', '住所', '住所（スプレッドシート用）']
+LAT_COLUMNS = ['Latitude', '緯度', 'lat']
+LON_COLUMNS = ['Longitude', '経度', 'lon', 'lng']
+RADIUS_COLUMNS = ['半径', '半径（km）', '半径(km)', 'radius_km']
+
+# 中心点リストのひな形
+TEMPLATE = pd.DataFrame({
+    '名前': ['加古川店', '明石店'],
+    '町名': ['加古川町寺家町', ''],
+    'Latitude': [None, 34.6491],
+    'Longitude': [None, 134.9928],
+    '半径': [3.0, 2.0],
+})
+
+# Excelのシート名に使えない文字
+SHEET_NAME_INVALID = re.compile(r'[\[\]:*?/\\]')
+
+
+def _find_column(df, names):
+    for name in names:
+        if name in df.columns:
+            return name
+    return None
+
+
+def read_centers(data):
+    """中心点リストのCSV（バイト列）を読み込む（文字コードはアップロードされた住所データと同じ方法で判定）"""
+    encoding = sniff_encoding(io.BytesIO(data))
+    try:
+        text = data.decode(encoding)
+    except (UnicodeDecodeError, LookupError):
+        # 先頭だけでは判定しきれなかった場合は、Windows の Excel で保存した CSV とみなす
+        text = data.decode('cp932', errors='replace')
+    return pd.read_csv(io.StringIO(text))
+
+
+def resolve_centers(centers, dataset, default_radius_km):
+    """中心点リストの各行の座標と半径を決める
+
+    座標の列があればそれを使い、なければ町名を検索して最も一致度の高い町の座標を使う。
+    半径の列がない・空の行は default_radius_km。
+    戻り値の列: 名前, 中心, Latitude, Longitude, 半径, 状態（空文字なら正常）
+    """
+    name_column = _find_column(centers, NAME_COLUMNS)
+    town_column = _find_column(centers, TOWN_COLUMNS)
+    lat_column = _find_column(centers, LAT_COLUMNS)
+    lon_column = _find_column(centers, LON_COLUMNS)
+    radius_column = _find_column(centers, RADIUS_COLUMNS)
+    if town_column is None and (lat_column is None or lon_column is None):
+        raise ValueError(f"中心点リストには町名の列（{'・'.join(TOWN_COLUMNS)}）か緯度・経度の列が必要です")
+
+    n = len(centers)
+    towns = centers[town_column].fillna('').astype(str).str.strip() if town_column else pd.Series([''] * n)
+    lat = pd.to_numeric(centers[lat_column], errors='coerce') if lat_column else pd.Series(np.nan, index=centers.index)
+    lon = pd.to_numeric(centers[lon_column], errors='coerce') if lon_column else pd.Series(np.nan, index=centers.index)
+    radius = pd.to_numeric(centers[radius_column], errors='coerce') if radius_column else pd.Series(np.nan, index=centers.index)
+
+    rows = []
+    for i in range(n):
+        town = towns.iloc[i]
+        row_lat, row_lon = lat.iloc[i], lon.iloc[i]
+        label = town
+        status = ''
+        if pd.isna(row_lat) or pd.isna(row_lon):
+            matched = dataset.take(dataset.search(town)[:1]) if town else None
+            if matched is None or matched.empty or pd.isna(matched['Latitude'].iloc[0]):
+                status = '町名が見つかりません' if town else '座標も町名もありません'
+            else:
+                label = matched['住所（スプレッドシート用）'].iloc[0]
+                row_lat, row_lon = matched['Latitude'].iloc[0], matched['Longitude'].iloc[0]
+        elif not label:
+            label = f"{row_lat:.5f}, {row_lon:.5f}"
+
+        row_radius = radius.iloc[i]
+        if pd.isna(row_radius):
+            row_radius = default_radius_km
+        elif row_radius <= 0:
+            status = status or '半径が0以下です'
+
+        name = centers[name_column].iloc[i] if name_column else None
+        rows.append({
+            '名前': str(name) if pd.notna(name) and str(name) else f"地点{i + 1}",
+            '中心': label,
+            'Latitude': row_lat,
+            'Longitude': row_lon,
+            '半径': float(row_radius),
+            '状態': status,
+        })
+    return pd.DataFrame(rows, columns=['名前', '中心', 'Latitude', 'Longitude', '半径', '状態'])
+
+
+def quote_centers(dataset, centers, unit_price):
+    """各円の世帯数・金額と、重複を除いた全体の合計を計算する
+
+    戻り値: (円ごとの集計表, 各円の行IDのリスト, 重複を除いた行IDの配列)
+    """
+    valid = (centers['状態'] == '').to_numpy()
+    lat = centers['Latitude'].to_numpy(dtype=np.float64)[valid]
+    lon = centers['Longitude'].to_numpy(dtype=np.float64)[valid]
+    radii_km = centers['半径'].to_numpy(dtype=np.float64)[valid]
+    # 同じ中心点・半径の組み合わせの結果は全セッションで再利用する
+    hits = dataset.cached('radius_batch', lambda: dataset.query_radius_batch(lat, lon, radii_km),
+                          lat=lat, lon=lon, radius_km=radii_km)
+    per_center = [np.empty(0, dtype=np.int64)] * len(centers)
+    for position, ids in zip(np.flatnonzero(valid), hits):
+        per_center[position] = ids
+
+    households = dataset.households()
+    counts = [len(ids) for ids in per_center]
+    totals = [int(households[ids].sum()) if len(ids) else 0 for ids in per_center]
+    summary = centers[['名前', '中心', '半径', '状態']].assign(
+        町名数=counts,
+        世帯数=totals,
+        算出金額=[total * unit_price for total in totals],
+    )
+    union = np.unique(np.concatenate(per_center)) if per_center else np.empty(0, dtype=np.int64)
+    return summary, per_center, union
+
+
+def sheet_name(index, name):
+    """地点ごとのシート名（Excelの制限：31文字以内・一部の記号は不可）"""
+    return SHEET_NAME_INVALID.sub('_', f"{index + 1}_{name}")[:31]
@@ -0,0 +1,278 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import folium
+import numpy as np
+import pandas as pd
+
+from dataset import SessionDataset, SharedDataset, load_dataset, normalize_frame
+from exports import build_csv, build_excel
+from geo_search import HALF_PLANES, RadiusSearcher, direction_mask, select_rows
+from map_layers import add_town_markers
+
+# 計測する処理（名前, 説明）
+CASES = [
+    ('load', '読込み（型変換・住所の分解・索引の作成）'),
+    ('search', '住所の部分一致検索'),
+    ('radius', '半径検索→行の切り出し→世帯数合計'),
+    ('direction', '方向・扇形・距離の絞り込み'),
+    ('aggregate', '町ごとの世帯数・重心の集計'),
+    ('totals', '格子ごとの合計から多角形の世帯数'),
+    ('map', 'folium の地図作成（HTML出力まで）'),
+    ('csv', 'CSVの作成'),
+    ('excel', 'Excelの作成'),
+]
+
+# 処理ごとの計測回数（重い処理は少なめ）
+REPEATS = {'load': 3, 'map': 5, 'csv': 5, 'excel': 3}
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+# ベースラインからこの割合以上遅くなり、かつ差が NOISE_MS を超えたら回帰とみなす
+DEFAULT_TOLERANCE = 0.25
+NOISE_MS = 1.0
+
+
+def synthetic_source(n_towns, seed=0):
+    """同梱の住所データをもとに n_towns 町分の合成データ（元CSVと同じ列・書式）を作る
+
+    町名は実在の町名に丁目の番号を付けて重複しないようにし、座標は元の町の周辺にばらつかせる
+    """
+    df, _ = load_dataset()
+    base = df.dropna(subset=['Latitude', 'Longitude'])
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(base), n_towns)
+    serial = pd.Series(picks).groupby(picks).cumcount().to_numpy() + 1
+
+    addresses = base['住所（スプレッドシート用）'].to_numpy(dtype=object)[picks]
+    households = rng.integers(1, 3000, n_towns)
+    return pd.DataFrame({
+        '住所（スプレッドシート用）': [f"{address}合成{n}丁目" for address, n in zip(addresses, serial)],
+        'Latitude': base['Latitude'].to_numpy()[picks] + rng.normal(0, 0.01, n_towns),
+        'Longitude': base['Longitude'].to_numpy()[picks] + rng.normal(0, 0.01, n_towns),
+        '世帯数': [f"{h:,}" for h in households],
+    })
+
+
+def _timed(fn, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return np.array(timings), result
+
+
+def bench_radius_query(df, radius_km, repeat, seed=0):
+    """ランダムな町を中心に半径検索→行の切り出し→世帯数合計までの時間（ms）を計測"""
+    searcher = RadiusSearcher(df)
+    rng = np.random.default_rng(seed)
+    centers = df.dropna(subset=['Latitude', 'Longitude']).sample(repeat, replace=True, random_state=rng)
+
+    timings = []
+    for lat, lon in zip(centers['Latitude'], centers['Longitude']):
+        start = time.perf_counter()
+        result_df = select_rows(df, searcher.query(lat, lon, radius_km))
+        result_df['世帯数'].sum()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    # 切り出した結果の型が元データと同じであることも確認
+    assert (result_df.dtypes == df.dtypes).all(), '検索結果の列の型が変わっています'
+    return np.array(timings)
+
+
+def run_suite(raw, radius_km, repeat, cases, seed=0):
+    """1つのデータ規模について各処理を計測し、{処理: 計測値(ms)の配列} を返す"""
+    rng = np.random.default_rng(seed)
+    results = {}
+
+    def build():
+        return SessionDataset(SharedDataset(normalize_frame(raw)))
+
+    load_timings, data = _timed(build, REPEATS['load'] if 'load' in cases else 1)
+    if 'load' in cases:
+        results['load'] = load_timings
+    df = data.shared.df
+    located = df.dropna(subset=['Latitude', 'Longitude'])
+    centers = located.sample(repeat, replace=True, random_state=rng)
+
+    if 'search' in cases:
+        # 住所の一部（町名部分の2〜4文字）を検索語にする
+        towns = located['town'].astype(str)
+        towns = towns[towns.str.len() >= 2].sample(repeat, replace=True, random_state=rng).tolist()
+        queries = [town[:int(rng.integers(2, 5))] for town in towns]
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            data.take(data.search(query))
+            timings.append((time.perf_counter() - start) * 1000)
+        results['search'] = np.array(timings)
+
+    if 'radius' in cases:
+        results['radius'] = bench_radius_query(df, radius_km, repeat, seed)
+
+    if 'direction' in cases:
+        timings = []
+        directions = list(HALF_PLANES)
+        for lat, lon in zip(centers['Latitude'], centers['Longitude']):
+            chosen = list(rng.choice(directions, int(rng.integers(1, 3)), replace=False))
+            start_deg = float(rng.uniform(0, 360))
+            start = time.perf_counter()
+            rows = data.filter()
+            rows[direction_mask(rows, lat, lon, chosen, sector=(start_deg, start_deg + 90), ring=(0, radius_km))]
+            timings.append((time.perf_counter() - start) * 1000)
+        results['direction'] = np.array(timings)
+
+    if 'aggregate' in cases:
+        all_towns = df['住所（スプレッドシート用）'].unique()
+        timings = []
+        for _ in range(repeat):
+            towns = rng.choice(all_towns, min(500, len(all_towns)), replace=False)
+            start = time.perf_counter()
+            data.town_table(towns)['世帯数'].sum()
+            timings.append((time.perf_counter() - start) * 1000)
+        results['aggregate'] = np.array(timings)
+
+    if 'totals' in cases:
+        # 半径と同じ大きさの六角形を多角形の例にする
+        angles = np.radians(np.arange(0, 420, 60))
+        d_lat = radius_km / 111.0
+        timings = []
+        for lat, lon in zip(centers['Latitude'], centers['Longitude']):
+            d_lon = d_lat / np.cos(np.radians(lat))
+            ring = np.column_stack([lon + d_lon * np.cos(angles), lat + d_lat * np.sin(angles)])
+            start = time.perf_counter()
+            data.polygon_total([[ring]])
+            timings.append((time.perf_counter() - start) * 1000)
+        results['totals'] = np.array(timings)
+
+    # 地図・出力は1つの円の検索結果を使う
+    center = centers.iloc[0]
+    result_df = data.take(data.query_radius(center['Latitude'], center['Longitude'], radius_km))
+
+    if 'map' in cases:
+        def build_map():
+            m = folium.Map(location=[center['Latitude'], center['Longitude']], zoom_start=14, prefer_canvas=True)
+            add_town_markers(m, result_df, color='green')
+            return m.get_root().render()
+        results['map'], _ = _timed(build_map, REPEATS['map'])
+
+    if 'csv' in cases:
+        results['csv'], _ = _timed(lambda: build_csv(result_df), REPEATS['csv'])
+
+    if 'excel' in cases:
+        summary = [('総世帯数', f"{result_df['世帯数'].sum():,}世帯")]
+        results['excel'], _ = _timed(lambda: build_excel(result_df, summary), REPEATS['excel'])
+
+    return results, len(df), len(result_df)
+
+
+def _bundled_source():
+    """同梱の市のCSVから読み込んだ元の列だけのデータ（読込みの計測用）"""
+    df, _ = load_dataset()
+    return df[['住所（スプレッドシート用）', 'Latitude', 'Longitude', '世帯数']].copy()
+
+
+def compare(results, baseline, tolerance):
+    """ベースラインより遅くなった処理を (規模, 処理, 今回, ベースライン) のリストで返す"""
+    regressions = []
+    for size, cases in results.items():
+        for case, stats in cases.items():
+            base = baseline.get(size, {}).get(case)
+            if base is None:
+                continue
+            now, before = stats['median_ms'], base['median_ms']
+            if now > before * (1 + tolerance) and now - before > NOISE_MS:
+                regressions.append((size, case, now, before))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='読込み・検索・集計・地図・出力の回帰ベンチマーク')
+    parser.add_argument('--sizes', default='bundled',
+                        help='データ規模（カンマ区切り。bundled=同梱データ、数値=合成データの町数）例: bundled,10000,100000,1000000')
+    parser.add_argument('--cases', default=','.join(name for name, _ in CASES), help='計測する処理（カンマ区切り）')
+    parser.add_argument('--radius', type=float, default=3.0, help='検索半径（km）')
+    parser.add_argument('--repeat', type=int, default=200, help='検索・集計の計測回数')
+    parser.add_argument('--target-ms', type=float, default=50.0, help='同梱データの半径検索で許容する最大時間（ms）')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='ベースラインのファイル')
+    parser.add_argument('--save-baseline', action='store_true', help='今回の結果をベースラインとして保存する')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='回帰とみなす遅延の割合（0.25 = 25%%）')
+    parser.add_argument('--json', help='結果をJSONで保存するファイル')
+    args = parser.parse_args()
+
+    cases = args.cases.split(',')
+    unknown = set(cases) - {name for name, _ in CASES}
+    if unknown:
+        parser.error(f"不明な処理: {', '.join(sorted(unknown))}")
+
+    results = {}
+    failed = False
+    for size in args.sizes.split(','):
+        raw = _bundled_source() if size == 'bundled' else synthetic_source(int(size))
+        timings, n_rows, n_result = run_suite(raw, args.radius, args.repeat, cases)
+        results[size] = {
+            case: {
+                'median_ms': float(np.median(values)),
+                'p95_ms': float(np.percentile(values, 95)),
+                'max_ms': float(values.max()),
+                'rows': n_rows,
+            }
+            for case, values in timings.items()
+        }
+
+        print(f"\n== {size}: {n_rows}行（出力の計測は半径{args.radius}kmの{n_result}行） ==")
+        for name, label in CASES:
+            if name in results[size]:
+                stats = results[size][name]
+                print(f"{name:<10} 中央値 {stats['median_ms']:9.2f}ms  p95 {stats['p95_ms']:9.2f}ms  "
+                      f"最大 {stats['max_ms']:9.2f}ms  {label}")
+
+        if size == 'bundled' and 'radius' in results[size] and results[size]['radius']['max_ms'] > args.target_ms:
+            print(f"半径検索が目標 {args.target_ms}ms を超えました", file=sys.stderr)
+            failed = True
+
+    # 規模ごとの伸び方（2つ以上の規模を測った場合）
+    if len(results) > 1:
+        print("\n== 規模ごとの中央値（ms） ==")
+        sizes = list(results)
+        print(f"{'':<10}" + ''.join(f"{size:>12}" for size in sizes))
+        for name, _ in CASES:
+            if name in cases:
+                print(f"{name:<10}" + ''.join(f"{results[size].get(name, {}).get('median_ms', float('nan')):12.2f}"
+                                             for size in sizes))
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as f:
+                baseline = json.load(f)
+        for size, cases_stats in results.items():
+            baseline.setdefault(size, {}).update(cases_stats)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print(f"\nベースラインを保存しました: {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for size, case, now, before in regressions:
+            print(f"回帰: {size} / {case}: {before:.2f}ms → {now:.2f}ms", file=sys.stderr)
+        if regressions:
+            failed = True
+        else:
+            print(f"\nベースラインから{args.tolerance:.0%}以上遅くなった処理はありません")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
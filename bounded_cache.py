@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+
+from instrumentation import increment
+
+
+class BoundedLRU:
+    """件数と合計バイト数に上限のあるLRUキャッシュ（スレッドセーフ・プロセス内で共有して使う）
+
+    値の大きさは sizeof(value) で求める。counter を渡すと、ヒット・ミスを計測の
+    '<counter>_hits' / '<counter>_misses' にも数える
+    """
+
+    def __init__(self, max_entries, max_bytes, sizeof, counter=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.counter = counter
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get_or_compute(self, key, compute):
+        """key の値があればそれを、なければ compute() で計算して返す
+
+        計算中はロックを外すので、同じキーを同時に計算した場合は先に入れた値を残す
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                hit = True
+                value = self._entries[key][0]
+            else:
+                self.misses += 1
+                hit = False
+        if self.counter:
+            increment(f'{self.counter}_hits' if hit else f'{self.counter}_misses')
+        if hit:
+            return value
+
+        value = self.prepare(compute())
+        size = self.sizeof(value)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, size)
+                self._nbytes += size
+            # 古いものから捨てる（直前に追加した1件は残す）
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self._nbytes > self.max_bytes):
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self._nbytes -= old_size
+        return value
+
+    def prepare(self, value):
+        """キャッシュに入れる前に値を整える（既定ではそのまま）"""
+        return value
+
+    def discard_if(self, predicate):
+        """predicate(key) が真のものをすべて捨て、捨てた件数を返す"""
+        with self._lock:
+            stale = [key for key in self._entries if predicate(key)]
+            for key in stale:
+                _, size = self._entries.pop(key)
+                self._nbytes -= size
+        return len(stale)
+
+    def stats(self):
+        """件数・バイト数・ヒット数・ミス数・ヒット率"""
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._nbytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,686 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import uuid
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from geocoding import Gazetteer
+from geo_search import RadiusSearcher, batch_radius_query, select_rows
+from grid_pyramid import AggregationPyramid, SessionPyramid
+from query_cache import query_cache, query_key
+from search_index import AddressSearchIndex
+from towns import ADDRESS_COLUMNS, TownAggregates, parse_addresses, town_frame
+
+# --- 市ごとの住所データ（市名, ファイル名） ---
+CITY_FILES = [
+    ('加古川市', '加古川市住所データ.csv'),
+    ('姫路市', '姫路市全域住所データ - 2024331.csv'),
+    ('神戸市', '神戸市住所データ.csv'),
+    ('明石市', '明石市住所データ.csv'),
+    ('西宮市', '西宮市住所データ.csv'),
+    ('高砂市', '高砂市住所データ.csv'),
+]
+CITY_NAMES = [city for city, _ in CITY_FILES]
+
+# 元のCSVの列
+SOURCE_COLUMNS = ['住所（スプレッドシート用）', 'Latitude', 'Longitude', '世帯数']
+
+# 同じ地点とみなすキーの列（世帯数が違う場合は CONFLICT_POLICIES に従う）
+KEY_COLUMNS = ['住所（スプレッドシート用）', 'Latitude', 'Longitude']
+
+# 同じ地点の世帯数が既存データと違う場合の扱い
+CONFLICT_POLICIES = {
+    'newest': '新しい世帯数で上書き',
+    'oldest': '既存の世帯数を残す',
+    'sum': '世帯数を合算',
+}
+
+# 読込み時に住所から作る内部用の列（エクスポートには含めない）
+INTERNAL_COLUMNS = ADDRESS_COLUMNS
+
+# コンパイル済みデータの形式。列の構成を変えたら上げる（古いデータは作り直される）
+ARTIFACT_VERSION = 2
+
+# コンパイル済みデータの保存先
+ARTIFACT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.dataset_cache')
+ARTIFACT_FILE = os.path.join(ARTIFACT_DIR, 'towns.feather')
+MANIFEST_FILE = os.path.join(ARTIFACT_DIR, 'manifest.json')
+
+# プロセスの umask（取得するには一度設定し直すしかないので、読み込み時に一度だけ調べる）
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def _source_path(file_name):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
+
+
+def _file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_fingerprint():
+    """元CSVの (ファイル名, サイズ, 更新時刻) の組。キャッシュのキーに使う"""
+    fingerprint = []
+    for _, file_name in CITY_FILES:
+        try:
+            stat = os.stat(_source_path(file_name))
+            fingerprint.append((file_name, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            fingerprint.append((file_name, None, None))
+    return tuple(fingerprint)
+
+
+def normalize_households(series):
+    """「1,058」のようなカンマ区切りの世帯数を整数に変換"""
+    return pd.to_numeric(series.astype(str).str.replace(',', '', regex=False), errors='coerce').fillna(0).astype(int)
+
+
+def _categorical(values, leading=()):
+    """カテゴリ型に変換する（leading に挙げた値を先頭のカテゴリにする）"""
+    values = pd.Series(values)
+    categories = list(leading) + sorted(set(values.dropna().unique().tolist()) - set(leading))
+    return pd.Categorical(values, categories=categories)
+
+
+def normalize_source(df):
+    """住所・座標・世帯数の型を揃える（内部用の列は取り除く）"""
+    df = df.drop(columns=INTERNAL_COLUMNS, errors='ignore').copy()
+    # 空の住所は空文字にする（pandas の版によって文字列 'nan' にならないように）
+    df['住所（スプレッドシート用）'] = df['住所（スプレッドシート用）'].fillna('').astype(str)
+    df['Latitude'] = pd.to_numeric(df['Latitude'], errors='coerce').astype(np.float64)
+    df['Longitude'] = pd.to_numeric(df['Longitude'], errors='coerce').astype(np.float64)
+    df['世帯数'] = normalize_households(df['世帯数'])
+    return df
+
+
+def add_address_columns(df):
+    """住所を分解した列を付ける
+
+    都道府県・市・区・町はカテゴリ型（同じ文字列は1回だけ保持し、行ごとには整数コード）
+    """
+    parts = parse_addresses(df['住所（スプレッドシート用）'])
+    df['prefecture'] = _categorical(parts['prefecture'].to_numpy())
+    df['city'] = _categorical(parts['city'].to_numpy(), leading=CITY_NAMES)
+    df['ward'] = _categorical(parts['ward'].to_numpy())
+    df['town'] = _categorical(parts['town'].to_numpy())
+    df['chome'] = parts['chome'].array
+    return df
+
+
+def normalize_frame(df):
+    """住所・座標・世帯数の型を揃え、住所を分解した列を付ける（アップロードされたデータにも使う）"""
+    return add_address_columns(normalize_source(df))
+
+
+def row_keys(df):
+    """重複判定用のキー（住所・座標の64bitハッシュ）"""
+    return pd.util.hash_pandas_object(df[KEY_COLUMNS], index=False).to_numpy()
+
+
+def _resolve_households(old, new, policy):
+    """同じ地点の世帯数が2つある場合に残す値（同じ値なら単なる重複）"""
+    if old == new or policy == 'oldest':
+        return old
+    if policy == 'sum':
+        return old + new
+    return new
+
+
+def _concat_overlay(overlay, new_df):
+    """差分の行を結合する（カテゴリ型の列はカテゴリを合わせてカテゴリ型のまま）"""
+    if overlay.empty:
+        return new_df
+    combined = pd.concat([overlay, new_df])
+    for column in ['prefecture', 'city', 'ward', 'town']:
+        combined[column] = union_categoricals([overlay[column], new_df[column]])
+    return combined
+
+
+def export_frame(df):
+    """ダウンロード用に内部用の列を取り除く"""
+    return df.drop(columns=INTERNAL_COLUMNS, errors='ignore')
+
+
+def _read_manifest():
+    try:
+        with open(MANIFEST_FILE, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_artifact_fresh(manifest):
+    """マニフェストに記録した元CSVと現在のファイルが一致するか確認
+
+    サイズと更新時刻が同じならそのまま、更新時刻だけ違う場合はハッシュで比較する。
+    """
+    if manifest is None or manifest.get('version') != ARTIFACT_VERSION or not os.path.exists(ARTIFACT_FILE):
+        return False
+    recorded = manifest.get('sources', {})
+    for _, file_name in CITY_FILES:
+        path = _source_path(file_name)
+        entry = recorded.get(file_name)
+        if not os.path.exists(path):
+            if entry is not None:
+                return False
+            continue
+        if entry is None:
+            return False
+        stat = os.stat(path)
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns != entry['mtime_ns'] and _file_sha1(path) != entry['sha1']:
+            return False
+    return True
+
+
+def _replace_file(path, write):
+    """一時ファイルに write(一時ファイルのパス) で書いてから置き換える
+
+    同時にコンパイルした複数のプロセスが書いている途中のファイルを読まないようにする
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    os.close(fd)
+    try:
+        write(temp_path)
+        # mkstemp は所有者だけが読める 0600 で作るので、通常のファイルと同じ（umask に従う）権限にする
+        # （コンパイルとアプリを別のユーザーで実行しても読めるように）
+        os.chmod(temp_path, 0o666 & ~UMASK)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def _write_manifest(path, manifest):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def compile_dataset():
+    """全市のCSVを読み込み、型を揃えた1つのデータとして保存する
+
+    戻り値は (データフレーム, 読込みに失敗した市のエラーメッセージのリスト)
+    """
+    frames = []
+    sources = {}
+    errors = []
+    for city, file_name in CITY_FILES:
+        path = _source_path(file_name)
+        try:
+            city_df = pd.read_csv(path, encoding='utf-8')
+        except Exception as e:
+            errors.append(f"{city}データファイルの読み込みに失敗: {str(e)}")
+            continue
+        frames.append(city_df)
+        stat = os.stat(path)
+        sources[file_name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': _file_sha1(path)}
+
+    if frames:
+        df = pd.concat(frames, ignore_index=True)
+    else:
+        df = pd.DataFrame(columns=SOURCE_COLUMNS + INTERNAL_COLUMNS)
+
+    # 市（CITY_FILES の順）・区の順に並べ、市や区ごとの行が連続するようにする
+    df = normalize_frame(df)
+    df = df.sort_values(['city', 'ward'], kind='stable').reset_index(drop=True)
+
+    # 読込みに失敗した市がある場合は保存しない（次回また読み直す）
+    if not errors:
+        os.makedirs(ARTIFACT_DIR, exist_ok=True)
+        _replace_file(ARTIFACT_FILE, df.to_feather)
+        _replace_file(MANIFEST_FILE, lambda path: _write_manifest(path, {'version': ARTIFACT_VERSION, 'sources': sources}))
+    return df, errors
+
+
+def load_dataset():
+    """コンパイル済みデータが最新ならそれを、古ければ作り直して読み込む"""
+    if _is_artifact_fresh(_read_manifest()):
+        try:
+            return pd.read_feather(ARTIFACT_FILE), []
+        except Exception:
+            pass
+    return compile_dataset()
+
+
+def _frame_nbytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def _searcher_nbytes(searcher):
+    index = searcher.index
+    arrays = [index.lat, index.lon, index.lat_rad, index.lon_rad] + list(index.cells.values())
+    return int(sum(a.nbytes for a in arrays))
+
+
+def _search_index_nbytes(search_index):
+    strings = sum(sys.getsizeof(text) for text in search_index.normalized)
+    return int(strings + sum(ids.nbytes for ids in search_index.postings.values()))
+
+
+def _row_ranges(df, keys):
+    """keys の値の組ごとの行範囲（連続していれば slice、そうでなければ行位置の配列）"""
+    if df.empty:
+        return {}
+    ranges = {}
+    for key, positions in df.groupby(keys, observed=True, sort=False).indices.items():
+        if positions[-1] - positions[0] + 1 == len(positions):
+            ranges[key] = slice(int(positions[0]), int(positions[-1]) + 1)
+        else:
+            ranges[key] = positions
+    return ranges
+
+
+def _area_mask(df, city, ward=None):
+    mask = (df['city'] == city).to_numpy()
+    if ward is not None:
+        mask = mask & (df['ward'] == ward).to_numpy()
+    return mask
+
+
+class SharedDataset:
+    """プロセス内で共有する基本データ（読込み後は変更しない）"""
+
+    def __init__(self, df):
+        self.df = df
+        self.searcher = RadiusSearcher(df)
+        self.towns = TownAggregates(df)
+        self.search_index = AddressSearchIndex(df['住所（スプレッドシート用）'])
+        # 格子ごとの世帯数（縮小した地図の色分け・範囲の合計世帯数用）
+        self.pyramid = AggregationPyramid(self.searcher.index.lat, self.searcher.index.lon,
+                                          df['世帯数'].to_numpy(dtype=np.int64))
+        # 市ごと・区ごとの行範囲（コンパイル時に市・区の順に並べてあるので slice になる）
+        self.city_ranges = _row_ranges(df, 'city')
+        self.ward_ranges = _row_ranges(df, ['city', 'ward'])
+        self._key_index = None
+        self._gazetteer = None
+        # 検索結果のキャッシュのキーに使うデータの版（読み直すたびに変わる）
+        self.version = uuid.uuid4().hex[:12]
+        self.nbytes = (_frame_nbytes(df) + _searcher_nbytes(self.searcher) + _frame_nbytes(self.towns.table) +
+                       _search_index_nbytes(self.search_index) + self.pyramid.nbytes)
+
+    def __len__(self):
+        return len(self.df)
+
+    def area_rows(self, city, ward=None):
+        """市（と区）の行をそのまま切り出す"""
+        rows = self.city_ranges.get(city) if ward is None else self.ward_ranges.get((city, ward))
+        if rows is None:
+            return self.df.iloc[0:0]
+        return self.df.iloc[rows]
+
+    @property
+    def key_index(self):
+        """重複判定用のキー → 行ID の辞書（最初のアップロード時に一度だけ計算）"""
+        if self._key_index is None:
+            self._key_index = dict(zip(row_keys(self.df).tolist(), range(len(self.df))))
+        return self._key_index
+
+    @property
+    def gazetteer(self):
+        """座標のない住所の座標を引く地名辞典（最初に必要になった時に一度だけ作る）"""
+        if self._gazetteer is None:
+            self._gazetteer = Gazetteer.from_dataset(self)
+        return self._gazetteer
+
+
+class SessionDataset:
+    """共有の基本データに、セッションごとのアップロード分（差分のみ）を重ねて扱う
+
+    行IDは基本データの行位置に続けてアップロード分を通し番号で振る。
+    基本データはコピーせず、検索は基本データと差分それぞれに対して行い結果だけを結合する。
+    """
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.overlay = shared.df.iloc[0:0].copy()
+        self.overlay_searcher = RadiusSearcher(self.overlay)
+        self.overlay_towns = TownAggregates(self.overlay)
+        self.overlay_search_index = AddressSearchIndex()
+        self.overlay_keys = {}
+        # このセッションで更新した基本データの世帯数（更新するまでは共有データの値を使う）
+        self.base_households = None
+        # アップロードでデータが変わった回数（検索結果のキャッシュのキーに使う）
+        self.revision = 0
+        self._session_token = uuid.uuid4().hex[:8]
+        self._pyramid = None
+
+    def __len__(self):
+        return len(self.shared) + len(self.overlay)
+
+    @property
+    def columns(self):
+        return self.shared.df.columns.union(self.overlay.columns, sort=False)
+
+    @property
+    def version(self):
+        """データの版。アップロードで変わっていなければ共有データの版（検索結果を全セッションで共有できる）"""
+        if self.revision == 0:
+            return self.shared.version
+        return f"{self.shared.version}.{self._session_token}.{self.revision}"
+
+    @property
+    def pyramid(self):
+        """格子ごとの世帯数。アップロードでデータが変わっていなければ共有データのものを使い、
+        変わっていれば共有データのものに差分（アップロード分・世帯数の更新分）の格子だけを重ねる"""
+        if self.revision == 0:
+            return self.shared.pyramid
+        if self._pyramid is None or self._pyramid[0] != self.revision:
+            self._pyramid = (self.revision, self._session_pyramid())
+        return self._pyramid[1]
+
+    def _session_pyramid(self):
+        """世帯数を更新した基本データの行（更新前との差）とアップロード分の行だけで差分の格子を作る"""
+        base = self.shared.searcher.index
+        n_base = len(self.shared)
+        lat, lon, households, counts, row_ids = [], [], [], [], []
+        if self.base_households is not None:
+            shared_households = self.shared.df['世帯数'].to_numpy(dtype=np.int64)
+            changed = np.flatnonzero(self.base_households != shared_households)
+            lat.append(base.lat[changed])
+            lon.append(base.lon[changed])
+            households.append(self.base_households[changed] - shared_households[changed])
+            counts.append(np.zeros(len(changed), dtype=np.int64))
+            row_ids.append(changed)
+        if not self.overlay.empty:
+            overlay = self.overlay_searcher.index
+            lat.append(overlay.lat)
+            lon.append(overlay.lon)
+            households.append(self.overlay['世帯数'].to_numpy(dtype=np.int64))
+            counts.append(np.ones(len(self.overlay), dtype=np.int64))
+            row_ids.append(np.arange(n_base, n_base + len(self.overlay)))
+        arrays = [np.concatenate(parts) if parts else np.empty(0) for parts in (lat, lon, households, counts, row_ids)]
+        return SessionPyramid(self.shared.pyramid, *arrays)
+
+    def cached(self, kind, compute, **params):
+        """検索結果を全セッション共有のキャッシュから返す（なければ compute() で計算する）
+
+        キーは検索の種類・条件（params）・データの版
+        """
+        return query_cache.get_or_compute(query_key(kind, self.version, **params), compute)
+
+    def _parts(self):
+        parts = [self._base_rows(self.shared.df)]
+        if not self.overlay.empty:
+            parts.append(self.overlay)
+        return parts
+
+    def append(self, new_df, policy='newest'):
+        """アップロードされた行のうち、既存データと重複しない行だけを差分に追加する
+
+        追加した行数を返す
+        """
+        return self.append_chunks([new_df], policy)[0]
+
+    def append_chunks(self, chunks, policy='newest'):
+        """分割して読み込んだ行を順に重複判定し、新しい地点の行だけをまとめて差分に追加する
+
+        キー（住所・座標のハッシュ）→ 行ID の索引で、追加する行だけを判定する。
+        既存の地点で世帯数が違う場合は policy（CONFLICT_POLICIES）に従って世帯数を更新する。
+        (追加した行数, 世帯数を更新した地点の数) を返す
+        """
+        if policy not in CONFLICT_POLICIES:
+            raise ValueError(f'不明な重複時の扱いです: {policy}')
+        base_index = self.shared.key_index
+        n_base = len(self.shared)
+        next_id = len(self)
+        pieces = []
+        pending = []
+        updates = {}
+        # 追加する行のキー。途中のチャンクで失敗した時に索引が存在しない行を指さないよう、最後にまとめて反映する
+        new_keys = {}
+
+        def current(row_id):
+            if row_id in updates:
+                return updates[row_id]
+            if row_id < n_base:
+                if self.base_households is not None:
+                    return int(self.base_households[row_id])
+                return int(self.shared.df['世帯数'].iat[row_id])
+            if row_id < len(self):
+                return int(self.overlay.at[row_id, '世帯数'])
+            return int(pending[row_id - len(self)])
+
+        for chunk in chunks:
+            chunk = normalize_source(chunk)
+            households = chunk['世帯数'].to_numpy(dtype=np.int64)
+            is_new = np.zeros(len(chunk), dtype=bool)
+            for i, key in enumerate(row_keys(chunk).tolist()):
+                row_id = base_index.get(key)
+                if row_id is None:
+                    row_id = self.overlay_keys.get(key)
+                if row_id is None:
+                    row_id = new_keys.get(key)
+                if row_id is None:
+                    new_keys[key] = next_id
+                    pending.append(households[i])
+                    next_id += 1
+                    is_new[i] = True
+                    continue
+                old = current(row_id)
+                value = _resolve_households(old, int(households[i]), policy)
+                if value != old:
+                    if row_id >= len(self):
+                        pending[row_id - len(self)] = value
+                    else:
+                        updates[row_id] = value
+            if is_new.any():
+                pieces.append(chunk[is_new])
+
+        # すべてのチャンクを読み終えてから反映する（途中で失敗した場合はデータを変えない）
+        new_df = None
+        if pieces:
+            new_df = add_address_columns(pd.concat(pieces) if len(pieces) > 1 else pieces[0])
+            new_df['世帯数'] = np.asarray(pending, dtype=np.int64)
+            new_df.index = pd.RangeIndex(len(self), len(self) + len(new_df))
+
+        self._apply_updates(updates)
+        if updates or pieces:
+            self.revision += 1
+        if new_df is None:
+            return 0, len(updates)
+
+        self.overlay = _concat_overlay(self.overlay, new_df)
+        self.overlay_keys.update(new_keys)
+        # 空間インデックスと町ごとの集計は追加分だけを反映
+        self.overlay_searcher.append(new_df)
+        self.overlay_towns.append(new_df)
+        self.overlay_search_index.append(new_df['住所（スプレッドシート用）'])
+        return len(new_df), len(updates)
+
+    def _apply_updates(self, updates):
+        """既存の行の世帯数を更新し、町ごとの集計には差分だけを足す"""
+        if not updates:
+            return
+        ids = np.fromiter(updates.keys(), dtype=np.int64, count=len(updates))
+        values = np.fromiter(updates.values(), dtype=np.int64, count=len(updates))
+        n_base = len(self.shared)
+        rows = self.take(ids)
+        deltas = values - rows['世帯数'].to_numpy(dtype=np.int64)
+
+        in_base = ids < n_base
+        if in_base.any():
+            if self.base_households is None:
+                self.base_households = self.shared.df['世帯数'].to_numpy(dtype=np.int64).copy()
+            self.base_households[ids[in_base]] = values[in_base]
+        if (~in_base).any():
+            self.overlay.loc[ids[~in_base], '世帯数'] = values[~in_base]
+        self.overlay_towns.adjust_households(rows, deltas)
+
+    def rebase(self, shared):
+        """共有データが更新された時に、このセッションのアップロード分と世帯数の更新を新しい共有データに載せ替える"""
+        session = SessionDataset(shared)
+        frames = []
+        if self.base_households is not None:
+            changed = np.flatnonzero(self.base_households != self.shared.df['世帯数'].to_numpy(dtype=np.int64))
+            frames.append(self.shared.df.iloc[changed].assign(世帯数=self.base_households[changed]))
+        if not self.overlay.empty:
+            frames.append(self.overlay)
+        session.append_chunks(frames, policy='newest')
+        return session
+
+    def _base_rows(self, rows):
+        """基本データの行（インデックスは行ID）に、このセッションで更新した世帯数を反映する"""
+        if self.base_households is None or rows.empty:
+            return rows
+        return rows.assign(世帯数=self.base_households[rows.index.to_numpy()])
+
+    def filter(self, mask_fn=None):
+        """mask_fn(df) が True を返す行を取り出す（インデックスは行ID）
+
+        差分がなければ基本データをそのまま（またはその一部を）返す
+        """
+        pieces = []
+        for df in self._parts():
+            if mask_fn is None:
+                pieces.append(df)
+                continue
+            mask = mask_fn(df)
+            pieces.append(df if mask.all() else df[mask])
+        if len(pieces) == 1:
+            return pieces[0]
+        return pd.concat(pieces)
+
+    def area_rows(self, city, ward=None):
+        """市（と区）の行を取り出す。基本データは事前に求めた行範囲から切り出すだけ"""
+        rows = self._base_rows(self.shared.area_rows(city, ward))
+        if self.overlay.empty:
+            return rows
+        overlay_rows = self.overlay[_area_mask(self.overlay, city, ward)]
+        if overlay_rows.empty:
+            return rows
+        return pd.concat([rows, overlay_rows])
+
+    def area_count(self, city, ward=None):
+        """市（と区）の行数"""
+        count = len(self.shared.area_rows(city, ward))
+        if not self.overlay.empty:
+            count += int(_area_mask(self.overlay, city, ward).sum())
+        return count
+
+    def wards(self, city):
+        """市に含まれる区の一覧"""
+        wards = {ward for c, ward in self.shared.ward_ranges if c == city}
+        if not self.overlay.empty:
+            wards |= set(self.overlay.loc[_area_mask(self.overlay, city), 'ward'].astype(str))
+        return sorted(ward for ward in wards if ward)
+
+    def take(self, ids):
+        """行IDの配列から行を ids と同じ順に取り出す（列の型は保持。検索結果の一致度の順などをそのまま保つ）"""
+        ids = np.asarray(ids, dtype=np.int64)
+        n_base = len(self.shared)
+        in_base = ids < n_base
+        base_ids = ids[in_base]
+        base_rows = select_rows(self.shared.df, base_ids)
+        if self.base_households is not None:
+            base_rows['世帯数'] = self.base_households[base_ids]
+        if self.overlay.empty:
+            return base_rows
+        overlay_rows = select_rows(self.overlay, ids[~in_base] - n_base)
+        rows = pd.concat([base_rows, overlay_rows], ignore_index=True)
+        # 基本データ・差分の順に結合したので、差分の行がいずれかの基本データの行より前にあれば元の順に並べ直す
+        if (~in_base[:-1] & in_base[1:]).any():
+            positions = np.concatenate([np.flatnonzero(in_base), np.flatnonzero(~in_base)])
+            rows = rows.take(np.argsort(positions, kind='stable')).reset_index(drop=True)
+        return rows
+
+    def query_radius(self, center_lat, center_lon, radius_km):
+        """半径検索の結果を行IDの昇順で返す"""
+        ids = self.shared.searcher.query(center_lat, center_lon, radius_km)
+        if self.overlay.empty:
+            return ids
+        overlay_ids = self.overlay_searcher.query(center_lat, center_lon, radius_km)
+        return np.concatenate([ids, overlay_ids + len(self.shared)])
+
+    def query_radius_batch(self, centers_lat, centers_lon, radii_km):
+        """複数の円それぞれの内側にある行IDを、円ごとの昇順の配列のリストで返す"""
+        lat, lon = self.coordinates()
+        return batch_radius_query(lat, lon, centers_lat, centers_lon, radii_km)
+
+    def query_polygons(self, polygons):
+        """多角形の内側にある行IDを昇順で返す"""
+        ids = self.shared.searcher.polygons(polygons)
+        if self.overlay.empty:
+            return ids
+        overlay_ids = self.overlay_searcher.polygons(polygons)
+        return np.concatenate([ids, overlay_ids + len(self.shared)])
+
+    def polygon_total(self, polygons):
+        """多角形の内側の (合計世帯数, 件数)。行を取り出さずに格子ごとの合計から求める"""
+        return self.pyramid.polygon_total(polygons)
+
+    def search(self, query):
+        """住所の部分一致検索。行IDを一致度の高い順に返す"""
+        ids, scores = self.shared.search_index.search(query)
+        if len(self.overlay_search_index):
+            overlay_ids, overlay_scores = self.overlay_search_index.search(query)
+            ids = np.concatenate([ids, overlay_ids + len(self.shared)])
+            scores = np.concatenate([scores, overlay_scores])
+            ids = ids[np.lexsort((ids, scores))]
+        return ids
+
+    def coordinates(self):
+        """全行の (緯度, 経度) の配列（行ID順）"""
+        base = self.shared.searcher.index
+        if self.overlay.empty:
+            return base.lat, base.lon
+        overlay = self.overlay_searcher.index
+        return np.concatenate([base.lat, overlay.lat]), np.concatenate([base.lon, overlay.lon])
+
+    def households(self):
+        """全行の世帯数の配列（行ID順）"""
+        base = self.shared.df['世帯数'].to_numpy(dtype=np.int64) if self.base_households is None else self.base_households
+        if self.overlay.empty:
+            return base
+        return np.concatenate([base, self.overlay['世帯数'].to_numpy(dtype=np.int64)])
+
+    def town_households(self, towns):
+        """町ごとの世帯数の配列（towns と同じ順）"""
+        households = self.shared.towns.sums(towns)['households'].to_numpy()
+        if len(self.overlay_towns):
+            households = households + self.overlay_towns.sums(towns)['households'].to_numpy()
+        return households
+
+    def town_table(self, towns):
+        """町ごとの世帯数・重心座標・市・区の表（towns と同じ順）"""
+        sums = self.shared.towns.sums(towns)
+        attributes = self.shared.towns.attributes(towns)
+        if len(self.overlay_towns):
+            sums = sums + self.overlay_towns.sums(towns)
+            attributes = attributes.combine_first(self.overlay_towns.attributes(towns))
+        return town_frame(sums, attributes)
+
+    def memory_usage(self):
+        """(全セッション共有分, このセッション固有分) のバイト数"""
+        session_bytes = (_frame_nbytes(self.overlay) + _searcher_nbytes(self.overlay_searcher) +
+                         _frame_nbytes(self.overlay_towns.table) + _search_index_nbytes(self.overlay_search_index))
+        if self.base_households is not None:
+            session_bytes += self.base_households.nbytes
+        if self._pyramid is not None:
+            session_bytes += self._pyramid[1].nbytes
+        return self.shared.nbytes, session_bytes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='市ごとの住所CSVを1つのデータにコンパイルする')
+    parser.add_argument('--force', action='store_true', help='元CSVが変わっていなくても作り直す')
+    args = parser.parse_args()
+
+    if args.force or not _is_artifact_fresh(_read_manifest()):
+        df, errors = compile_dataset()
+        for message in errors:
+            print(message)
+        print(f"{len(df)}行をコンパイルしました: {ARTIFACT_FILE}")
+    else:
+        print(f"コンパイル済みデータは最新です: {ARTIFACT_FILE}")
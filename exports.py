@@ -0,0 +1,83 @@
+import hashlib
+import io
+
+import pandas as pd
+
+from bounded_cache import BoundedLRU
+from dataset import export_frame
+from instrumentation import current
+
+# キャッシュの上限（件数・合計バイト数）
+MAX_ENTRIES = 32
+MAX_BYTES = 64 * 1024 * 1024
+
+EXCEL_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+class ExportCache(BoundedLRU):
+    """作成済みのダウンロードファイルを保持するLRUキャッシュ（プロセス内で共有）"""
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        super().__init__(max_entries, max_bytes, len)
+
+    def get_or_build(self, key, builder):
+        """key のファイルがあればそれを、なければ builder() で作って返す"""
+        return self.get_or_compute(key, builder)
+
+
+export_cache = ExportCache()
+
+
+def content_key(kind, df, **params):
+    """出力の種類・対象行の内容・条件から一意のキーを作る"""
+    digest = hashlib.sha1(kind.encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    digest.update(repr(list(df.columns)).encode('utf-8'))
+    digest.update(repr(sorted(params.items())).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def build_csv(df):
+    """ダウンロード用のCSV（UTF-8）"""
+    csv_buffer = io.StringIO()
+    export_frame(df).to_csv(csv_buffer, index=False)
+    return csv_buffer.getvalue().encode('utf-8')
+
+
+def build_excel(df, summary_items, extra_sheets=()):
+    """住所データ・追加シート・サマリーシートを含むExcelファイル
+
+    summary_items: (項目, 値) のリスト
+    extra_sheets: (シート名, データフレーム) のリスト
+    """
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        export_frame(df).to_excel(writer, index=False, sheet_name='住所データ')
+        for sheet_name, sheet_df in extra_sheets:
+            sheet_df.to_excel(writer, index=False, sheet_name=sheet_name)
+        summary_data = pd.DataFrame({
+            '項目': [item for item, _ in summary_items],
+            '値': [value for _, value in summary_items],
+        })
+        summary_data.to_excel(writer, index=False, sheet_name='サマリー')
+    return buffer.getvalue()
+
+
+def lazy_export(kind, rows, builder, **params):
+    """ダウンロードボタンが押された時に初めて作成する（同じ内容ならキャッシュを返す）
+
+    rows: 出力する行（データフレーム、または押された時に行を取り出す関数）
+    builder: 行を受け取ってファイルの中身を返す関数
+    st.download_button の data に渡す関数を返す
+    """
+    # ボタンが押された時は再実行の外で呼ばれるので、作成時のセッションの計測先を使う
+    recorder = current()
+
+    def build():
+        df = rows() if callable(rows) else rows
+        key = content_key(kind, df, **params)
+        if recorder is None:
+            return export_cache.get_or_build(key, lambda: builder(df))
+        with recorder.span(f'export:{kind}'):
+            return export_cache.get_or_build(key, lambda: builder(df))
+    return build
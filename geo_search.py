@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+from geopy.distance import geodesic
+
+from instrumentation import increment
+from polygons import points_in_polygon, polygon_bounds
+from spatial_index import KM_PER_DEG_LAT, GridIndex, haversine_km
+
+# ハバーサイン距離と楕円体（WGS-84）距離の差は最大でも約0.5%
+# この幅に入る境界付近の候補だけを geodesic で再計算する
+BOUNDARY_TOLERANCE = 0.005
+
+# 複数の円をまとめて判定する時の距離行列（点 × 中心）の1回あたりの要素数の上限
+BATCH_CHUNK_CELLS = 1_000_000
+
+# 東西南北の方向フィルター：基準点に対してどちら側にあるか（緯度・経度の大小で判定）
+HALF_PLANES = {
+    '北側': ('lat', 1),
+    '南側': ('lat', -1),
+    '東側': ('lon', 1),
+    '西側': ('lon', -1),
+}
+
+
+def _coordinates(df):
+    lat = pd.to_numeric(df['Latitude'], errors='coerce').to_numpy(dtype=np.float64)
+    lon = pd.to_numeric(df['Longitude'], errors='coerce').to_numpy(dtype=np.float64)
+    return lat, lon
+
+
+def bearings_deg(lat, lon, center_lat, center_lon):
+    """中心点から各点への方位角（北=0°、時計回り、0〜360°）"""
+    lat1 = np.radians(center_lat)
+    lat2 = np.radians(np.asarray(lat, dtype=np.float64))
+    d_lon = np.radians(np.asarray(lon, dtype=np.float64) - center_lon)
+    y = np.sin(d_lon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(d_lon)
+    return np.degrees(np.arctan2(y, x)) % 360.0
+
+
+def sector_mask(bearings, start_deg, end_deg):
+    """方位角が start_deg から時計回りに end_deg までの扇形に入るか
+
+    start_deg > end_deg の場合は北をまたぐ扇形（例: 300°〜60°）とみなす
+    """
+    start = start_deg % 360.0
+    end = end_deg % 360.0
+    if end_deg - start_deg >= 360.0:
+        return ~np.isnan(bearings)
+    if start <= end:
+        return (bearings >= start) & (bearings <= end)
+    return (bearings >= start) | (bearings <= end)
+
+
+def direction_mask(df, base_lat, base_lon, directions=(), sector=None, ring=None):
+    """基準点から見た方向・距離の条件に合う行の真偽値配列
+
+    directions: HALF_PLANES のキーのリスト（いずれかに当てはまればOK）
+    sector: 方位角の範囲 (開始, 終了)（度、北=0°・時計回り）
+    ring: 基準点からの距離の範囲 (最小, 最大)（km）
+    座標が欠損している行は常に False
+    """
+    lat, lon = _coordinates(df)
+    increment('rows_scanned', len(lat))
+    mask = ~(np.isnan(lat) | np.isnan(lon))
+
+    if directions:
+        matches = np.zeros(len(lat), dtype=bool)
+        for direction in directions:
+            axis, sign = HALF_PLANES[direction]
+            values, base = (lat, base_lat) if axis == 'lat' else (lon, base_lon)
+            matches |= sign * (values - base) > 0
+        mask &= matches
+
+    if sector is not None:
+        mask &= sector_mask(bearings_deg(lat, lon, base_lat, base_lon), *sector)
+
+    if ring is not None:
+        distances = haversine_km(np.radians(lat), np.radians(lon), base_lat, base_lon)
+        mask &= (distances >= ring[0]) & (distances <= ring[1])
+
+    return mask
+
+
+def batch_radius_query(lat, lon, centers_lat, centers_lon, radii_km, exact=True, chunk_cells=BATCH_CHUNK_CELLS):
+    """複数の円（中心・半径）それぞれの内側にある点の位置を、円ごとの昇順の配列のリストで返す
+
+    全円の外接矩形で点を絞り込み、点を分割しながら距離行列（点 × 中心）を一括で計算する。
+    exact=True の場合、境界付近の組み合わせだけ楕円体距離（geodesic）で判定し直す
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    centers_lat = np.asarray(centers_lat, dtype=np.float64)
+    centers_lon = np.asarray(centers_lon, dtype=np.float64)
+    radii_km = np.asarray(radii_km, dtype=np.float64)
+    n_centers = len(centers_lat)
+    if n_centers == 0:
+        return []
+
+    margin = radii_km * BOUNDARY_TOLERANCE if exact else np.zeros(n_centers)
+    outer = radii_km + margin
+    d_lat = outer / KM_PER_DEG_LAT
+    d_lon = outer / (KM_PER_DEG_LAT * np.maximum(np.cos(np.radians(centers_lat)), 1e-6))
+    candidates = np.flatnonzero(
+        (lat >= (centers_lat - d_lat).min()) & (lat <= (centers_lat + d_lat).max()) &
+        (lon >= (centers_lon - d_lon).min()) & (lon <= (centers_lon + d_lon).max())
+    )
+    increment('rows_scanned', len(lat))
+    lat_rad = np.radians(lat[candidates])
+    lon_rad = np.radians(lon[candidates])
+
+    hits = [[] for _ in range(n_centers)]
+    chunk = max(1, chunk_cells // n_centers)
+    for start in range(0, len(candidates), chunk):
+        distances = haversine_km(lat_rad[start:start + chunk, None], lon_rad[start:start + chunk, None],
+                                 centers_lat[None, :], centers_lon[None, :])
+        rows, cols = np.nonzero(distances <= outer)
+        if exact:
+            boundary = np.flatnonzero(distances[rows, cols] > radii_km[cols] - margin[cols])
+            increment('geodesic', len(boundary))
+            keep = np.ones(len(rows), dtype=bool)
+            for i in boundary:
+                point = candidates[start + rows[i]]
+                center = (centers_lat[cols[i]], centers_lon[cols[i]])
+                keep[i] = geodesic(center, (lat[point], lon[point])).km <= radii_km[cols[i]]
+            rows, cols = rows[keep], cols[keep]
+        ids = candidates[start + rows]
+        order = np.argsort(cols, kind='stable')
+        splits = np.searchsorted(cols[order], np.arange(1, n_centers))
+        for center, center_ids in enumerate(np.split(ids[order], splits)):
+            if len(center_ids):
+                hits[center].append(center_ids)
+
+    return [np.concatenate(found) if found else np.empty(0, dtype=np.int64) for found in hits]
+
+
+def _within_radius(distances, lat, lon, center_lat, center_lon, radius_km):
+    """ハバーサイン距離で確実に内側の点はそのまま、境界付近の点だけ楕円体距離（geodesic）で判定し直す"""
+    margin = radius_km * BOUNDARY_TOLERANCE
+    inside = distances <= radius_km - margin
+    boundary = np.flatnonzero(~inside & (distances <= radius_km + margin))
+    increment('geodesic', len(boundary))
+    center = (center_lat, center_lon)
+    for i in boundary:
+        inside[i] = geodesic(center, (lat[i], lon[i])).km <= radius_km
+    return inside
+
+
+def select_rows(df, positions):
+    """検索結果の行位置から、元の列の型を保ったままデータフレームを切り出す"""
+    return df.take(positions).reset_index(drop=True)
+
+
+class RadiusSearcher:
+    """データセットの座標を空間インデックスに登録し、半径・最近傍・矩形検索を行う
+
+    返す値はすべてデータフレームの行位置（df.iloc 用）。
+    """
+
+    def __init__(self, df):
+        self.index = GridIndex()
+        self.append(df)
+
+    def __len__(self):
+        return len(self.index)
+
+    def append(self, df):
+        """追加された行だけをインデックスに登録する"""
+        lat, lon = _coordinates(df)
+        self.index.append(lat, lon)
+
+    def query(self, center_lat, center_lon, radius_km, exact=True):
+        """中心点から radius_km 以内にある行の位置を昇順の配列で返す
+
+        exact=True の場合、境界付近の候補だけ楕円体距離（geodesic）で判定し直す
+        """
+        margin = radius_km * BOUNDARY_TOLERANCE if exact else 0.0
+        ids, distances = self.index.query_radius(center_lat, center_lon, radius_km + margin)
+        if not exact:
+            return ids
+        return ids[_within_radius(distances, self.index.lat[ids], self.index.lon[ids], center_lat, center_lon, radius_km)]
+
+    def nearest(self, center_lat, center_lon, k=1):
+        """中心点に近い順に k 行の位置と距離（km）を返す"""
+        return self.index.nearest(center_lat, center_lon, k)
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """矩形内にある行の位置を昇順の配列で返す"""
+        return self.index.query_bbox(min_lat, min_lon, max_lat, max_lon)
+
+    def polygons(self, polygons):
+        """いずれかの多角形の内側にある行の位置を昇順の配列で返す
+
+        外接矩形でインデックスから候補を取り出し、候補だけを内外判定する
+        """
+        found = []
+        for rings in polygons:
+            ids = self.index.query_bbox(*polygon_bounds(rings))
+            found.append(ids[points_in_polygon(self.index.lat[ids], self.index.lon[ids], rings)])
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
@@ -0,0 +1,349 @@
+import csv
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from geopy.geocoders import Nominatim
+
+from search_index import normalize_text
+
+# 住所→座標のキャッシュの保存先（コンパイル済みデータと同じ場所）
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.dataset_cache', 'geocode.sqlite3')
+
+# 外部の地図サービスへの同時問い合わせ数
+DEFAULT_WORKERS = 4
+
+# OpenStreetMap（Nominatim）の利用規約上の上限は1秒に1件
+NOMINATIM_INTERVAL = 1.0
+NOMINATIM_USER_AGENT = 'household-map-app'
+
+# 見つからなかった住所の記録を信じる期間（秒）。過ぎたら同じ問い合わせ先にも問い合わせ直す
+NEGATIVE_TTL = 30 * 24 * 60 * 60
+
+# 住所の先頭の都道府県
+PREFECTURE = re.compile(r'^.+?[都道府県]')
+
+# 住所の末尾の番地・号（「123」「2-3」「5番地」「12番3号」「1の2」など）を、住所を逆順にした文字列の先頭で照合する
+# 末尾（$）に合わせる正規表現は照合の開始位置を1文字ずつずらして試すので、末尾でない長い数字の並びで
+# 時間が掛かる。先頭で1回だけ照合し、数字の並びの区切り方も1通りにして、照合の時間を住所の長さに比例させる
+BLOCK_NUMBER_REVERSED = re.compile(r'(?:地番|番|号)?\d+(?:(?:地番|番|号|の|-|ー|‐|−)\d+)*(?!\d)[\s,、]*')
+
+# 住所の末尾の丁目（検索用の正規化では漢数字を変えないので、漢数字の丁目も含める）
+CHOME = re.compile(r'[\d一二三四五六七八九十]+丁目$')
+
+
+def _address_key(address):
+    """キャッシュ・住所の照合に使う住所の表記（検索と同じ正規化）。空の住所は空文字（探さない）"""
+    if pd.isna(address):
+        return ''
+    return normalize_text(address).strip()
+
+
+def _without_prefecture(text):
+    return PREFECTURE.sub('', text)
+
+
+def _without_block_number(text):
+    """住所の末尾の番地・号を除く"""
+    match = BLOCK_NUMBER_REVERSED.match(text[::-1])
+    return text[:len(text) - match.end()] if match else text
+
+
+class GeocodeCache:
+    """住所→座標の永続キャッシュ（SQLite、複数のスレッド・プロセスから使える）
+
+    見つからなかった住所も座標なし（NULL）と問い合わせ先（source）を記録し、同じ住所を何度も問い合わせないようにする。
+    見つからなかった記録は、同じ問い合わせ先で NEGATIVE_TTL 以内のものだけを使う
+    """
+
+    def __init__(self, path=CACHE_FILE):
+        self.path = path
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS geocode ('
+                'address TEXT PRIMARY KEY, lat REAL, lon REAL, source TEXT, updated REAL)'
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM geocode').fetchone()[0]
+
+    def get_many(self, addresses, source=None, negative_ttl=NEGATIVE_TTL):
+        """{住所: (緯度, 経度) または None（見つからなかった住所）} を返す（キャッシュにない住所は含めない）
+
+        見つからなかった記録は、問い合わせ先が source で negative_ttl 秒以内のものだけを返す
+        （問い合わせ先が変わった・古くなった記録は、キャッシュにないものとして扱い問い合わせ直す）
+        """
+        found = {}
+        addresses = list(addresses)
+        oldest = time.time() - negative_ttl
+        with self._lock:
+            # SQLite の変数の上限に収まるように分けて問い合わせる
+            for start in range(0, len(addresses), 500):
+                batch = addresses[start:start + 500]
+                rows = self._connection.execute(
+                    f"SELECT address, lat, lon FROM geocode WHERE address IN ({','.join('?' * len(batch))}) "
+                    "AND (lat IS NOT NULL OR (source = ? AND updated >= ?))", batch + [source, oldest]
+                )
+                for address, lat, lon in rows:
+                    found[address] = None if lat is None else (lat, lon)
+        return found
+
+    def put_many(self, results, source):
+        """{住所: (緯度, 経度) または None} を保存する"""
+        now = time.time()
+        rows = [(address, *(coords if coords is not None else (None, None)), source, now)
+                for address, coords in results.items()]
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?)', rows)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class Gazetteer:
+    """同梱の市の住所データを地名辞典として使い、住所から座標を引く
+
+    完全に一致する住所がなければ、都道府県を省いた表記・番地を除いた表記・丁目を除いた町の重心の順に探す
+    """
+
+    def __init__(self, addresses, lat, lon):
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        self.exact = {}
+        town_sums = {}
+        for text, y, x in zip(addresses, lat.tolist(), lon.tolist()):
+            if np.isnan(y) or np.isnan(x):
+                continue
+            text = _without_prefecture(text)
+            self.exact.setdefault(text, (y, x))
+            town = CHOME.sub('', text)
+            sums = town_sums.setdefault(town, [0.0, 0.0, 0])
+            sums[0] += y
+            sums[1] += x
+            sums[2] += 1
+        self.towns = {town: (y / n, x / n) for town, (y, x, n) in town_sums.items()}
+
+    @classmethod
+    def from_dataset(cls, shared):
+        """共有データ（正規化済みの住所と座標の索引）から作る"""
+        index = shared.searcher.index
+        return cls(shared.search_index.normalized, index.lat, index.lon)
+
+    def lookup(self, key):
+        """正規化済みの住所から (緯度, 経度) を返す（見つからなければ None）"""
+        text = _without_prefecture(key)
+        if text in self.exact:
+            return self.exact[text]
+        stripped = _without_block_number(text)
+        if stripped in self.exact:
+            return self.exact[stripped]
+        return self.towns.get(CHOME.sub('', stripped))
+
+
+class RateLimiter:
+    """複数のスレッドから呼ばれても、問い合わせの間隔を min_interval 秒以上あける"""
+
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class NominatimGeocoder:
+    """OpenStreetMap の Nominatim（geopy 経由）で住所を検索する"""
+
+    name = 'nominatim'
+    source = 'nominatim'
+    min_interval = NOMINATIM_INTERVAL
+
+    def __init__(self, user_agent=NOMINATIM_USER_AGENT, timeout=10):
+        self._geocoder = Nominatim(user_agent=user_agent, timeout=timeout)
+
+    def geocode(self, address):
+        location = self._geocoder.geocode(address, country_codes='jp')
+        if location is None:
+            return None
+        return location.latitude, location.longitude
+
+
+class TableGeocoder:
+    """住所→座標の表を引くだけのジオコーダー（オフラインでの動作確認・社内の座標表の利用）"""
+
+    name = 'table'
+    min_interval = 0.0
+
+    def __init__(self, table):
+        self.table = {_address_key(address): coords for address, coords in table.items()}
+        # 表の内容が変わったら、見つからなかった住所を問い合わせ直す
+        digest = hashlib.sha1(repr(sorted(self.table.items())).encode('utf-8')).hexdigest()[:12]
+        self.source = f'table:{digest}'
+
+    @classmethod
+    def from_csv(cls, path):
+        """住所・緯度・経度の3列のCSV（見出し行あり）から作る"""
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            rows = list(csv.reader(f))[1:]
+        return cls({row[0]: (float(row[1]), float(row[2])) for row in rows if len(row) >= 3})
+
+    def geocode(self, address):
+        return self.table.get(_address_key(address))
+
+
+def make_geocoder(spec):
+    """設定の文字列からジオコーダーを作る
+
+    'none'（外部に問い合わせない）/ 'nominatim' / 'table:住所と座標のCSVのパス'
+    """
+    if not spec or spec == 'none':
+        return None
+    if spec == 'nominatim':
+        return NominatimGeocoder()
+    if spec.startswith('table:'):
+        return TableGeocoder.from_csv(spec[len('table:'):])
+    raise ValueError(f'不明なジオコーダーです: {spec}')
+
+
+def geocode_addresses(addresses, geocoder, workers=DEFAULT_WORKERS, progress=None):
+    """{キー: 住所} の住所をジオコーダーに並行して問い合わせ、({キー: 座標または None}, 失敗した住所の数) を返す
+
+    問い合わせの間隔はジオコーダーの min_interval 秒以上あける。
+    例外になった住所（通信エラーなど）は結果に含めない（キャッシュせず次回また問い合わせる）
+    """
+    limiter = RateLimiter(getattr(geocoder, 'min_interval', 0.0))
+    results = {}
+    failed = 0
+
+    def resolve(address):
+        limiter.wait()
+        return geocoder.geocode(address)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(resolve, address): key for key, address in addresses.items()}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                results[futures[future]] = future.result()
+            except Exception:
+                failed += 1
+            if progress is not None:
+                progress(done / len(futures))
+    return results, failed
+
+
+class GeocodingStage:
+    """アップロードされた行のうち座標がない行の座標を埋める
+
+    キャッシュ → 地名辞典（同梱の市の住所データ）→ ジオコーダーの順に探す。
+    キャッシュの「見つからなかった」記録は、地名辞典でも見つからず、同じジオコーダーで記録したものだけを使う。
+    stats に探し方ごとの住所の数を数える
+    """
+
+    def __init__(self, gazetteer=None, cache=None, geocoder=None, workers=DEFAULT_WORKERS, progress=None):
+        self.gazetteer = gazetteer
+        self.cache = cache
+        self.geocoder = geocoder
+        self.workers = workers
+        self.progress = progress
+        self.stats = {'cache': 0, 'gazetteer': 0, 'geocoder': 0, 'not_found': 0, 'failed': 0}
+
+    def fill(self, chunk):
+        """chunk の座標が欠けている行を埋めたデータフレームを返す（座標の列がなければ作る）"""
+        chunk = chunk.copy()
+        for column in ('Latitude', 'Longitude'):
+            chunk[column] = pd.to_numeric(chunk[column], errors='coerce') if column in chunk else np.nan
+        addresses = chunk['住所（スプレッドシート用）'] if '住所（スプレッドシート用）' in chunk else None
+        if addresses is None:
+            return chunk
+        # 空の住所（NaN・空文字）は文字列 'nan' として探さないよう、キーを作る前に除く
+        missing = ((chunk['Latitude'].isna() | chunk['Longitude'].isna()) & addresses.notna() &
+                   (addresses.astype(str).str.strip() != ''))
+        if not missing.any():
+            return chunk
+
+        originals = addresses[missing].astype(str)
+        keys = originals.map(_address_key)
+        # 正規化した住所ごとに1回だけ探す（ジオコーダーには元の表記を渡す）
+        unique = {}
+        for key, address in zip(keys, originals):
+            if key:
+                unique.setdefault(key, address)
+        resolved = self.resolve(unique)
+        found = [(index, resolved[key]) for index, key in keys.items() if key in resolved]
+        if found:
+            index = [index for index, _ in found]
+            chunk.loc[index, 'Latitude'] = [lat for _, (lat, _) in found]
+            chunk.loc[index, 'Longitude'] = [lon for _, (_, lon) in found]
+        return chunk
+
+    def resolve(self, addresses):
+        """{正規化済みの住所: 元の住所} から {正規化済みの住所: (緯度, 経度)} を返す（見つからなかった住所は含めない）"""
+        resolved = {}
+        pending = list(addresses)
+        source = getattr(self.geocoder, 'source', None)
+
+        negatives = set()
+        if self.cache is not None and pending:
+            cached = self.cache.get_many(pending, source)
+            for key, coords in cached.items():
+                if coords is None:
+                    negatives.add(key)
+                else:
+                    resolved[key] = coords
+                    self.stats['cache'] += 1
+            pending = [key for key in pending if key not in resolved]
+
+        # 地名辞典は手元で引けるので、前に見つからなかった住所も探し直す（同梱データの更新で見つかることがある）
+        if self.gazetteer is not None and pending:
+            remaining = []
+            for key in pending:
+                coords = self.gazetteer.lookup(key)
+                if coords is None:
+                    remaining.append(key)
+                else:
+                    resolved[key] = coords
+                    self.stats['gazetteer'] += 1
+            pending = remaining
+
+        # 同じジオコーダーで見つからなかった住所は問い合わせない
+        self.stats['not_found'] += sum(key in negatives for key in pending)
+        pending = [key for key in pending if key not in negatives]
+
+        if self.geocoder is not None and pending:
+            results, failed = geocode_addresses({key: addresses[key] for key in pending},
+                                                self.geocoder, self.workers, self.progress)
+            self.stats['failed'] += failed
+            if self.cache is not None:
+                self.cache.put_many(results, source)
+            for key, coords in results.items():
+                if coords is None:
+                    self.stats['not_found'] += 1
+                else:
+                    resolved[key] = coords
+                    self.stats['geocoder'] += 1
+        elif pending:
+            self.stats['not_found'] += len(pending)
+        return resolved
+
+    def iter_chunks(self, chunks):
+        """分割して読み込んだデータフレームの座標を順に埋める"""
+        for chunk in chunks:
+            yield self.fill(chunk)
@@ -0,0 +1,249 @@
+import numpy as np
+import pandas as pd
+
+from instrumentation import increment
+from polygons import points_in_polygon, polygon_bounds
+
+# 最も細かい格子の一辺（度）。0.005度 ≒ 南北550m・東西450m（兵庫県付近）
+BASE_CELL_DEG = 0.005
+
+# 格子の段数（1段ごとに一辺を2倍にする。0.005・0.01・0.02・0.04・0.08度）
+LEVELS = 5
+
+# 地図に表示する時の格子1つのおおよその大きさ（ピクセル）
+CELL_PX = 24
+
+# 合計を求める時の格子の大きさ（範囲の幅のおよそ 1/N にする）
+CELLS_ACROSS = 8
+
+# 格子と多角形の辺の交差判定で一度に作る配列の要素数の上限
+EDGE_CHUNK_CELLS = 1_000_000
+
+
+class _Level:
+    """1段分の格子：格子ごとの世帯数・件数・点の外接矩形と、格子順に並べた行ID"""
+
+    def __init__(self, cell_deg, cell_y, cell_x, ids, lat, lon, households, counts, n_rows):
+        self.cell_deg = cell_deg
+        keys = np.empty(0, dtype=np.int64)
+        if len(ids):
+            # 格子の番号の組を1つの整数にして並べ替える
+            width = int(cell_x.max() - cell_x.min()) + 1
+            keys = (cell_y - cell_y.min()) * width + (cell_x - cell_x.min())
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])[:len(keys)]
+
+        self.ids = ids[order]
+        self.bounds = np.r_[starts, len(keys)]
+        self.cell_y = cell_y[order][starts]
+        self.cell_x = cell_x[order][starts]
+        self.households = np.add.reduceat(households[self.ids], starts)
+        self.rows = np.diff(self.bounds) if counts is None else np.add.reduceat(counts[self.ids], starts)
+        lat, lon = lat[self.ids], lon[self.ids]
+        # 格子の境界ではなく、格子に入っている点の外接矩形で内外を判定する（浮動小数点の丸めの影響を受けない）
+        self.min_lat = np.minimum.reduceat(lat, starts)
+        self.max_lat = np.maximum.reduceat(lat, starts)
+        self.min_lon = np.minimum.reduceat(lon, starts)
+        self.max_lon = np.maximum.reduceat(lon, starts)
+
+        # 行ID → 格子の番号（座標のない行は -1）。一部の行だけを集計する時に使う
+        self.cell_of = np.full(n_rows, -1, dtype=np.int64)
+        self.cell_of[self.ids] = np.repeat(np.arange(len(starts)), np.diff(self.bounds))
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in (
+            self.ids, self.bounds, self.cell_y, self.cell_x, self.households, self.rows,
+            self.min_lat, self.max_lat, self.min_lon, self.max_lon, self.cell_of))
+
+    def members(self, cells):
+        """格子（番号の配列）に入っている行IDをまとめて返す"""
+        starts = self.bounds[cells]
+        lengths = self.bounds[np.asarray(cells) + 1] - starts
+        # 格子ごとの区間 [start, start + length) をつなげた位置の配列
+        offsets = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum()) - np.repeat(offsets - starts, lengths)
+        return self.ids[positions]
+
+
+class AggregationPyramid:
+    """世帯数を何段階かの大きさの正方形の格子ごとに合計した表（データ読込み時に一度だけ作る）
+
+    縮小した地図の色分け（格子ごとの世帯数）と、多角形の範囲の合計世帯数に使う。
+    範囲の合計は、範囲に完全に含まれる格子は合計済みの値を足し、境界に掛かる格子の点だけを1件ずつ判定する。
+    counts（点ごとの件数）を渡すと、件数は点の数ではなくその合計にする（世帯数だけを補正する点は 0）
+    """
+
+    def __init__(self, lat, lon, households, counts=None, base_cell_deg=BASE_CELL_DEG, levels=LEVELS):
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        self.lat = lat
+        self.lon = lon
+        self.households = np.asarray(households, dtype=np.int64)
+        self.counts = None if counts is None else np.asarray(counts, dtype=np.int64)
+        valid = ~(np.isnan(lat) | np.isnan(lon))
+        ids = np.flatnonzero(valid)
+
+        # 細かい格子の番号を整数で割って粗い格子の番号にする（粗い格子はちょうど4つの細かい格子からなる）
+        base_y = np.floor(lat[valid] / base_cell_deg).astype(np.int64)
+        base_x = np.floor(lon[valid] / base_cell_deg).astype(np.int64)
+        self.levels = [
+            _Level(base_cell_deg * 2 ** k, base_y // 2 ** k, base_x // 2 ** k, ids, lat, lon, self.households,
+                   self.counts, len(lat))
+            for k in range(levels)
+        ]
+
+    def __len__(self):
+        return len(self.lat)
+
+    @property
+    def nbytes(self):
+        return sum(level.nbytes for level in self.levels)
+
+    def level_for_zoom(self, zoom):
+        """地図のズームレベルで格子1つが CELL_PX ピクセル前後になる段"""
+        target_deg = CELL_PX * 360.0 / (256 * 2 ** zoom)
+        return int(np.argmin([abs(np.log(level.cell_deg / target_deg)) for level in self.levels]))
+
+    def _level_for_extent(self, extent_deg):
+        """幅 extent_deg の範囲の合計に使う段（格子が範囲の幅の 1/CELLS_ACROSS 以下になる最も粗い段）"""
+        fitting = [k for k, level in enumerate(self.levels) if level.cell_deg <= extent_deg / CELLS_ACROSS]
+        return fitting[-1] if fitting else 0
+
+    def cells(self, level, ids=None):
+        """段 level の格子ごとの世帯数・件数の表（格子の南西の角の緯度経度と一辺の度数付き）
+
+        ids（行IDの配列）を渡すと、その行だけを格子ごとに合計する（行が1つもない格子は含めない）
+        """
+        grid = self.levels[level]
+        if ids is None:
+            households, rows = grid.households, grid.rows
+        else:
+            ids = np.asarray(ids, dtype=np.int64)
+            cell_of = grid.cell_of[ids]
+            located = cell_of >= 0
+            households = np.bincount(cell_of[located], weights=self.households[ids][located],
+                                     minlength=len(grid)).astype(np.int64)
+            counts = None if self.counts is None else self.counts[ids][located]
+            rows = np.bincount(cell_of[located], weights=counts, minlength=len(grid)).astype(np.int64)
+        # 件数が 0 でも世帯数を補正する格子は残す（SessionPyramid で共有の格子に足す）
+        keep = (rows > 0) | (households != 0)
+        return pd.DataFrame({
+            'lat': grid.cell_y[keep] * grid.cell_deg,
+            'lon': grid.cell_x[keep] * grid.cell_deg,
+            'size': grid.cell_deg,
+            'households': households[keep],
+            'rows': rows[keep],
+        })
+
+    def polygon_total(self, polygons):
+        """いずれかの多角形の内側にある（多角形検索と同じ判定）行の (合計世帯数, 件数)"""
+        if not polygons:
+            return 0, 0
+        bounds = np.array([polygon_bounds(rings) for rings in polygons])
+        # 最も小さい多角形に合わせる
+        extent = np.minimum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1]).min()
+        grid = self.levels[self._level_for_extent(extent)]
+
+        interior = np.zeros(len(grid), dtype=bool)
+        touched = np.zeros(len(grid), dtype=bool)
+        for rings, (min_lat, min_lon, max_lat, max_lon) in zip(polygons, bounds):
+            near = np.flatnonzero((grid.max_lat >= min_lat) & (grid.min_lat <= max_lat) &
+                                  (grid.max_lon >= min_lon) & (grid.min_lon <= max_lon))
+            # 辺が通らず、4隅が内側の格子は丸ごと内側、4隅が外側なら丸ごと外側
+            crossed = _edges_cross(rings, grid.min_lat[near], grid.min_lon[near], grid.max_lat[near], grid.max_lon[near])
+            corners = points_in_polygon(
+                np.r_[grid.min_lat[near], grid.min_lat[near], grid.max_lat[near], grid.max_lat[near]],
+                np.r_[grid.min_lon[near], grid.max_lon[near], grid.min_lon[near], grid.max_lon[near]],
+                rings,
+            ).reshape(4, -1)
+            inside_box = ((grid.min_lat[near] >= min_lat) & (grid.max_lat[near] <= max_lat) &
+                          (grid.min_lon[near] >= min_lon) & (grid.max_lon[near] <= max_lon))
+            interior[near[~crossed & corners.all(axis=0) & inside_box]] = True
+            touched[near[crossed | corners.any(axis=0)]] = True
+
+        boundary = grid.members(np.flatnonzero(touched & ~interior))
+        increment('rows_scanned', len(boundary))
+        mask = np.zeros(len(boundary), dtype=bool)
+        lat, lon = self.lat[boundary], self.lon[boundary]
+        for rings, (min_lat, min_lon, max_lat, max_lon) in zip(polygons, bounds):
+            in_box = (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+            mask |= in_box & points_in_polygon(lat, lon, rings)
+        return self._total(grid, np.flatnonzero(interior), boundary[mask])
+
+    def _total(self, grid, cells, ids):
+        """合計済みの格子と、1件ずつ判定した行の合計"""
+        households = int(grid.households[cells].sum()) + int(self.households[ids].sum())
+        rows = len(ids) if self.counts is None else int(self.counts[ids].sum())
+        return households, int(grid.rows[cells].sum()) + rows
+
+
+class SessionPyramid:
+    """共有データの格子ごとの合計に、セッションの差分（アップロードした行・世帯数を更新した行）だけの格子を重ねる
+
+    共有データの表はコピーせず、差分の点だけで AggregationPyramid を作る。
+    差分の点は、アップロードした行（世帯数・件数 1）と、世帯数を更新した基本データの行（更新前との差・件数 0）。
+    row_ids は差分の点ごとのセッションの行ID
+    """
+
+    def __init__(self, shared, lat, lon, households, counts, row_ids):
+        self.shared = shared
+        self.delta = AggregationPyramid(lat, lon, households, counts,
+                                        base_cell_deg=shared.levels[0].cell_deg, levels=len(shared.levels))
+        self.row_ids = np.asarray(row_ids, dtype=np.int64)
+
+    @property
+    def levels(self):
+        return self.shared.levels
+
+    @property
+    def nbytes(self):
+        """このセッションだけが持つ分のバイト数"""
+        return self.delta.nbytes + self.row_ids.nbytes
+
+    def level_for_zoom(self, zoom):
+        return self.shared.level_for_zoom(zoom)
+
+    def cells(self, level, ids=None):
+        """AggregationPyramid.cells と同じ（共有データの格子と差分の格子を、同じ位置どうし足し合わせる）"""
+        if ids is None:
+            shared_cells = self.shared.cells(level)
+            delta_cells = self.delta.cells(level)
+        else:
+            ids = np.asarray(ids, dtype=np.int64)
+            shared_cells = self.shared.cells(level, ids[ids < len(self.shared)])
+            delta_cells = self.delta.cells(level, np.flatnonzero(np.isin(self.row_ids, ids)))
+        if delta_cells.empty:
+            return shared_cells
+        cells = pd.concat([shared_cells, delta_cells]).groupby(['lat', 'lon', 'size'], as_index=False, sort=False).sum()
+        return cells[cells['rows'] > 0].reset_index(drop=True)
+
+    def polygon_total(self, polygons):
+        """AggregationPyramid.polygon_total と同じ（共有データと差分の合計の和）"""
+        shared_households, shared_rows = self.shared.polygon_total(polygons)
+        delta_households, delta_rows = self.delta.polygon_total(polygons)
+        return shared_households + delta_households, shared_rows + delta_rows
+
+
+def _edges_cross(rings, min_lat, min_lon, max_lat, max_lon):
+    """各矩形に多角形（穴を含む）の辺が掛かっているか（辺が矩形に触れる場合も含む）"""
+    crossed = np.zeros(len(min_lat), dtype=bool)
+    if not len(min_lat):
+        return crossed
+    edges = np.concatenate([np.column_stack([ring, np.roll(ring, -1, axis=0)]) for ring in rings])
+    corner_x = np.stack([min_lon, max_lon, min_lon, max_lon], axis=1)[:, :, None]
+    corner_y = np.stack([min_lat, min_lat, max_lat, max_lat], axis=1)[:, :, None]
+    chunk = max(1, EDGE_CHUNK_CELLS // len(min_lat))
+    for start in range(0, len(edges), chunk):
+        x1, y1, x2, y2 = edges[start:start + chunk].T
+        # 外接矩形が重なり、かつ矩形の4隅が辺を含む直線の両側（または線上）にある
+        overlap = ((np.minimum(x1, x2) <= max_lon[:, None]) & (np.maximum(x1, x2) >= min_lon[:, None]) &
+                   (np.minimum(y1, y2) <= max_lat[:, None]) & (np.maximum(y1, y2) >= min_lat[:, None]))
+        side = (x2 - x1) * (corner_y - y1) - (y2 - y1) * (corner_x - x1)
+        straddle = (side.min(axis=1) <= 0) & (side.max(axis=1) >= 0)
+        crossed |= (overlap & straddle).any(axis=1)
+    return crossed
@@ -0,0 +1,94 @@
+import codecs
+import io
+
+import chardet
+import pandas as pd
+from openpyxl import load_workbook
+
+# 文字コードの判定に使う先頭部分の大きさ
+PREFIX_BYTES = 64 * 1024
+
+# 一度に読み込む行数
+CHUNK_ROWS = 50_000
+
+# 列の型（世帯数は「1,058」のようなカンマ区切りがあるので文字列で読み、後で整数に変換する）
+CSV_DTYPES = {
+    '住所（スプレッドシート用）': str,
+    'Latitude': 'float64',
+    'Longitude': 'float64',
+    '世帯数': str,
+}
+
+# chardet の判定結果を、より多くの文字を含む上位互換の文字コードに読み替える
+ENCODING_ALIASES = {
+    'shift_jis': 'cp932',
+    'ascii': 'utf-8',
+}
+
+
+def sniff_encoding(stream, prefix_bytes=PREFIX_BYTES):
+    """ファイル先頭の一部だけを見て文字コードを推定する（読み取り位置は先頭に戻す）"""
+    position = stream.tell()
+    prefix = stream.read(prefix_bytes)
+    stream.seek(position)
+
+    if prefix.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # 末尾で文字が途中で切れていても UTF-8 と判定できるように逐次デコードする
+        codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    encoding = (chardet.detect(prefix)['encoding'] or 'cp932').lower().replace('-', '_')
+    return ENCODING_ALIASES.get(encoding, encoding)
+
+
+def iter_csv_chunks(stream, chunk_rows=CHUNK_ROWS):
+    """CSVを chunk_rows 行ずつ読み込み、(データフレーム, 読込み済みの割合) を順に返す"""
+    stream.seek(0, io.SEEK_END)
+    size = max(stream.tell(), 1)
+    stream.seek(0)
+    encoding = sniff_encoding(stream)
+
+    text = io.TextIOWrapper(stream, encoding=encoding, errors='replace', newline='')
+    try:
+        reader = pd.read_csv(text, chunksize=chunk_rows, dtype=CSV_DTYPES)
+        for chunk in reader:
+            yield chunk, min(stream.tell() / size, 1.0)
+    finally:
+        # アップロードされたファイルを閉じないように切り離す
+        text.detach()
+
+
+def iter_excel_chunks(stream, chunk_rows=CHUNK_ROWS):
+    """Excel（先頭のシート）を1行ずつ読み、chunk_rows 行ごとに (データフレーム, 読込み済みの割合) を返す"""
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        total = sheet.max_row or 0
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(name) if name is not None else '' for name in header]
+
+        buffer = []
+        done = 1
+        for row in rows:
+            buffer.append(row)
+            done += 1
+            if len(buffer) >= chunk_rows:
+                yield pd.DataFrame(buffer, columns=columns), min(done / total, 1.0) if total else 0.0
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=columns), 1.0
+    finally:
+        workbook.close()
+
+
+def iter_upload_chunks(uploaded_file, chunk_rows=CHUNK_ROWS):
+    """アップロードされたCSV/Excelを分割して読み込む（ファイル全体のコピーを作らない）"""
+    if uploaded_file.name.lower().endswith('.xlsx'):
+        return iter_excel_chunks(uploaded_file, chunk_rows)
+    return iter_csv_chunks(uploaded_file, chunk_rows)
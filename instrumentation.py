@@ -0,0 +1,180 @@
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+# 区間ごとに保持する計測値の数（セッションごとのパーセンタイルの計算に使う）
+HISTORY_SIZE = 200
+
+# 計測結果のJSONログの出力先を指定する環境変数（ファイル名、'-' なら標準エラー）
+LOG_ENV = 'APP_PERF_LOG'
+
+logger = logging.getLogger('household_map.perf')
+
+# 実行中の処理の計測先（スクリプトの実行スレッドごと）
+_current = contextvars.ContextVar('perf_recorder', default=None)
+
+
+def configure_logging(destination=None):
+    """計測結果のログを1行1件のJSONで書き出すようにする（何度呼んでも出力先は1つ）
+
+    destination を省略すると環境変数 APP_PERF_LOG を使い、どちらもなければ何もしない
+    """
+    destination = destination or os.environ.get(LOG_ENV)
+    if not destination or logger.handlers:
+        return
+    handler = logging.StreamHandler(sys.stderr) if destination == '-' else logging.FileHandler(destination, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def _summary(values):
+    values = np.asarray(values, dtype=np.float64)
+    return {
+        'count': len(values),
+        'p50_ms': round(float(np.percentile(values, 50)), 2),
+        'p95_ms': round(float(np.percentile(values, 95)), 2),
+        'max_ms': round(float(values.max()), 2),
+    }
+
+
+class PerfRecorder:
+    """セッションごとの処理時間の計測
+
+    再実行（rerun）ごとに区間の時間と件数を記録し、区間ごとの直近 HISTORY_SIZE 回の値を保持する
+    """
+
+    def __init__(self, history_size=HISTORY_SIZE):
+        self.session_id = uuid.uuid4().hex[:8]
+        self.reruns = 0
+        self.spans = []
+        self.counters = {}
+        self.history = defaultdict(lambda: deque(maxlen=history_size))
+        self._depth = 0
+        self._started = None
+        self._lock = threading.Lock()
+
+    def start_rerun(self):
+        """再実行の計測を始める（前回の計測が終わっていなければ捨てる）"""
+        self.reruns += 1
+        self.spans = []
+        self.counters = {}
+        self._depth = 0
+        self._started = time.perf_counter()
+        _current.set(self)
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._started) * 1000 if self._started is not None else 0.0
+
+    def finish_rerun(self):
+        """再実行の計測を終え、結果をログに書き出す"""
+        if self._started is None:
+            return
+        total_ms = self.elapsed_ms()
+        with self._lock:
+            self.history['rerun'].append(total_ms)
+        self._log('rerun', total_ms, spans=self.span_totals(), counters=dict(self.counters),
+                  percentiles=self.percentiles())
+        self._started = None
+        _current.set(None)
+
+    @contextmanager
+    def span(self, name):
+        """with ブロックの処理時間を name の区間として記録する"""
+        entry = None
+        with self._lock:
+            if self._started is not None:
+                # 開始順に並ぶように先に登録し、終わった時に時間を入れる
+                entry = [name, self._depth, 0.0]
+                self.spans.append(entry)
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self._depth -= 1
+            with self._lock:
+                self.history[name].append(elapsed_ms)
+            if entry is not None:
+                entry[2] = elapsed_ms
+            else:
+                # ダウンロードのように再実行の外で動く処理は1件ずつ書き出す
+                self._log('span', elapsed_ms, span=name)
+
+    def increment(self, name, n=1):
+        """name の件数に n を加える"""
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def span_totals(self):
+        """この再実行の区間ごとの合計時間（ms）"""
+        totals = {}
+        for name, _, elapsed_ms in self.spans:
+            totals[name] = round(totals.get(name, 0.0) + elapsed_ms, 2)
+        return totals
+
+    def percentiles(self):
+        """区間ごとの直近の計測値の回数・中央値・p95・最大（ms）"""
+        with self._lock:
+            return {name: _summary(values) for name, values in self.history.items() if values}
+
+    def spans_frame(self):
+        """この再実行の区間の一覧（開始順、入れ子は字下げ）"""
+        return pd.DataFrame({
+            '区間': ['　' * depth + name for name, depth, _ in self.spans],
+            '時間(ms)': [round(elapsed_ms, 2) for _, _, elapsed_ms in self.spans],
+        })
+
+    def percentiles_frame(self):
+        """このセッションの区間ごとのパーセンタイルの表"""
+        rows = [{'区間': name, '回数': stats['count'], '中央値(ms)': stats['p50_ms'],
+                 'p95(ms)': stats['p95_ms'], '最大(ms)': stats['max_ms']}
+                for name, stats in sorted(self.percentiles().items())]
+        return pd.DataFrame(rows, columns=['区間', '回数', '中央値(ms)', 'p95(ms)', '最大(ms)'])
+
+    def _log(self, event, elapsed_ms, **fields):
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        record = {
+            'event': event,
+            'time': round(time.time(), 3),
+            'session': self.session_id,
+            'rerun': self.reruns,
+            'elapsed_ms': round(elapsed_ms, 2),
+        }
+        record.update(fields)
+        logger.info(json.dumps(record, ensure_ascii=False))
+
+
+def current():
+    """実行中の処理の計測先（計測していなければ None）"""
+    return _current.get()
+
+
+@contextmanager
+def span(name):
+    """実行中の計測先があれば、with ブロックの処理時間を name の区間として記録する"""
+    recorder = _current.get()
+    if recorder is None:
+        yield
+        return
+    with recorder.span(name):
+        yield
+
+
+def increment(name, n=1):
+    """実行中の計測先があれば name の件数に n を加える"""
+    recorder = _current.get()
+    if recorder is not None:
+        recorder.increment(name, n)
@@ -1,34 +1,16 @@
-import pandas as pd
-import folium
 import os
+import sys
 
-# CSVファイルを読み込み
-df = pd.read_csv('加古川市住所データ.csv')
+from batch_cli import run_jobs
 
-# CSVの中身を確認（任意）
-print(df.head())
+# 市の全町名の地図をHTMLで作成する（一括作成ツール batch_cli.py の1ジョブとして実行）
+# 使い方: python map_create.py [市名] [出力先フォルダ]
+city = sys.argv[1] if len(sys.argv) > 1 else '加古川市'
+out_dir = sys.argv[2] if len(sys.argv) > 2 else os.path.expanduser('~/Desktop')
 
-# 地図の中心を設定
-map_center = [df.iloc[0]['Latitude'], df.iloc[0]['Longitude']]
+job = {'name': f'{city}_世帯数マップ', 'type': 'area', 'city': city, 'unit_price': 5.0, 'outputs': ['html']}
+results = run_jobs([job], out_dir, workers=1)
 
-# 地図を作成
-m = folium.Map(location=map_center, zoom_start=13)
-
-# CSVデータをもとに地図に表示
-for idx, row in df.iterrows():
-    town = row['住所（スプレッドシート用）']
-    households = row['世帯数']
-    lat = row['Latitude']
-    lon = row['Longitude']
-
-    folium.Marker(
-        location=[lat, lon],
-        popup=f"{town}: {households}世帯",
-        icon=folium.Icon(icon='home', color='blue')
-    ).add_to(m)
-
-# 強制的に絶対パスでHTMLとして保存（必ずファイルが作られます）
-save_path = os.path.expanduser('~/Desktop/kakogawa_seitai_map.html')
-m.save(save_path)
-
-print(f"地図を作成しました。保存場所: {save_path}")
+if results['エラー'].iloc[0]:
+    sys.exit(f"地図を作成できませんでした: {results['エラー'].iloc[0]}")
+print(f"地図を作成しました。保存場所: {os.path.join(out_dir, results['出力'].iloc[0])}")
@@ -0,0 +1,182 @@
+import folium
+import numpy as np
+from branca.element import MacroElement
+from jinja2 import Template
+
+from instrumentation import increment, span
+
+# これを超える件数はアイコンのマーカーをやめ、1つのGeoJSONレイヤーで描画する
+MARKER_THRESHOLD = 200
+
+# これを超える件数は、縮小した地図では町のマーカーの代わりに格子ごとの世帯数で色分けする
+DENSITY_THRESHOLD = 1000
+
+# 格子の色分けを表示する最大のズームレベル（これより拡大すると町のマーカーを表示する）
+DENSITY_MAX_ZOOM = 12
+
+# 格子の色分けの色（世帯数の少ない順、YlOrRd の6段階）
+DENSITY_COLORS = ['#ffffb2', '#fed976', '#feb24c', '#fd8d3c', '#f03b20', '#bd0026']
+
+# folium のアイコン色とそろえた円マーカーの色
+CIRCLE_MARKER_COLORS = {
+    'green': '#72b026',
+    'blue': '#38aadd',
+    'red': '#d63e2a',
+}
+
+
+def towns_geojson(towns, households, lat, lon):
+    """町名・世帯数・座標の配列から GeoJSON（FeatureCollection）を作る"""
+    lat = np.round(np.asarray(lat, dtype=np.float64), 6).tolist()
+    lon = np.round(np.asarray(lon, dtype=np.float64), 6).tolist()
+    households = np.asarray(households).tolist()
+    features = [
+        {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [x, y]},
+            'properties': {'label': f"{town}:{count}世帯"},
+        }
+        for town, count, y, x in zip(towns, households, lat, lon)
+    ]
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def town_layer(df, color, name='町名'):
+    """件数が多い場合の町マーカー（Canvas描画の円マーカー1レイヤー）"""
+    fill = CIRCLE_MARKER_COLORS.get(color, color)
+    return folium.GeoJson(
+        towns_geojson(df['住所（スプレッドシート用）'], df['世帯数'], df['Latitude'], df['Longitude']),
+        name=name,
+        marker=folium.CircleMarker(radius=5, weight=1, color='#ffffff', fill=True, fill_color=fill, fill_opacity=0.9),
+        popup=folium.GeoJsonPopup(fields=['label'], labels=False),
+        tooltip=folium.GeoJsonTooltip(fields=['label'], labels=False),
+        embed=True,
+    )
+
+
+class ZoomRange(MacroElement):
+    """レイヤーをズームレベルが min_zoom〜max_zoom の時だけ地図に表示する（ブラウザ側で切り替える）"""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var layer = {{ this.layer.get_name() }};
+            function update() {
+                var zoom = map.getZoom();
+                var show = zoom >= {{ this.min_zoom }} && zoom <= {{ this.max_zoom }};
+                if (show && !map.hasLayer(layer)) { map.addLayer(layer); }
+                if (!show && map.hasLayer(layer)) { map.removeLayer(layer); }
+            }
+            map.on('zoomend', update);
+            update();
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, layer, min_zoom=None, max_zoom=None):
+        super().__init__()
+        self._name = 'ZoomRange'
+        self.layer = layer
+        self.min_zoom = 0 if min_zoom is None else min_zoom
+        self.max_zoom = 99 if max_zoom is None else max_zoom
+
+
+def cells_geojson(cells):
+    """格子の表（AggregationPyramid.cells）から、世帯数で色分けした正方形の GeoJSON を作る
+
+    色の区切りは表示する格子の世帯数の分位点（格子の大きさによらず同じように色が分かれる）
+    """
+    households = cells['households'].to_numpy()
+    breaks = np.quantile(households, np.linspace(0, 1, len(DENSITY_COLORS) + 1)[1:-1]) if len(households) else []
+    classes = np.searchsorted(breaks, households, side='right')
+    lat0 = np.round(cells['lat'].to_numpy(), 6)
+    lon0 = np.round(cells['lon'].to_numpy(), 6)
+    lat1 = np.round(lat0 + cells['size'].to_numpy(), 6)
+    lon1 = np.round(lon0 + cells['size'].to_numpy(), 6)
+    features = [
+        {
+            'type': 'Feature',
+            'id': str(i),
+            'geometry': {'type': 'Polygon', 'coordinates': [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]]},
+            'properties': {'households': count, 'rows': rows, 'class': k},
+        }
+        for i, (y0, x0, y1, x1, count, rows, k) in enumerate(zip(
+            lat0.tolist(), lon0.tolist(), lat1.tolist(), lon1.tolist(),
+            households.tolist(), cells['rows'].tolist(), classes.tolist()))
+    ]
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def add_density_layers(m, pyramid, ids=None, max_zoom=DENSITY_MAX_ZOOM, interactive=True):
+    """格子ごとの世帯数の色分けを地図に追加する
+
+    ズームレベルごとに見やすい大きさの格子の段を選び、段ごとに1レイヤーにしてズームに合わせて切り替える。
+    ids（行IDの配列）を渡すとその行だけを集計する。max_zoom より拡大した地図には表示しない。
+    interactive=False なら世帯数の表示（ツールチップ）を付けず、マウス操作を下の地図に通す（描画用の地図向け）
+    """
+    with span('density'):
+        zoom_ranges = {}
+        for zoom in range(max_zoom + 1):
+            level = pyramid.level_for_zoom(zoom)
+            low, _ = zoom_ranges.get(level, (zoom, zoom))
+            zoom_ranges[level] = (low, zoom)
+
+        for level, (low, high) in sorted(zoom_ranges.items()):
+            cells = pyramid.cells(level, ids)
+            increment('density_cells', len(cells))
+            if cells.empty:
+                continue
+            layer = folium.GeoJson(
+                cells_geojson(cells),
+                name=f"世帯数の分布（{pyramid.levels[level].cell_deg:g}度の格子）",
+                style_function=lambda feature: {
+                    'fillColor': DENSITY_COLORS[feature['properties']['class']], 'color': '#666666',
+                    'weight': 0.5, 'fillOpacity': 0.55,
+                },
+                tooltip=folium.GeoJsonTooltip(fields=['households', 'rows'], aliases=['世帯数', '件数'], localize=True)
+                if interactive else None,
+                control=False,
+                embed=True,
+                interactive=interactive,
+            ).add_to(m)
+            ZoomRange(layer, low, high).add_to(m)
+
+
+def selection_layer(df, color, name='選択した町名'):
+    """町のマーカーだけを載せたレイヤー（st_folium の feature_group_to_add に渡す）
+
+    件数によらずGeoJSONの円マーカー1つにまとめる。出力に要素ごとの乱数のIDが入らないので、
+    同じ町なら同じJavaScriptになり、ブラウザ側でレイヤーを作り直さない
+    """
+    layer = folium.FeatureGroup(name=name)
+    add_town_markers(layer, df, color, threshold=0)
+    return layer
+
+
+def add_town_markers(m, df, color, icon='home', threshold=MARKER_THRESHOLD, pyramid=None, ids=None):
+    """町のマーカーを地図に追加する
+
+    threshold 件以下なら従来どおりアイコンのマーカー、超える場合はGeoJSONの円マーカーで描画する。
+    pyramid（格子ごとの世帯数）と ids（df の行ID）を渡すと、DENSITY_THRESHOLD 件を超える場合は
+    縮小した地図では格子の色分けを表示し、マーカーは拡大した時だけ表示する
+    """
+    if pyramid is not None and len(df) > DENSITY_THRESHOLD:
+        add_density_layers(m, pyramid, ids)
+        group = folium.FeatureGroup(name='町名', control=False).add_to(m)
+        ZoomRange(group, min_zoom=DENSITY_MAX_ZOOM + 1).add_to(m)
+        m = group
+
+    with span('markers'):
+        df = df.dropna(subset=['Latitude', 'Longitude'])
+        increment('markers_emitted', len(df))
+        if len(df) > threshold:
+            town_layer(df, color).add_to(m)
+            return
+
+        for town, households, lat, lon in zip(df['住所（スプレッドシート用）'], df['世帯数'], df['Latitude'], df['Longitude']):
+            folium.Marker(
+                [lat, lon],
+                popup=f"{town}:{households}世帯",
+                icon=folium.Icon(color=color, icon=icon)
+            ).add_to(m)
@@ -0,0 +1,93 @@
+import hashlib
+import json
+
+import numpy as np
+
+
+def _rings(coordinates):
+    """GeoJSON の Polygon の座標を (経度, 緯度) の配列のリストにする（先頭が外周、残りが穴）"""
+    rings = []
+    for ring in coordinates:
+        ring = np.asarray(ring, dtype=np.float64)[:, :2]
+        if len(ring) >= 3:
+            rings.append(ring)
+    return rings
+
+
+def parse_geojson(geojson):
+    """GeoJSON（文字列・バイト列・辞書）から多角形のリストを取り出す
+
+    FeatureCollection / Feature / GeometryCollection / Polygon / MultiPolygon に対応し、
+    点や線は無視する。多角形が1つもなければ ValueError
+    """
+    if isinstance(geojson, bytes):
+        geojson = geojson.decode('utf-8-sig')
+    if isinstance(geojson, str):
+        geojson = json.loads(geojson)
+
+    polygons = []
+    stack = [geojson]
+    while stack:
+        obj = stack.pop()
+        if not isinstance(obj, dict):
+            continue
+        kind = obj.get('type')
+        if kind == 'FeatureCollection':
+            stack.extend(reversed(obj.get('features') or []))
+        elif kind == 'Feature':
+            stack.append(obj.get('geometry'))
+        elif kind == 'GeometryCollection':
+            stack.extend(reversed(obj.get('geometries') or []))
+        elif kind == 'Polygon':
+            rings = _rings(obj.get('coordinates') or [])
+            if rings:
+                polygons.append(rings)
+        elif kind == 'MultiPolygon':
+            for coordinates in obj.get('coordinates') or []:
+                rings = _rings(coordinates)
+                if rings:
+                    polygons.append(rings)
+
+    if not polygons:
+        raise ValueError('GeoJSONに多角形（Polygon / MultiPolygon）が含まれていません')
+    return polygons
+
+
+def polygon_bounds(rings):
+    """多角形の外接矩形 (最小緯度, 最小経度, 最大緯度, 最大経度)"""
+    exterior = rings[0]
+    return exterior[:, 1].min(), exterior[:, 0].min(), exterior[:, 1].max(), exterior[:, 0].max()
+
+
+def points_in_polygon(lat, lon, rings):
+    """各点が多角形（穴あり）の内側にあるか（偶奇判定、点の配列についてベクトル化）"""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    inside = np.zeros(len(lat), dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for ring in rings:
+            x1, y1 = ring[:, 0], ring[:, 1]
+            x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+            for xa, ya, xb, yb in zip(x1, y1, x2, y2):
+                if ya == yb:
+                    continue
+                crosses = (ya > lat) != (yb > lat)
+                inside ^= crosses & (lon < (xb - xa) * (lat - ya) / (yb - ya) + xa)
+    return inside
+
+
+def polygons_geojson(polygons):
+    """多角形のリストを GeoJSON（MultiPolygon の Feature）に戻す（地図表示用）"""
+    return {
+        'type': 'Feature',
+        'properties': {},
+        'geometry': {
+            'type': 'MultiPolygon',
+            'coordinates': [[ring.tolist() for ring in rings] for rings in polygons],
+        },
+    }
+
+
+def polygons_key(polygons):
+    """多角形の組み合わせを表す短いキー（キャッシュやファイル名用）"""
+    return hashlib.sha1(json.dumps(polygons_geojson(polygons)).encode('utf-8')).hexdigest()[:12]
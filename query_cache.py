@@ -0,0 +1,73 @@
+import numpy as np
+
+from bounded_cache import BoundedLRU
+from search_index import normalize_text
+
+# キャッシュの上限（件数・合計バイト数）
+MAX_ENTRIES = 256
+MAX_BYTES = 128 * 1024 * 1024
+
+# 座標を丸める桁数（小数点以下7桁 ≒ 1cm）。同じ町を中心にした検索は同じキーになる
+COORDINATE_DIGITS = 7
+
+
+def _normalize(value):
+    """キーに使えるように値をそろえる（文字列は表記ゆれを統一し、配列・リストはタプルにする）"""
+    if isinstance(value, str):
+        return normalize_text(value).strip()
+    if isinstance(value, (float, np.floating)):
+        return round(float(value), COORDINATE_DIGITS)
+    if isinstance(value, (np.integer, np.bool_)):
+        return value.item()
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(_normalize(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_normalize(item) for item in value))
+    return value
+
+
+def query_key(kind, version, **params):
+    """検索の種類・データの版・条件から、キャッシュのキーを作る"""
+    return (kind, version) + tuple((name, _normalize(value)) for name, value in sorted(params.items()))
+
+
+def _nbytes(value):
+    """キャッシュする値のおおよそのバイト数"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return 64 + sum(_nbytes(item) for item in value)
+    if isinstance(value, str):
+        return 50 + len(value) * 4
+    return 32
+
+
+def _freeze(value):
+    """共有する配列を書き込み禁止にする（あるセッションでの書き換えが他のセッションに漏れないように）"""
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _freeze(item)
+
+
+class QueryCache(BoundedLRU):
+    """検索結果（行IDの配列・町名のリスト・合計など）を保持するLRUキャッシュ（プロセス内の全セッションで共有）
+
+    キーにデータの版を含めるので、アップロードや元CSVの更新でデータが変わると別のキーになる。
+    返す値は共有されるので、呼び出し側で書き換えないこと（配列は書き込み禁止にしてある）
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        super().__init__(max_entries, max_bytes, _nbytes, counter='query_cache')
+
+    def prepare(self, value):
+        _freeze(value)
+        return value
+
+    def discard(self, version):
+        """データの版が version の結果をすべて捨てる（そのデータがもう使われない時に呼ぶ）"""
+        return self.discard_if(lambda key: key[1] == version)
+
+
+query_cache = QueryCache()
@@ -0,0 +1,90 @@
+import numpy as np
+from geopy.distance import geodesic
+
+from geo_search import BOUNDARY_TOLERANCE
+from instrumentation import increment
+from spatial_index import haversine_km
+
+
+class RadiusSolver:
+    """中心点から近い順に町を並べ、世帯数の累積和から目標に届く半径を求める
+
+    並べ替えは中心点ごとに一度だけで、目標世帯数・予算を変えても二分探索だけで答えが出る。
+    境界付近の町だけ楕円体距離（geodesic）で測り直し、円形範囲の検索と同じ判定にそろえる。
+    """
+
+    def __init__(self, lat, lon, households, center_lat, center_lon):
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        valid = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+        self.center = (center_lat, center_lon)
+        self._lat = lat[valid]
+        self._lon = lon[valid]
+        self._ids = valid
+        self._households = np.asarray(households, dtype=np.int64)[valid]
+        self._distances = haversine_km(np.radians(self._lat), np.radians(self._lon), center_lat, center_lon)
+        self._refined = np.zeros(len(valid), dtype=bool)
+        self._sort()
+
+    def _sort(self):
+        self._order = np.argsort(self._distances, kind='stable')
+        self.distances = self._distances[self._order]
+        self.cumulative = np.cumsum(self._households[self._order])
+
+    def _refine(self, radius_km):
+        """radius_km 付近の町を geodesic で測り直す（測り直した町があれば True）"""
+        margin = radius_km * BOUNDARY_TOLERANCE
+        band = np.flatnonzero((np.abs(self._distances - radius_km) <= margin) & ~self._refined)
+        increment('geodesic', len(band))
+        for i in band:
+            self._distances[i] = geodesic(self.center, (self._lat[i], self._lon[i])).km
+        self._refined[band] = True
+        if len(band):
+            self._sort()
+        return len(band) > 0
+
+    @property
+    def total_households(self):
+        return int(self.cumulative[-1]) if len(self.cumulative) else 0
+
+    def _solve(self, count_fn):
+        count = count_fn()
+        while count and self._refine(self.distances[count - 1]):
+            count = count_fn()
+        return count
+
+    def for_households(self, target):
+        """target 世帯以上になる最小の半径で囲める町の数と半径（km）
+
+        全体で target に届かない場合は全町を返す
+        """
+        def count_fn():
+            count = int(np.searchsorted(self.cumulative, target, side='left')) + 1
+            count = min(count, len(self.cumulative))
+            # 同じ距離の町は半径で分けられないので全部含める
+            return int(np.searchsorted(self.distances, self.distances[count - 1], side='right')) if count else 0
+        return self._result(self._solve(count_fn))
+
+    def for_budget(self, budget, unit_price):
+        """予算（円）に収まる最大の半径で囲める町の数と半径（km）"""
+        max_households = budget / unit_price
+
+        def count_fn():
+            count = int(np.searchsorted(self.cumulative, max_households, side='right'))
+            # 同じ距離の町の一部だけが予算に収まる場合は、その距離の町をすべて外す
+            if 0 < count < len(self.distances) and self.distances[count] == self.distances[count - 1]:
+                count = int(np.searchsorted(self.distances, self.distances[count], side='left'))
+            return count
+        return self._result(self._solve(count_fn))
+
+    def _result(self, count):
+        radius_km = float(self.distances[count - 1]) if count else 0.0
+        return count, radius_km
+
+    def ids(self, count):
+        """近い順に count 町の行IDを昇順で返す"""
+        return np.sort(self._ids[self._order[:count]])
+
+    def households(self, count):
+        """近い順に count 町の合計世帯数"""
+        return int(self.cumulative[count - 1]) if count else 0
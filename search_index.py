@@ -0,0 +1,173 @@
+import unicodedata
+
+import numpy as np
+
+from instrumentation import increment
+from towns import ADDRESS_PATTERN
+
+# 地名の「ケ」「ヶ」は「が」と読むことが多い（松ケ丘・松ヶ丘・松が丘）ので、カタカナのうちにすべて「が」にする
+# 前後の文字を見ずに置き換えるので、検索語が「ケ丘」のように途中で切れていても住所と同じ表記になる
+GA_VARIANTS = str.maketrans({'ケ': 'が', 'ヶ': 'が'})
+
+# 小書きの仮名の表記ゆれを統一する（ひらがなに変換した後に適用）
+KANA_VARIANTS = str.maketrans({'ゖ': 'が', 'ゕ': 'か', 'ゎ': 'わ'})
+
+# 順位付けの重み（小さいほど上位）
+RANK_EXACT = 0
+RANK_TOWN_PREFIX = 1
+RANK_PARTIAL = 2
+
+
+def normalize_text(text):
+    """検索用に住所を正規化する
+
+    全角英数字→半角（１丁目→1丁目）、半角カナ→全角、カタカナ→ひらがな、
+    ヶ・ケ・がの表記ゆれをそろえる。
+    どの置き換えも1文字ずつで前後の文字を見ないので、住所の部分文字列を正規化すると
+    正規化した住所の部分文字列になる（元の表記で一致する住所は必ず検索で見つかる）。
+    漢数字はそのままにする（十二所前町・二階町のように地名の一部であることが多く、
+    「十二」→「12」のように前後を見て読み替えると部分文字列の一致が崩れる）
+    """
+    text = unicodedata.normalize('NFKC', str(text))
+    text = text.translate(GA_VARIANTS)
+    text = ''.join(chr(ord(c) - 0x60) if 'ァ' <= c <= 'ヶ' else c for c in text)
+    text = text.translate(KANA_VARIANTS)
+    return text.lower()
+
+
+# 2文字の組を1つの整数で表す時のずらし幅（Unicodeの最大値 0x10FFFF は21ビットに収まる）
+GRAM_SHIFT = 21
+
+
+def _gram_string(code):
+    """_postings の整数表現を文字列に戻す"""
+    if code < 1 << GRAM_SHIFT:
+        return chr(code)
+    return chr((code >> GRAM_SHIFT) - 1) + chr(code & ((1 << GRAM_SHIFT) - 1))
+
+
+def _postings(texts, start):
+    """住所ごとの1文字・2文字の部分文字列から転置リスト（文字列 → 文書IDの昇順配列）を作る
+
+    全住所を1つの文字コードの配列にして、部分文字列を整数に変換してからまとめて並べ替える
+    """
+    if not texts:
+        return {}
+    lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+    codes = np.frombuffer(''.join(texts).encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+    docs = np.repeat(np.arange(start, start + len(texts), dtype=np.int64), lengths)
+
+    # 同じ住所の中で隣り合う2文字だけを組にする（1文字と区別するため上位を1ずらす）
+    same = docs[:-1] == docs[1:]
+    pairs = ((codes[:-1][same] + 1) << GRAM_SHIFT) | codes[1:][same]
+    grams = np.concatenate([codes, pairs])
+    gram_docs = np.concatenate([docs, docs[:-1][same]])
+
+    # (部分文字列, 文書ID) の順に並べ、重複を除いて部分文字列ごとに分ける
+    order = np.lexsort((gram_docs, grams))
+    grams = grams[order]
+    gram_docs = gram_docs[order]
+    keep = np.ones(len(grams), dtype=bool)
+    keep[1:] = (grams[1:] != grams[:-1]) | (gram_docs[1:] != gram_docs[:-1])
+    grams = grams[keep]
+    gram_docs = gram_docs[keep]
+    boundaries = np.flatnonzero(grams[1:] != grams[:-1]) + 1
+    firsts = np.concatenate([[0], boundaries])
+    return {
+        _gram_string(int(code)): ids
+        for code, ids in zip(grams[firsts].tolist(), np.split(gram_docs, boundaries))
+    }
+
+
+def _town_start(text):
+    """住所のうち都道府県・市・区を除いた町名部分の開始位置"""
+    match = ADDRESS_PATTERN.match(text)
+    return match.end() if match else 0
+
+
+class AddressSearchIndex:
+    """住所の部分一致検索用の転置インデックス（1文字・2文字単位）
+
+    文書IDは追加順の通し番号（データフレームの行位置と一致させて使う）。
+    """
+
+    def __init__(self, addresses=()):
+        self.normalized = []
+        self.town_starts = []
+        self.postings = {}
+        self.append(addresses)
+
+    def __len__(self):
+        return len(self.normalized)
+
+    def append(self, addresses):
+        """住所を追加する（既存の転置リストには追加分だけを足す）"""
+        start = len(self.normalized)
+        # 同じ住所は正規化を1回だけにする
+        cache = {}
+        texts = []
+        for address in addresses:
+            entry = cache.get(address)
+            if entry is None:
+                text = normalize_text(address)
+                entry = cache[address] = (text, _town_start(text))
+            texts.append(entry[0])
+            self.town_starts.append(entry[1])
+        self.normalized.extend(texts)
+
+        for gram, ids in _postings(texts, start).items():
+            if gram in self.postings:
+                self.postings[gram] = np.concatenate([self.postings[gram], ids])
+            else:
+                self.postings[gram] = ids
+
+    def search(self, query):
+        """query を含む住所の (ID, 順位のスコア) を返す（スコアの小さい順）
+
+        空の検索語は何も返さない
+        """
+        query = normalize_text(query).strip()
+        if not query:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+        if len(query) == 1:
+            grams = [query]
+        else:
+            grams = list({query[i:i + 2] for i in range(len(query) - 1)})
+
+        # 短い転置リストから順に積集合をとる
+        lists = []
+        for gram in grams:
+            ids = self.postings.get(gram)
+            if ids is None:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+            lists.append(ids)
+        lists.sort(key=len)
+        candidates = lists[0]
+        for ids in lists[1:]:
+            if len(candidates) == 0:
+                break
+            candidates = np.intersect1d(candidates, ids, assume_unique=True)
+
+        # 2文字単位の一致だけでは連続しているとは限らないので実際の文字列で確認
+        increment('rows_scanned', len(candidates))
+        hits = []
+        scores = []
+        for doc in candidates.tolist():
+            text = self.normalized[doc]
+            position = text.find(query)
+            if position < 0:
+                continue
+            if text == query or text[self.town_starts[doc]:] == query:
+                rank = RANK_EXACT
+            elif position == self.town_starts[doc]:
+                rank = RANK_TOWN_PREFIX
+            else:
+                rank = RANK_PARTIAL
+            hits.append(doc)
+            scores.append(rank * 1e6 + position * 1e3 + len(text))
+
+        hits = np.asarray(hits, dtype=np.int64)
+        scores = np.asarray(scores, dtype=np.float64)
+        order = np.lexsort((hits, scores))
+        return hits[order], scores[order]
@@ -0,0 +1,52 @@
+# 町名リストの1ページに表示する件数の選択肢
+PAGE_SIZES = [50, 100, 200, 500]
+DEFAULT_PAGE_SIZE = 100
+
+
+class TownSelection:
+    """選択した町名の集合
+
+    一括の選択・解除・反転は集合演算で行い、町名の数に比例する時間で済むようにする
+    """
+
+    def __init__(self, towns=()):
+        self._towns = set(towns)
+
+    def __contains__(self, town):
+        return town in self._towns
+
+    def __len__(self):
+        return len(self._towns)
+
+    def __iter__(self):
+        return iter(self._towns)
+
+    def set(self, town, selected):
+        """1つの町名を選択（selected=False なら解除）する"""
+        if selected:
+            return self.select([town])
+        return self.deselect([town])
+
+    def select(self, towns):
+        """towns を選択に加え、新たに選択した件数を返す"""
+        before = len(self._towns)
+        self._towns.update(towns)
+        return len(self._towns) - before
+
+    def deselect(self, towns):
+        """towns を選択から外し、外した件数を返す"""
+        before = len(self._towns)
+        self._towns.difference_update(towns)
+        return before - len(self._towns)
+
+    def invert(self, towns):
+        """towns の選択状態を反転する（towns に含まれない選択はそのまま）"""
+        self._towns.symmetric_difference_update(set(towns))
+
+    def clear(self):
+        self._towns.clear()
+
+    def sorted(self):
+        """選択した町名を名前順のリストで返す"""
+        return sorted(self._towns)
+
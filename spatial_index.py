@@ -0,0 +1,139 @@
+import numpy as np
+
+from instrumentation import increment
+
+# 地球の平均半径（km）
+EARTH_RADIUS_KM = 6371.0088
+
+# グリッドのセルサイズ（度）。0.02度 ≒ 南北2.2km・東西1.8km（兵庫県付近）
+DEFAULT_CELL_DEG = 0.02
+
+# 緯度1度あたりの距離（km）
+KM_PER_DEG_LAT = np.pi * EARTH_RADIUS_KM / 180.0
+
+
+def haversine_km(lat_rad, lon_rad, center_lat, center_lon):
+    """中心点（度）から各点（ラジアン配列）までのハバーサイン距離をkmで返す"""
+    c_lat = np.radians(center_lat)
+    c_lon = np.radians(center_lon)
+    d_lat = lat_rad - c_lat
+    d_lon = lon_rad - c_lon
+    a = np.sin(d_lat / 2.0) ** 2 + np.cos(c_lat) * np.cos(lat_rad) * np.sin(d_lon / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GridIndex:
+    """緯度経度を等間隔のセルに振り分けるバケット型の空間インデックス
+
+    点のIDは追加順の通し番号（データフレームの行位置と一致させて使う）。
+    座標が欠損している点もIDだけは割り当て、セルには登録しない。
+    """
+
+    def __init__(self, cell_deg=DEFAULT_CELL_DEG):
+        self.cell_deg = cell_deg
+        self.cells = {}
+        self.lat = np.empty(0, dtype=np.float64)
+        self.lon = np.empty(0, dtype=np.float64)
+        self.lat_rad = np.empty(0, dtype=np.float64)
+        self.lon_rad = np.empty(0, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def _cell_of(self, lat, lon):
+        return (np.floor(np.asarray(lat) / self.cell_deg).astype(np.int64),
+                np.floor(np.asarray(lon) / self.cell_deg).astype(np.int64))
+
+    def append(self, lat, lon):
+        """点を追加し、割り当てたIDの配列を返す（既存のセルは作り直さない）"""
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        start = len(self.lat)
+        ids = np.arange(start, start + len(lat))
+
+        self.lat = np.concatenate([self.lat, lat])
+        self.lon = np.concatenate([self.lon, lon])
+        self.lat_rad = np.concatenate([self.lat_rad, np.radians(lat)])
+        self.lon_rad = np.concatenate([self.lon_rad, np.radians(lon)])
+
+        valid = ~(np.isnan(lat) | np.isnan(lon))
+        if not valid.any():
+            return ids
+
+        # 追加分だけをセルごとにまとめて登録
+        cell_lat, cell_lon = self._cell_of(lat[valid], lon[valid])
+        keys = np.stack([cell_lat, cell_lon], axis=1)
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(unique_keys) + 1))
+        valid_ids = ids[valid][order]
+        for k, (a, b) in enumerate(zip(bounds[:-1], bounds[1:])):
+            key = (int(unique_keys[k, 0]), int(unique_keys[k, 1]))
+            members = valid_ids[a:b]
+            if key in self.cells:
+                self.cells[key] = np.concatenate([self.cells[key], members])
+            else:
+                self.cells[key] = members
+        return ids
+
+    def _candidates(self, min_lat, min_lon, max_lat, max_lon):
+        """矩形に掛かるセルに属するIDを返す（矩形外の点も含む）"""
+        (lat0, lat1), (lon0, lon1) = self._cell_of([min_lat, max_lat], [min_lon, max_lon])
+        n_cells = (lat1 - lat0 + 1) * (lon1 - lon0 + 1)
+        if n_cells > len(self.cells):
+            # 広い矩形は登録済みのセルを走査したほうが速い
+            hits = [ids for (cy, cx), ids in self.cells.items()
+                    if lat0 <= cy <= lat1 and lon0 <= cx <= lon1]
+        else:
+            hits = [self.cells[(cy, cx)]
+                    for cy in range(lat0, lat1 + 1)
+                    for cx in range(lon0, lon1 + 1)
+                    if (cy, cx) in self.cells]
+        if not hits:
+            return np.empty(0, dtype=np.int64)
+        ids = np.concatenate(hits)
+        increment('rows_scanned', len(ids))
+        return ids
+
+    def query_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        """矩形内（境界を含む）の点のIDを昇順で返す"""
+        ids = self._candidates(min_lat, min_lon, max_lat, max_lon)
+        lat = self.lat[ids]
+        lon = self.lon[ids]
+        inside = (lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)
+        return np.sort(ids[inside])
+
+    def query_radius(self, center_lat, center_lon, radius_km):
+        """中心から radius_km 以内（ハバーサイン距離）の点のIDと距離をID昇順で返す"""
+        d_lat = radius_km / KM_PER_DEG_LAT
+        cos_lat = max(np.cos(np.radians(center_lat)), 1e-6)
+        d_lon = min(radius_km / (KM_PER_DEG_LAT * cos_lat), 180.0)
+        ids = np.sort(self._candidates(center_lat - d_lat, center_lon - d_lon,
+                                       center_lat + d_lat, center_lon + d_lon))
+        distances = haversine_km(self.lat_rad[ids], self.lon_rad[ids], center_lat, center_lon)
+        inside = distances <= radius_km
+        return ids[inside], distances[inside]
+
+    def nearest(self, center_lat, center_lon, k=1):
+        """中心に近い順に k 点のIDと距離を返す"""
+        if not self.cells or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+        # 候補が k 点集まるまでセルの輪を広げる
+        all_keys = np.array(list(self.cells.keys()))
+        max_ring = int(np.abs(all_keys - np.array(self._cell_of(center_lat, center_lon))).max())
+        ring = 0
+        while True:
+            half = (ring + 0.5) * self.cell_deg
+            ids = self._candidates(center_lat - half, center_lon - half,
+                                   center_lat + half, center_lon + half)
+            if len(ids) >= k or ring >= max_ring:
+                break
+            ring = max(1, ring * 2)
+
+        # k 番目の距離で半径検索し直せば取りこぼしがない
+        distances = haversine_km(self.lat_rad[ids], self.lon_rad[ids], center_lat, center_lon)
+        kth = np.partition(distances, min(k, len(distances)) - 1)[min(k, len(distances)) - 1]
+        ids, distances = self.query_radius(center_lat, center_lon, kth)
+        order = np.argsort(distances, kind='stable')[:k]
+        return ids[order], distances[order]
@@ -0,0 +1,184 @@
+import io
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from spatial_index import KM_PER_DEG_LAT
+
+# 画像の既定サイズ（px）
+DEFAULT_SIZE = (1200, 900)
+
+# 配色（folium のマーカーの色に合わせる）
+BACKGROUND_COLOR = (245, 243, 238)
+GRID_COLOR = (222, 219, 212)
+CONTEXT_COLOR = (190, 190, 190)
+CIRCLE_OUTLINE = (49, 135, 206)
+CIRCLE_FILL = (49, 135, 206, 28)
+MARKER_COLORS = {
+    'green': (114, 176, 38),
+    'blue': (56, 170, 221),
+    'red': (214, 62, 42),
+}
+
+# 範囲指定がない場合の最小表示幅（km）
+MIN_SPAN_KM = 1.0
+
+
+def _circle_polygon(center_lat, center_lon, radius_km, n=180):
+    """中心と半径から円周上の点（度）を求める（球面上の目的地計算）"""
+    lat1 = np.radians(center_lat)
+    lon1 = np.radians(center_lon)
+    angular = radius_km / (KM_PER_DEG_LAT * 180.0 / np.pi)
+    bearings = np.linspace(0.0, 2.0 * np.pi, n, endpoint=False)
+    lat2 = np.arcsin(np.sin(lat1) * np.cos(angular) + np.cos(lat1) * np.sin(angular) * np.cos(bearings))
+    lon2 = lon1 + np.arctan2(np.sin(bearings) * np.sin(angular) * np.cos(lat1),
+                             np.cos(angular) - np.sin(lat1) * np.sin(lat2))
+    return np.degrees(lat2), np.degrees(lon2)
+
+
+class _Projection:
+    """表示範囲の緯度経度を画像の座標に変換する（正距円筒図法、中心緯度で補正）"""
+
+    def __init__(self, min_lat, min_lon, max_lat, max_lon, size, padding=40):
+        width, height = size
+        self.cos_lat = np.cos(np.radians((min_lat + max_lat) / 2.0))
+        span_x = max((max_lon - min_lon) * self.cos_lat, 1e-9)
+        span_y = max(max_lat - min_lat, 1e-9)
+        self.scale = min((width - 2 * padding) / span_x, (height - 2 * padding) / span_y)
+        self.center_lat = (min_lat + max_lat) / 2.0
+        self.center_lon = (min_lon + max_lon) / 2.0
+        self.width = width
+        self.height = height
+
+    def __call__(self, lat, lon):
+        x = self.width / 2.0 + (np.asarray(lon) - self.center_lon) * self.cos_lat * self.scale
+        y = self.height / 2.0 - (np.asarray(lat) - self.center_lat) * self.scale
+        return x, y
+
+    def bounds(self):
+        half_lon = self.width / 2.0 / (self.cos_lat * self.scale)
+        half_lat = self.height / 2.0 / self.scale
+        return (self.center_lat - half_lat, self.center_lon - half_lon,
+                self.center_lat + half_lat, self.center_lon + half_lon)
+
+    def px_per_km(self):
+        return self.scale / KM_PER_DEG_LAT
+
+
+def _nice_step(value):
+    """1, 2, 5 × 10^n のうち value 以下で最大の値"""
+    exponent = np.floor(np.log10(value))
+    for factor in (5, 2, 1):
+        step = factor * 10 ** exponent
+        if step <= value:
+            return step
+    return 10 ** exponent
+
+
+def _draw_star(draw, x, y, r, color):
+    angles = np.pi / 2 + np.arange(10) * np.pi / 5
+    radii = np.where(np.arange(10) % 2 == 0, r, r * 0.45)
+    points = list(zip(x + radii * np.cos(angles), y - radii * np.sin(angles)))
+    draw.polygon(points, fill=color, outline=(255, 255, 255))
+
+
+def render_map_png(lat, lon, color='green', center=None, radius_km=None, star=None,
+                   context_lat=None, context_lon=None, polygons=None, size=DEFAULT_SIZE):
+    """町の座標から地図画像（PNG）を描画してバイト列で返す
+
+    lat, lon: 表示する町の座標の配列
+    center, radius_km: 円形範囲（中心の (緯度, 経度) と半径）
+    star: 基準点の (緯度, 経度)
+    context_lat, context_lon: 背景として薄く描く全町の座標
+    polygons: 多角形範囲（polygons.parse_geojson の戻り値）
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+
+    # 表示範囲を決める（円があれば円全体、なければ全マーカー）
+    extent_lat = [lat]
+    extent_lon = [lon]
+    if center is not None and radius_km:
+        circle_lat, circle_lon = _circle_polygon(center[0], center[1], radius_km)
+        extent_lat.append(circle_lat)
+        extent_lon.append(circle_lon)
+    for rings in polygons or ():
+        extent_lat.append(rings[0][:, 1])
+        extent_lon.append(rings[0][:, 0])
+    if star is not None:
+        extent_lat.append(np.array([star[0]]))
+        extent_lon.append(np.array([star[1]]))
+    all_lat = np.concatenate(extent_lat)
+    all_lon = np.concatenate(extent_lon)
+    if len(all_lat) == 0:
+        raise ValueError('描画する座標がありません')
+
+    min_lat, max_lat = all_lat.min(), all_lat.max()
+    min_lon, max_lon = all_lon.min(), all_lon.max()
+    half_span = MIN_SPAN_KM / KM_PER_DEG_LAT / 2.0
+    mid_lat, mid_lon = (min_lat + max_lat) / 2.0, (min_lon + max_lon) / 2.0
+    min_lat, max_lat = min(min_lat, mid_lat - half_span), max(max_lat, mid_lat + half_span)
+    min_lon, max_lon = min(min_lon, mid_lon - half_span), max(max_lon, mid_lon + half_span)
+    project = _Projection(min_lat, min_lon, max_lat, max_lon, size)
+
+    image = Image.new('RGB', size, BACKGROUND_COLOR)
+    draw = ImageDraw.Draw(image, 'RGBA')
+    view = project.bounds()
+
+    # 経緯線
+    grid = _nice_step((view[2] - view[0]) / 6.0)
+    for g in np.arange(np.ceil(view[0] / grid) * grid, view[2], grid):
+        _, y = project(g, 0.0)
+        draw.line([(0, y), (size[0], y)], fill=GRID_COLOR)
+    for g in np.arange(np.ceil(view[1] / grid) * grid, view[3], grid):
+        x, _ = project(0.0, g)
+        draw.line([(x, 0), (x, size[1])], fill=GRID_COLOR)
+
+    # 背景の町（表示範囲内だけ）
+    if context_lat is not None and context_lon is not None:
+        context_lat = np.asarray(context_lat, dtype=np.float64)
+        context_lon = np.asarray(context_lon, dtype=np.float64)
+        visible = ((context_lat >= view[0]) & (context_lat <= view[2]) &
+                   (context_lon >= view[1]) & (context_lon <= view[3]))
+        xs, ys = project(context_lat[visible], context_lon[visible])
+        for x, y in zip(xs, ys):
+            draw.ellipse([x - 2, y - 2, x + 2, y + 2], fill=CONTEXT_COLOR)
+
+    # 円形範囲
+    if center is not None and radius_km:
+        xs, ys = project(circle_lat, circle_lon)
+        draw.polygon(list(zip(xs, ys)), fill=CIRCLE_FILL, outline=CIRCLE_OUTLINE, width=3)
+
+    # 多角形範囲（穴は背景色で塗り戻す）
+    for rings in polygons or ():
+        for i, ring in enumerate(rings):
+            xs, ys = project(ring[:, 1], ring[:, 0])
+            fill = CIRCLE_FILL if i == 0 else BACKGROUND_COLOR + (255,)
+            draw.polygon(list(zip(xs, ys)), fill=fill, outline=CIRCLE_OUTLINE, width=3)
+
+    # 町のマーカー
+    fill = MARKER_COLORS.get(color, MARKER_COLORS['green'])
+    xs, ys = project(lat, lon)
+    for x, y in zip(xs, ys):
+        draw.ellipse([x - 6, y - 6, x + 6, y + 6], fill=fill, outline=(255, 255, 255), width=2)
+
+    # 基準点（星）
+    if star is not None:
+        x, y = project(star[0], star[1])
+        _draw_star(draw, float(x), float(y), 16, MARKER_COLORS['red'])
+
+    # 縮尺
+    font = ImageFont.load_default()
+    scale_km = _nice_step(size[0] / 5.0 / project.px_per_km())
+    bar = scale_km * project.px_per_km()
+    x0, y0 = 30, size[1] - 30
+    draw.rectangle([x0 - 8, y0 - 24, x0 + bar + 8, y0 + 8], fill=(255, 255, 255, 200))
+    draw.line([(x0, y0), (x0 + bar, y0)], fill=(60, 60, 60), width=3)
+    draw.line([(x0, y0 - 6), (x0, y0)], fill=(60, 60, 60), width=2)
+    draw.line([(x0 + bar, y0 - 6), (x0 + bar, y0)], fill=(60, 60, 60), width=2)
+    label = f"{scale_km:g} km" if scale_km >= 1 else f"{scale_km * 1000:g} m"
+    draw.text((x0, y0 - 20), label, fill=(60, 60, 60), font=font)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', optimize=False)
+    return buffer.getvalue()
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from bounded_cache import BoundedLRU
+from exports import ExportCache
+from query_cache import QueryCache, query_key
+
+
+def test_evicts_least_recently_used_by_count_and_bytes():
+    cache = BoundedLRU(max_entries=3, max_bytes=10, sizeof=len)
+    for key in 'abc':
+        cache.get_or_compute(key, lambda: b'xx')
+    cache.get_or_compute('a', lambda: pytest.fail('a はキャッシュにあるはず'))
+    cache.get_or_compute('d', lambda: b'xx')
+    assert list(cache._entries) == ['c', 'a', 'd']
+
+    # 上限を超える大きさでも直前に追加した1件は残す
+    cache.get_or_compute('e', lambda: b'x' * 20)
+    assert list(cache._entries) == ['e']
+    assert cache.nbytes == 20
+    assert cache.stats()['hits'] == 1
+
+
+def test_query_and_export_caches_share_the_helper():
+    queries = QueryCache(max_entries=8)
+    ids = queries.get_or_compute(query_key('radius', 'v1', lat=34.7), lambda: np.arange(3))
+    assert not ids.flags.writeable
+    queries.get_or_compute(query_key('radius', 'v2', lat=34.7), lambda: np.arange(3))
+    assert queries.discard('v1') == 1
+    assert len(queries) == 1
+
+    exports = ExportCache(max_bytes=5)
+    assert exports.get_or_build('a', lambda: b'abc') == b'abc'
+    exports.get_or_build('b', lambda: b'abc')
+    assert len(exports) == 1
+    assert exports.nbytes == 3
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import dataset
+from dataset import SessionDataset, SharedDataset, load_dataset, normalize_source
+
+UPLOAD_COLUMNS = ['住所（スプレッドシート用）', 'Latitude', 'Longitude', '世帯数']
+
+
+@pytest.fixture(scope='module')
+def shared():
+    df, errors = load_dataset()
+    assert not errors
+    return SharedDataset(df)
+
+
+def _upload_chunks(shared, n_chunks=3, rows=50):
+    """基本データの地点を少しずらした（新しい地点の）行と、既存の地点の世帯数を変えた行を含むチャンク"""
+    chunks = []
+    for k in range(n_chunks):
+        chunk = shared.df[UPLOAD_COLUMNS].iloc[k * rows:(k + 1) * rows].copy()
+        chunk['Latitude'] = chunk['Latitude'] + 0.0001 * (k + 1)
+        updated = shared.df[UPLOAD_COLUMNS].iloc[[1000 + k]].copy()
+        updated['世帯数'] = updated['世帯数'] + 7
+        chunks.append(pd.concat([chunk, updated]))
+    return chunks
+
+
+def _failing(chunks, fail_at):
+    for i, chunk in enumerate(chunks):
+        if i == fail_at:
+            raise ValueError('読込み中のエラー')
+        yield chunk
+
+
+@pytest.mark.parametrize('fail_at', [1, 2])
+def test_failed_upload_leaves_session_unchanged_and_can_be_retried(shared, fail_at):
+    data = SessionDataset(shared)
+    chunks = _upload_chunks(shared)
+
+    with pytest.raises(ValueError):
+        data.append_chunks(_failing(chunks, fail_at))
+    assert len(data) == len(shared)
+    assert data.overlay_keys == {}
+    assert data.base_households is None
+    assert data.revision == 0
+
+    added, updated = data.append_chunks(chunks)
+    assert added == sum(len(chunk) - 1 for chunk in chunks)
+    assert updated == len(chunks)
+    assert len(data) == len(shared) + added
+    assert sorted(data.overlay_keys.values()) == list(range(len(shared), len(data)))
+    np.testing.assert_array_equal(data.take(np.arange(len(shared), len(data)))['世帯数'].to_numpy(),
+                                  np.concatenate([chunk['世帯数'].to_numpy()[:-1] for chunk in chunks]))
+
+    # 同じファイルをもう一度読み込んでも増えない
+    assert data.append_chunks(chunks) == (0, 0)
+
+
+def test_empty_addresses_stay_empty_strings():
+    df = normalize_source(pd.DataFrame({
+        '住所（スプレッドシート用）': pd.Series([np.nan, None, '兵庫県明石市'], dtype=object),
+        'Latitude': [None, None, 34.6], 'Longitude': [None, None, 135.0], '世帯数': ['1', '2', '3'],
+    }))
+    assert df['住所（スプレッドシート用）'].tolist() == ['', '', '兵庫県明石市']
+
+
+def test_replaced_files_follow_umask(tmp_path):
+    path = tmp_path / 'towns.feather'
+    dataset._replace_file(str(path), lambda temp_path: open(temp_path, 'wb').close())
+    assert path.stat().st_mode & 0o777 == 0o666 & ~dataset.UMASK
+    assert [p.name for p in tmp_path.iterdir()] == ['towns.feather']
+
+
+def test_take_keeps_the_order_of_ids(shared):
+    data = SessionDataset(shared)
+    upload = shared.df[UPLOAD_COLUMNS].iloc[:3].copy()
+    upload['住所（スプレッドシート用）'] = ['兵庫県明石市新町', '兵庫県明石市新町北', '兵庫県明石市本新町']
+    data.append_chunks([upload])
+    n_base = len(shared)
+
+    ids = np.array([n_base + 1, 5, n_base, 2, n_base + 2])
+    rows = data.take(ids)
+    expected = [data.take([row_id])['住所（スプレッドシート用）'].iat[0] for row_id in ids]
+    assert rows['住所（スプレッドシート用）'].tolist() == expected
+
+    # 差分の行が完全に一致する場合は、基本データの部分一致より前に並ぶ
+    matched = data.take(data.search('兵庫県明石市新町'))
+    assert matched['住所（スプレッドシート用）'].iat[0] == '兵庫県明石市新町'
@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import pytest
+from geopy.distance import geodesic
+
+from dataset import load_dataset
+from geo_search import RadiusSearcher, batch_radius_query, bearings_deg, direction_mask, sector_mask
+from spatial_index import GridIndex, haversine_km
+
+# 加古川駅・姫路駅・明石駅付近と、データの範囲外（海上）
+CENTERS = [(34.7569, 134.8414, 3.0), (34.8268, 134.6906, 5.0), (34.6491, 134.9929, 1.5), (34.30, 135.50, 2.0)]
+
+# 基準点と、そこから北・東・南・西・北東・北西に約1km離れた点、座標の欠損
+BASE = (34.75, 134.85)
+POINTS = pd.DataFrame({
+    'Latitude': [34.759, 34.75, 34.741, 34.75, 34.7564, 34.7564, np.nan],
+    'Longitude': [134.85, 134.861, 134.85, 134.839, 134.8578, 134.8422, 134.85],
+})
+
+
+@pytest.fixture(scope='module')
+def df():
+    df, errors = load_dataset()
+    assert not errors
+    return df
+
+
+@pytest.fixture(scope='module')
+def searcher(df):
+    return RadiusSearcher(df)
+
+
+def _coordinates(df):
+    return df['Latitude'].to_numpy(dtype=np.float64), df['Longitude'].to_numpy(dtype=np.float64)
+
+
+def test_grid_index_matches_brute_force():
+    rng = np.random.default_rng(0)
+    lat = rng.uniform(34.6, 34.9, 2000)
+    lon = rng.uniform(134.6, 135.0, 2000)
+    lat[::50] = np.nan
+    index = GridIndex()
+    index.append(lat[:1500], lon[:1500])
+    assert list(index.append(lat[1500:], lon[1500:])) == list(range(1500, 2000))
+
+    distances = haversine_km(np.radians(lat), np.radians(lon), 34.75, 134.8)
+    ids, found = index.query_radius(34.75, 134.8, 4.0)
+    assert list(ids) == list(np.flatnonzero(distances <= 4.0))
+    np.testing.assert_allclose(found, distances[ids])
+
+    ids, found = index.nearest(34.75, 134.8, k=5)
+    assert list(ids) == list(np.argsort(np.nan_to_num(distances, nan=np.inf), kind='stable')[:5])
+
+    inside = (lat >= 34.7) & (lat <= 34.8) & (lon >= 134.7) & (lon <= 134.9)
+    assert list(index.query_bbox(34.7, 134.7, 34.8, 134.9)) == list(np.flatnonzero(inside))
+
+
+@pytest.mark.parametrize('center_lat, center_lon, radius_km', CENTERS)
+def test_radius_query_matches_geodesic(df, searcher, center_lat, center_lon, radius_km):
+    lat, lon = _coordinates(df)
+    # 楕円体距離で全件を測った結果と一致する（境界付近の判定し直しで取りこぼさない）
+    rough = np.flatnonzero(haversine_km(np.radians(lat), np.radians(lon), center_lat, center_lon) <= radius_km * 1.01)
+    expected = [i for i in rough if geodesic((center_lat, center_lon), (lat[i], lon[i])).km <= radius_km]
+    assert list(searcher.query(center_lat, center_lon, radius_km)) == expected
+
+
+@pytest.mark.parametrize('exact', [True, False])
+def test_batch_matches_single_queries(df, searcher, exact):
+    lat, lon = _coordinates(df)
+    centers_lat, centers_lon, radii = map(list, zip(*CENTERS))
+    # 距離行列を細かく分割しても結果は変わらない
+    for chunk_cells in (1_000_000, 7):
+        results = batch_radius_query(lat, lon, centers_lat, centers_lon, radii, exact=exact, chunk_cells=chunk_cells)
+        assert len(results) == len(CENTERS)
+        for found, (center_lat, center_lon, radius_km) in zip(results, CENTERS):
+            assert list(found) == list(searcher.query(center_lat, center_lon, radius_km, exact=exact))
+    assert batch_radius_query(lat, lon, [], [], []) == []
+
+
+def test_bearings_are_clockwise_from_north():
+    bearings = bearings_deg(POINTS['Latitude'], POINTS['Longitude'], *BASE)
+    np.testing.assert_allclose(bearings[:6], [0, 90, 180, 270, 45, 315], atol=0.5)
+    assert np.isnan(bearings[6])
+
+
+@pytest.mark.parametrize('directions, expected', [
+    (['北側'], [0, 4, 5]),
+    (['南側'], [2]),
+    (['東側'], [1, 4]),
+    (['西側'], [3, 5]),
+    (['北側', '東側'], [0, 1, 4, 5]),
+    ([], [0, 1, 2, 3, 4, 5]),
+])
+def test_half_planes(directions, expected):
+    assert list(np.flatnonzero(direction_mask(POINTS, *BASE, directions=directions))) == expected
+
+
+@pytest.mark.parametrize('sector, expected', [
+    ((30, 100), [1, 4]),
+    # 北をまたぐ扇形
+    ((300, 60), [0, 4, 5]),
+    ((-60, 60), [0, 4, 5]),
+    ((0, 360), [0, 1, 2, 3, 4, 5]),
+])
+def test_sectors(sector, expected):
+    assert list(np.flatnonzero(direction_mask(POINTS, *BASE, sector=sector))) == expected
+
+
+def test_sector_mask_edges_are_inclusive():
+    bearings = np.array([0.0, 60.0, 180.0, 300.0, np.nan])
+    assert list(sector_mask(bearings, 300, 60)) == [True, True, False, True, False]
+    assert list(sector_mask(bearings, 0, 720)) == [True, True, True, True, False]
+
+
+def test_ring_keeps_distance_bounds(df):
+    lat, lon = _coordinates(df)
+    distances = haversine_km(np.radians(lat), np.radians(lon), *BASE)
+    mask = direction_mask(df, *BASE, ring=(2.0, 5.0))
+    assert mask.any()
+    assert (distances[mask] >= 2.0).all() and (distances[mask] <= 5.0).all()
+    assert mask.sum() == ((distances >= 2.0) & (distances <= 5.0)).sum()
+
+    # 条件を組み合わせても欠損した座標の行は含まれない
+    mask = direction_mask(POINTS, *BASE, directions=['北側'], sector=(0, 360), ring=(0.0, 2.0))
+    assert list(np.flatnonzero(mask)) == [0, 4, 5]
@@ -0,0 +1,90 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from geocoding import GeocodeCache, GeocodingStage, Gazetteer, TableGeocoder, _address_key
+
+ADDRESS = '兵庫県明石市新しい町1'
+
+
+class CountingTable(TableGeocoder):
+    def __init__(self, table):
+        super().__init__(table)
+        self.calls = 0
+
+    def geocode(self, address):
+        self.calls += 1
+        return super().geocode(address)
+
+
+def _resolve(gazetteer, cache, geocoder):
+    stage = GeocodingStage(gazetteer, cache, geocoder, workers=1)
+    return stage.resolve({_address_key(ADDRESS): ADDRESS}), stage.stats
+
+
+def test_not_found_is_cached_per_geocoder():
+    cache = GeocodeCache(':memory:')
+    empty = CountingTable({})
+    assert _resolve(None, cache, empty)[0] == {}
+    assert empty.calls == 1
+
+    # 同じ問い合わせ先には問い合わせ直さない
+    again = CountingTable({})
+    resolved, stats = _resolve(None, cache, again)
+    assert resolved == {}
+    assert again.calls == 0
+    assert stats['not_found'] == 1
+
+    # 表が変われば問い合わせ直し、見つかった座標はキャッシュから返す
+    filled = CountingTable({ADDRESS: (34.65, 135.0)})
+    assert _resolve(None, cache, filled)[0] == {_address_key(ADDRESS): (34.65, 135.0)}
+    assert filled.calls == 1
+    resolved, stats = _resolve(None, cache, CountingTable({}))
+    assert stats['cache'] == 1
+
+
+def test_not_found_is_retried_against_updated_gazetteer_and_after_ttl():
+    cache = GeocodeCache(':memory:')
+    geocoder = CountingTable({})
+    _resolve(Gazetteer([], [], []), cache, geocoder)
+
+    gazetteer = Gazetteer([_address_key(ADDRESS)], [34.6], [135.1])
+    resolved, stats = _resolve(gazetteer, cache, geocoder)
+    assert resolved == {_address_key(ADDRESS): (34.6, 135.1)}
+    assert stats['gazetteer'] == 1
+
+    key = _address_key(ADDRESS)
+    assert cache.get_many([key], geocoder.source) == {key: None}
+    assert cache.get_many([key], geocoder.source, negative_ttl=-1) == {}
+
+
+def test_lookup_strips_block_numbers():
+    gazetteer = Gazetteer(['兵庫県加古川市加古川町寺家町', '兵庫県神戸市東灘区魚崎北町1丁目'], [34.76, 34.72], [134.84, 135.28])
+    assert gazetteer.lookup(_address_key('加古川市加古川町寺家町12番3号')) == (34.76, 134.84)
+    assert gazetteer.lookup(_address_key('神戸市東灘区魚崎北町1丁目2-3')) == (34.72, 135.28)
+    # 丁目がなければ町の重心
+    assert gazetteer.lookup(_address_key('神戸市東灘区魚崎北町5丁目')) == (34.72, 135.28)
+
+
+@pytest.mark.parametrize('digits', ['1' * 5000, '1-' * 5000])
+def test_lookup_of_long_digit_run_is_fast(digits):
+    gazetteer = Gazetteer(['兵庫県加古川市加古川町寺家町'], [34.76], [134.84])
+    start = time.perf_counter()
+    assert gazetteer.lookup(_address_key(f'加古川市{digits}丁目')) is None
+    assert time.perf_counter() - start < 0.5
+
+
+def test_empty_addresses_are_not_looked_up():
+    cache = GeocodeCache(':memory:')
+    geocoder = CountingTable({})
+    chunk = pd.DataFrame({
+        '住所（スプレッドシート用）': pd.Series([np.nan, None, '', '  ', ADDRESS], dtype=object),
+        'Latitude': [np.nan] * 5,
+        'Longitude': [np.nan] * 5,
+    })
+    GeocodingStage(None, cache, geocoder, workers=1).fill(chunk)
+    assert geocoder.calls == 1
+    assert cache.get_many(['nan', ''], geocoder.source) == {}
+    assert len(cache) == 1
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from dataset import SessionDataset, SharedDataset, load_dataset
+from grid_pyramid import AggregationPyramid
+
+UPLOAD_COLUMNS = ['住所（スプレッドシート用）', 'Latitude', 'Longitude', '世帯数']
+
+# 加古川駅付近を囲む四角形
+SQUARE = [[np.array([[134.80, 34.72], [134.88, 34.72], [134.88, 34.79], [134.80, 34.79]])]]
+
+
+@pytest.fixture(scope='module')
+def session():
+    df, errors = load_dataset()
+    assert not errors
+    data = SessionDataset(SharedDataset(df))
+    added = df[UPLOAD_COLUMNS].sample(400, random_state=0)
+    added['Latitude'] = added['Latitude'] + 0.0002
+    updated = df[UPLOAD_COLUMNS].sample(200, random_state=1)
+    updated['世帯数'] = updated['世帯数'] * 2 + 1
+    data.append_chunks([pd.concat([added, updated])], policy='newest')
+    return data
+
+
+def _sorted(cells):
+    return cells.sort_values(['lat', 'lon']).reset_index(drop=True)
+
+
+def test_session_pyramid_matches_full_rebuild(session):
+    full = AggregationPyramid(*session.coordinates(), session.households())
+    pyramid = session.pyramid
+    assert pyramid.nbytes < full.nbytes / 4
+
+    ids = np.flatnonzero(np.random.default_rng(0).random(len(session)) < 0.3)
+    for level in range(len(full.levels)):
+        pd.testing.assert_frame_equal(_sorted(pyramid.cells(level)), _sorted(full.cells(level)), check_dtype=False)
+        pd.testing.assert_frame_equal(_sorted(pyramid.cells(level, ids)), _sorted(full.cells(level, ids)),
+                                      check_dtype=False)
+
+    assert pyramid.polygon_total(SQUARE) == full.polygon_total(SQUARE)
+
+
+def test_polygon_total_matches_exact_query(session):
+    ids = session.query_polygons(SQUARE)
+    assert session.polygon_total(SQUARE) == (int(session.households()[ids].sum()), len(ids))
@@ -0,0 +1,84 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from geo_search import RadiusSearcher
+from polygons import parse_geojson, points_in_polygon, polygon_bounds, polygons_geojson, polygons_key
+
+# 外周 (0,0)-(10,10) の正方形に (4,4)-(6,6) の穴（座標は (経度, 緯度)）
+OUTER = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+HOLE = [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]
+OTHER = [[20, 20], [22, 20], [22, 22], [20, 20]]
+POLYGON = {'type': 'Polygon', 'coordinates': [OUTER, HOLE]}
+
+
+def test_even_odd_rule_excludes_holes():
+    rings = parse_geojson(POLYGON)[0]
+    lat = np.array([1.0, 5.0, 5.0, 3.0, 11.0, -1.0, 5.0, np.nan])
+    lon = np.array([1.0, 5.0, 3.0, 7.0, 5.0, 5.0, 12.0, 5.0])
+    assert list(points_in_polygon(lat, lon, rings)) == [True, False, True, True, False, False, False, False]
+    # 穴がなければ中心も内側
+    assert points_in_polygon([5.0], [5.0], rings[:1])[0]
+    assert polygon_bounds(rings) == (0, 0, 10, 10)
+
+
+@pytest.mark.parametrize('geojson', [
+    POLYGON,
+    json.dumps(POLYGON),
+    json.dumps(POLYGON).encode('utf-8-sig'),
+    {'type': 'Feature', 'properties': {}, 'geometry': POLYGON},
+])
+def test_parse_single_polygon(geojson):
+    polygons = parse_geojson(geojson)
+    assert len(polygons) == 1
+    assert [ring.shape for ring in polygons[0]] == [(5, 2), (5, 2)]
+
+
+def test_parse_collections_in_order():
+    geojson = {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'geometry': {'type': 'MultiPolygon', 'coordinates': [[OUTER, HOLE], [OTHER]]}},
+        {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [1, 1]}},
+        {'type': 'Feature', 'geometry': {'type': 'GeometryCollection', 'geometries': [
+            {'type': 'LineString', 'coordinates': [[0, 0], [1, 1]]},
+            {'type': 'Polygon', 'coordinates': [[[p[0], p[1], 0.0] for p in OTHER]]},
+        ]}},
+        {'type': 'Feature', 'geometry': None},
+    ]}
+    polygons = parse_geojson(geojson)
+    assert [len(rings) for rings in polygons] == [2, 1, 1]
+    # 高度は捨てる
+    np.testing.assert_array_equal(polygons[2][0], np.array(OTHER, dtype=np.float64))
+
+    # 地図表示用に戻しても同じ多角形になる
+    again = parse_geojson(polygons_geojson(polygons))
+    assert polygons_key(again) == polygons_key(polygons)
+    assert polygons_key(polygons[:1]) != polygons_key(polygons)
+
+
+@pytest.mark.parametrize('geojson', [
+    {'type': 'Point', 'coordinates': [1, 1]},
+    {'type': 'FeatureCollection', 'features': []},
+    {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 1]]]},
+    [POLYGON],
+])
+def test_parse_without_polygons_raises(geojson):
+    with pytest.raises(ValueError):
+        parse_geojson(geojson)
+
+
+def test_invalid_json_raises():
+    # json.JSONDecodeError も ValueError の一種
+    with pytest.raises(ValueError):
+        parse_geojson('{"type": "Polygon",')
+
+
+def test_searcher_matches_full_scan():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'Latitude': rng.uniform(-2, 24, 3000), 'Longitude': rng.uniform(-2, 24, 3000)})
+    polygons = parse_geojson({'type': 'MultiPolygon', 'coordinates': [[OUTER, HOLE], [OTHER]]})
+    expected = np.zeros(len(df), dtype=bool)
+    for rings in polygons:
+        expected |= points_in_polygon(df['Latitude'], df['Longitude'], rings)
+    assert list(RadiusSearcher(df).polygons(polygons)) == list(np.flatnonzero(expected))
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from dataset import load_dataset
+from geo_search import RadiusSearcher
+from radius_solver import RadiusSolver
+
+# 加古川駅付近
+CENTER = (34.7569, 134.8414)
+UNIT_PRICE = 3.3
+
+
+@pytest.fixture(scope='module')
+def df():
+    df, errors = load_dataset()
+    assert not errors
+    return df
+
+
+@pytest.fixture(scope='module')
+def searcher(df):
+    return RadiusSearcher(df)
+
+
+def _solver(df):
+    return RadiusSolver(df['Latitude'], df['Longitude'], df['世帯数'], *CENTER)
+
+
+def _households_within(df, searcher, radius_km):
+    return int(df['世帯数'].to_numpy()[searcher.query(*CENTER, radius_km)].sum())
+
+
+@pytest.mark.parametrize('target', [1, 5000, 30000, 200000])
+def test_for_households_reaches_target_with_smallest_radius(df, searcher, target):
+    solver = _solver(df)
+    count, radius_km = solver.for_households(target)
+    assert solver.households(count) >= target
+    # 求めた半径の円形検索と同じ町になり、少しでも小さい半径では届かない
+    assert list(solver.ids(count)) == list(searcher.query(*CENTER, radius_km))
+    assert _households_within(df, searcher, radius_km * (1 - 1e-9)) < target
+
+
+@pytest.mark.parametrize('budget', [10000, 100000, 1000000])
+def test_for_budget_stays_within_budget(df, searcher, budget):
+    solver = _solver(df)
+    count, radius_km = solver.for_budget(budget, UNIT_PRICE)
+    assert 0 < count
+    assert solver.households(count) * UNIT_PRICE <= budget
+    assert list(solver.ids(count)) == list(searcher.query(*CENTER, radius_km))
+    # 次に近い町まで広げると予算を超える
+    assert solver.households(count + 1) * UNIT_PRICE > budget
+
+
+def test_targets_beyond_the_data(df):
+    solver = _solver(df)
+    located = int(df['Latitude'].notna().sum())
+    assert solver.total_households == int(df.loc[df['Latitude'].notna(), '世帯数'].sum())
+    assert solver.for_households(solver.total_households + 1)[0] == located
+    assert solver.for_budget(solver.total_households * UNIT_PRICE * 2, UNIT_PRICE)[0] == located
+    assert solver.for_budget(0, UNIT_PRICE) == (0, 0.0)
+    assert solver.households(0) == 0 and len(solver.ids(0)) == 0
+
+
+def test_towns_at_the_same_distance_are_kept_together():
+    lat = [34.75, 34.76, 34.76, np.nan, 34.80]
+    lon = [134.85, 134.85, 134.85, 134.85, 134.85]
+    solver = RadiusSolver(lat, lon, [10, 20, 30, 40, 50], 34.75, 134.85)
+    assert solver.for_households(15)[0] == 3
+    assert solver.for_budget(40, 1)[0] == 1
+    assert solver.for_budget(60, 1)[0] == 3
+    assert list(solver.ids(3)) == [0, 1, 2]
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from dataset import load_dataset
+from search_index import AddressSearchIndex, normalize_text
+
+ADDRESS_COLUMN = '住所（スプレッドシート用）'
+
+# 以前は見つからなかった検索語（ケが漢字に挟まれていない）
+KNOWN_QUERIES = ['ケ丘', '霞ケ', '雀ケ']
+
+# 漢数字を含む地名（十二所前町・二階町など）。前後を見て数字に読み替えると部分文字列が一致しなくなる
+NUMERAL_QUERIES = ['十二所', '二所前', '十二', '二階', '一色西１丁目']
+
+
+@pytest.fixture(scope='module')
+def addresses():
+    df, errors = load_dataset()
+    assert not errors
+    return df[ADDRESS_COLUMN].astype(str).reset_index(drop=True)
+
+
+@pytest.fixture(scope='module')
+def index(addresses):
+    return AddressSearchIndex(addresses)
+
+
+def _sample_queries(addresses, count=300, seed=0):
+    """実際の住所から切り出した部分文字列（長さ1〜5）"""
+    rng = np.random.default_rng(seed)
+    queries = []
+    for row in rng.integers(0, len(addresses), count):
+        text = addresses[row]
+        length = int(rng.integers(1, 6))
+        start = int(rng.integers(0, max(len(text) - length, 0) + 1))
+        query = text[start:start + length]
+        if query.strip():
+            queries.append(query)
+    return queries
+
+
+@pytest.mark.parametrize('query', KNOWN_QUERIES + NUMERAL_QUERIES)
+def test_known_queries_find_every_contains_match(addresses, index, query):
+    expected = set(np.flatnonzero(addresses.str.contains(query, regex=False)).tolist())
+    assert expected
+    ids, _ = index.search(query)
+    assert expected <= set(ids.tolist())
+
+
+def test_sampled_substrings_find_every_contains_match(addresses, index):
+    for query in _sample_queries(addresses):
+        expected = set(np.flatnonzero(addresses.str.contains(query, regex=False)).tolist())
+        ids, _ = index.search(query)
+        missing = expected - set(ids.tolist())
+        assert not missing, (query, [addresses[i] for i in sorted(missing)[:5]])
+
+
+@pytest.mark.parametrize('variant', ['松ケ丘', '松ヶ丘', '松が丘', '松ｹ丘'])
+def test_ga_variants_normalize_alike(variant):
+    assert normalize_text(variant) == normalize_text('松が丘')
+
+
+@pytest.mark.parametrize('query, address', [
+    ('十二丁目', '兵庫県姫路市本町十二丁目'),
+    ('二丁目', '兵庫県姫路市本町十二丁目'),
+    ('１２丁目', '兵庫県姫路市本町12丁目'),
+])
+def test_kanji_numerals_normalize_consistently(query, address):
+    """漢数字は住所・検索語とも変えない（「十二丁目」が「十2丁目」にならない）"""
+    assert normalize_text('十二丁目') == '十二丁目'
+    index = AddressSearchIndex([address, '兵庫県姫路市本町1丁目'])
+    ids, _ = index.search(query)
+    assert ids.tolist() == [0]
@@ -0,0 +1,133 @@
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+# 「兵庫県神戸市東灘区…」から都道府県・市・区を取り出す
+ADDRESS_PATTERN = re.compile(r'^(?P<prefecture>.+?[都道府県])?(?P<city>.+?市)(?P<ward>[^町丁区]{0,3}[^町丁区地]区)?')
+
+# 町名と末尾の丁目まで含めて分解する
+ADDRESS_PARTS_PATTERN = re.compile(
+    ADDRESS_PATTERN.pattern + r'(?P<town>.*?)(?:(?P<chome>[0-9０-９一二三四五六七八九十]+)丁目)?$'
+)
+
+# 住所から作る構造化された列
+ADDRESS_COLUMNS = ['prefecture', 'city', 'ward', 'town', 'chome']
+
+# 町ごとに合計する列
+SUM_COLUMNS = ['households', 'lat_sum', 'lon_sum', 'n_coords', 'n_rows']
+
+KANJI_NUMBERS = {c: i for i, c in enumerate('〇一二三四五六七八九')}
+
+
+def _chome_number(text):
+    """「１」「12」「十二」などの丁目の番号を整数にする"""
+    text = unicodedata.normalize('NFKC', text)
+    if text.isdigit():
+        return int(text)
+    if '十' in text:
+        tens, _, ones = text.partition('十')
+        return KANJI_NUMBERS.get(tens, 1) * 10 + KANJI_NUMBERS.get(ones, 0)
+    return KANJI_NUMBERS.get(text)
+
+
+def parse_addresses(addresses):
+    """住所を都道府県・市・区・町・丁目に分解する
+
+    該当しない部分は空文字（丁目は欠損）
+    """
+    # 同じ住所は1回だけ分解する
+    codes, uniques = pd.factorize(pd.Series(addresses, dtype=str))
+    parts = pd.Series(uniques, dtype=str).str.extract(ADDRESS_PARTS_PATTERN)
+    chome = parts['chome'].map(_chome_number, na_action='ignore')
+    parts = parts[ADDRESS_COLUMNS[:-1]].fillna('')
+    parts['chome'] = pd.array(chome, dtype='Int16')
+    return parts.take(codes).reset_index(drop=True)
+
+
+def _aggregate(df):
+    lat = pd.to_numeric(df['Latitude'], errors='coerce').to_numpy(dtype=np.float64)
+    lon = pd.to_numeric(df['Longitude'], errors='coerce').to_numpy(dtype=np.float64)
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    rows = pd.DataFrame({
+        'households': df['世帯数'].to_numpy(dtype=np.int64),
+        'lat_sum': np.where(valid, lat, 0.0),
+        'lon_sum': np.where(valid, lon, 0.0),
+        'n_coords': valid.astype(np.int64),
+        'n_rows': np.ones(len(df), dtype=np.int64),
+        'city': df['city'].astype(str).to_numpy(dtype=object),
+        'ward': df['ward'].astype(str).to_numpy(dtype=object),
+    }, index=pd.Index(df['住所（スプレッドシート用）'].to_numpy(dtype=object), name='town'))
+    return rows.groupby(level=0, sort=False).agg(
+        {column: 'sum' for column in SUM_COLUMNS} | {'city': 'first', 'ward': 'first'}
+    )
+
+
+class TownAggregates:
+    """住所（町名）ごとの世帯数・座標・市・区の集計表
+
+    データ読込み時に一度だけ作り、アップロード時は追加分だけを集計して足し込む。
+    """
+
+    def __init__(self, df):
+        self.table = _aggregate(df)
+
+    def __len__(self):
+        return len(self.table)
+
+    def append(self, df):
+        """追加された行を集計して表に反映する"""
+        self._merge(_aggregate(df))
+
+    def adjust_households(self, df, deltas):
+        """既存の行（df）の世帯数が deltas だけ変わったことを表に反映する"""
+        new = _aggregate(df.assign(世帯数=deltas))
+        new[SUM_COLUMNS[1:]] = 0
+        self._merge(new)
+
+    def _merge(self, new):
+        common = new.index.intersection(self.table.index)
+        if len(common):
+            self.table.loc[common, SUM_COLUMNS] += new.loc[common, SUM_COLUMNS]
+        self.table = pd.concat([self.table, new.drop(common)])
+
+    def sums(self, towns):
+        """指定した町の合計値（存在しない町は0）"""
+        # 表全体をコピーしないよう、行位置を求めて必要な行だけを列ごとに取り出す
+        towns = self._index(towns)
+        positions = self.table.index.get_indexer(towns)
+        missing = positions < 0
+        sums = {}
+        for column in SUM_COLUMNS:
+            values = self.table[column].to_numpy()[positions]
+            values[missing] = 0
+            sums[column] = values
+        return pd.DataFrame(sums, index=towns)
+
+    def attributes(self, towns):
+        """指定した町の市・区名（存在しない町は欠損）"""
+        return self.table.reindex(self._index(towns))[['city', 'ward']]
+
+    def _index(self, towns):
+        # 表と同じ型の Index にする（型が違うと照合のたびに表の Index 全体が変換される）
+        return pd.Index(towns, dtype=self.table.index.dtype)
+
+
+def town_frame(sums, attributes):
+    """合計値から町ごとの表（世帯数・重心座標・市・区）を作る
+
+    列名は元データと同じにして、地図やエクスポートにそのまま使えるようにする
+    """
+    n_coords = sums['n_coords'].to_numpy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        lat = np.where(n_coords > 0, sums['lat_sum'].to_numpy() / n_coords, np.nan)
+        lon = np.where(n_coords > 0, sums['lon_sum'].to_numpy() / n_coords, np.nan)
+    return pd.DataFrame({
+        '住所（スプレッドシート用）': sums.index.to_numpy(dtype=object),
+        '世帯数': sums['households'].to_numpy(dtype=np.int64),
+        'Latitude': lat,
+        'Longitude': lon,
+        '市': attributes['city'].fillna('').to_numpy(dtype=object),
+        '区': attributes['ward'].fillna('').to_numpy(dtype=object),
+    })